@@ -0,0 +1,35 @@
+"""
+Доступ к отладочным эндпоинтам по ADMIN_TOKEN (заголовок X-Admin-Token).
+Без ADMIN_TOKEN в окружении отладочные эндпоинты выключены (404).
+"""
+import hmac
+import os
+from typing import Optional, Union
+
+from fastapi import Header, HTTPException
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+_ADMIN_TOKEN_BYTES = ADMIN_TOKEN.encode()
+
+
+def is_admin_token(token: Union[str, bytes, None]) -> bool:
+    """
+    Сравнение байтов: compare_digest на str падает с TypeError при не-ASCII
+    символах. token - сырые байты заголовка или str, которую Starlette
+    декодировала из них как latin-1.
+    """
+    if not ADMIN_TOKEN or token is None:
+        return False
+    if isinstance(token, str):
+        try:
+            token = token.encode("latin-1")
+        except UnicodeEncodeError:
+            return False  # Из заголовка такой строки не получить
+    return hmac.compare_digest(token, _ADMIN_TOKEN_BYTES)
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
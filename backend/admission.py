@@ -0,0 +1,91 @@
+"""
+Контроль допуска: при перегрузке быстрый 503 вместо общей очереди.
+
+Сигналы перегрузки - запросы в обработке, задержка event loop (по
+LoopMonitor) и очередь потока-писателя. Нагрузка - наибольшее из
+отношений сигнала к своему порогу (ADMISSION_MAX_IN_FLIGHT,
+ADMISSION_MAX_LAG_MS, ADMISSION_MAX_WRITE_QUEUE).
+
+- нагрузка >= 1: отклоняются запросы низкого приоритета (история покупок
+  и результатов, список рефералов);
+- нагрузка >= 2: отклоняются все, кроме критичных;
+- критичные (/api/auth, /api/payments/*, health) принимаются всегда, как
+  и /metrics с /api/debug/*: мониторинг и админка нужнее всего именно под
+  нагрузкой, а они дешёвые или закрыты токеном администратора.
+
+Отказ - 503 с Retry-After: ADMISSION_RETRY_AFTER, до роутинга и без
+обращения к БД. Пороги и отказы видны в /metrics.
+"""
+import json
+import os
+from typing import Callable
+
+import metrics
+
+MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "200"))
+MAX_LAG = float(os.getenv("ADMISSION_MAX_LAG_MS", "100")) / 1000
+MAX_WRITE_QUEUE = int(os.getenv("ADMISSION_MAX_WRITE_QUEUE", "500"))
+RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+
+CRITICAL, NORMAL, LOW = "critical", "normal", "low"
+
+CRITICAL_PREFIXES = ("/api/auth", "/api/payments/", "/health", "/api/health", "/metrics", "/api/debug/")
+LOW_PRIORITY = {("GET", "/api/purchases"), ("GET", "/api/results"), ("GET", "/api/referrals")}
+
+# Уровень нагрузки, начиная с которого отклоняется приоритет
+SHED_AT = {LOW: 1.0, NORMAL: 2.0}
+
+rejected = metrics.Counter(metrics.registry, "admission_rejected_total", "Requests shed with 503 by priority",
+                           ("priority",))
+metrics.GaugeCallback(metrics.registry, "admission_max_in_flight", "In-flight requests threshold",
+                      lambda: MAX_IN_FLIGHT)
+metrics.GaugeCallback(metrics.registry, "admission_max_loop_lag_seconds", "Event loop lag threshold",
+                      lambda: MAX_LAG)
+metrics.GaugeCallback(metrics.registry, "admission_max_write_queue", "Writer queue depth threshold",
+                      lambda: MAX_WRITE_QUEUE)
+
+
+def priority_of(method: str, path: str) -> str:
+    if path.startswith(CRITICAL_PREFIXES):
+        return CRITICAL
+    if (method, path.rstrip("/")) in LOW_PRIORITY:
+        return LOW
+    return NORMAL
+
+
+_REJECT_BODY = json.dumps({"detail": "Server overloaded, retry later"}).encode()
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, loop_lag: Callable[[], float], write_queue_depth: Callable[[], int]):
+        self.app = app
+        self.loop_lag = loop_lag
+        self.write_queue_depth = write_queue_depth
+        self.in_flight = 0
+        metrics.GaugeCallback(metrics.registry, "admission_load", "Current load relative to thresholds",
+                              self.load)
+
+    def load(self) -> float:
+        return max(self.in_flight / MAX_IN_FLIGHT,
+                   self.loop_lag() / MAX_LAG,
+                   self.write_queue_depth() / MAX_WRITE_QUEUE)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        priority = priority_of(scope["method"], scope["path"])
+        if priority != CRITICAL and self.load() >= SHED_AT[priority]:
+            rejected.inc(priority)
+            await send({"type": "http.response.start", "status": 503, "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(_REJECT_BODY)).encode()),
+                (b"retry-after", str(RETRY_AFTER).encode()),
+            ]})
+            await send({"type": "http.response.body", "body": _REJECT_BODY})
+            return
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,38 @@
+"""Общие помощники бенчмарков: подписанный initData и перцентили."""
+import hashlib
+import hmac
+import json
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional
+
+TEST_BOT_TOKEN = "123456:TEST-load-generator-token"
+
+
+def sign_init_data(bot_token: str, user: Dict[str, Any], auth_date: Optional[int] = None) -> str:
+    """initData в формате Telegram WebApp, подписанный как это делает Telegram."""
+    pairs = {
+        "auth_date": str(auth_date if auth_date is not None else int(time.time())),
+        "query_id": f"AAH{user['id']}",
+        "user": json.dumps(user, ensure_ascii=False, separators=(",", ":")),
+    }
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(pairs.items()))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    pairs["hash"] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urllib.parse.urlencode(pairs)
+
+
+def synthetic_user(index: int) -> Dict[str, Any]:
+    return {
+        "id": 7_000_000_000 + index,
+        "first_name": f"Load{index}",
+        "username": f"load_user_{index}",
+        "language_code": "ru",
+    }
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
@@ -0,0 +1,267 @@
+"""
+Генератор синтетических данных для проверки схемы на масштабе.
+
+Заливает N пользователей и всё, что у них бывает в жизни: реферальные
+деревья со степенным распределением (preferential attachment - у кого
+больше приглашённых, тот чаще приглашает ещё), пополнения, покупки скинов
+и ромашек, user_skins и историю результатов. Каждая денежная операция
+пишется и в purchases, и двойной проводкой в ledger_entries, а
+users.balance равен сумме журнала - python ledger.py проходит без
+расхождений.
+
+Данные полностью определяются --seed (включая даты), поэтому бенчмарки
+на них воспроизводимы. Пользователь с номером i получает tg_id
+synthetic_user(i), так что loadtest и micro могут подписать ему initData.
+
+Запуск из папки backend:
+    python -m bench.datagen --users 1000000 --seed 1
+    python -m bench.datagen --users 100000 --database-url sqlite:///./scale.db --verify
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from array import array
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from bench.common import synthetic_user
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# Все даты отсчитываются от фиксированной точки, а не от now(): иначе данные зависели бы от дня запуска
+EPOCH = datetime(2025, 1, 1)
+SPAN = timedelta(days=365)
+
+PAYMENT_AMOUNTS = [100, 250, 500, 1000]
+DAISY_COST = 50
+SIGNUP_BONUS = 100
+INVITER_BONUS = 50
+INVITED_BONUS = 25
+
+TEXT_SETS = [
+    ["любит", "не любит"],
+    ["купить", "не покупать"],
+    ["позвонит", "не позвонит"],
+    ["любит", "не любит", "плюнет", "поцелует", "к сердцу прижмёт", "к чёрту пошлёт"],
+]
+
+
+def build_referral_forest(rnd: random.Random, users: int, invited_share: float):
+    """
+    Первый проход: кто кого пригласил. inviters[i] - номер пригласившего
+    (или -1), counts[i] - число приглашённых. Пригласивший выбирается
+    пропорционально (число его приглашённых + 1).
+    """
+    inviters = array("l", [-1]) * users
+    counts = array("l", [0]) * users
+    # Каждый пользователь лежит здесь 1 + counts[i] раз
+    attachment = array("l")
+    for i in range(users):
+        if attachment and rnd.random() < invited_share:
+            inviter = attachment[rnd.randrange(len(attachment))]
+            inviters[i] = inviter
+            counts[inviter] += 1
+            attachment.append(inviter)
+        attachment.append(i)
+    return inviters, counts
+
+
+class Batch:
+    """Строки одной транзакции, по таблицам."""
+
+    def __init__(self):
+        self.users: List[Dict[str, Any]] = []
+        self.referrals: List[Dict[str, Any]] = []
+        self.purchases: List[Dict[str, Any]] = []
+        self.user_skins: List[Dict[str, Any]] = []
+        self.results: List[Dict[str, Any]] = []
+        self.ledger: List[Dict[str, Any]] = []
+
+    def post(self, tx_id: str, user_id: int, amount: int, kind: str, counter_account: str,
+             created_at: datetime, reference: str = None) -> None:
+        """Двойная проводка в том же виде, что ledger.post."""
+        import ledger
+
+        self.ledger.append({"tx_id": tx_id, "account": ledger.USER_ACCOUNT, "user_id": user_id,
+                            "amount": amount, "kind": kind, "reference": reference, "created_at": created_at})
+        self.ledger.append({"tx_id": tx_id, "account": counter_account, "user_id": None,
+                            "amount": -amount, "kind": kind, "reference": reference, "created_at": created_at})
+
+
+def generate_user(rnd: random.Random, batch: Batch, i: int, users: int, inviters, counts,
+                  skins: List[Dict[str, Any]], avg_results: float) -> None:
+    import ledger
+
+    user_id = i + 1
+    created_at = EPOCH + SPAN * (i / users) + timedelta(seconds=rnd.randrange(3600))
+    info = synthetic_user(i)
+
+    def moment() -> datetime:
+        return created_at + timedelta(seconds=rnd.randrange(30 * 86400))
+
+    tx = 0
+
+    def next_tx() -> str:
+        nonlocal tx
+        tx += 1
+        return f"gen-{user_id}-{tx}"
+
+    balance = SIGNUP_BONUS
+    batch.post(next_tx(), user_id, SIGNUP_BONUS, "signup_bonus", ledger.BONUS_ACCOUNT, created_at)
+
+    # Приглашение: бонусы обоим, как в apply_referral; у пригласившего они учтены в его балансе заранее
+    inviter = inviters[i]
+    if inviter >= 0:
+        at = created_at + timedelta(seconds=rnd.randrange(600))
+        batch.referrals.append({"inviter_id": inviter + 1, "invited_id": user_id, "rewarded": False,
+                                "created_at": at})
+        batch.post(next_tx(), inviter + 1, INVITER_BONUS, "referral_bonus", ledger.REFERRALS_ACCOUNT, at)
+        batch.purchases.append({"user_id": inviter + 1, "item_type": "referral_bonus", "item_id": None,
+                                "amount": INVITER_BONUS, "payment_id": None, "created_at": at})
+        batch.post(next_tx(), user_id, INVITED_BONUS, "referral_bonus", ledger.REFERRALS_ACCOUNT, at)
+        batch.purchases.append({"user_id": user_id, "item_type": "referral_bonus", "item_id": None,
+                                "amount": INVITED_BONUS, "payment_id": None, "created_at": at})
+        balance += INVITED_BONUS
+    balance += INVITER_BONUS * counts[i]
+
+    # Платит меньшинство, зато некоторые много раз
+    if rnd.random() < 0.15:
+        for k in range(min(50, int(rnd.paretovariate(1.5)))):
+            amount = rnd.choice(PAYMENT_AMOUNTS)
+            payment_id = f"gen-pay-{user_id}-{k}"
+            at = moment()
+            batch.post(next_tx(), user_id, amount, "balance", ledger.PAYMENTS_ACCOUNT, at, payment_id)
+            batch.purchases.append({"user_id": user_id, "item_type": "balance", "item_id": None,
+                                    "amount": amount, "payment_id": payment_id, "created_at": at})
+            balance += amount
+
+    current_skin_id = next(skin["id"] for skin in skins if skin["is_default"])
+    for skin in rnd.sample(skins, len(skins)):
+        if skin["is_default"] or skin["price"] > balance or rnd.random() > 0.3:
+            continue
+        at = moment()
+        batch.post(next_tx(), user_id, -skin["price"], "skin", ledger.SHOP_ACCOUNT, at, str(skin["id"]))
+        batch.user_skins.append({"user_id": user_id, "skin_id": skin["id"], "purchased_at": at})
+        batch.purchases.append({"user_id": user_id, "item_type": "skin", "item_id": skin["id"],
+                                "amount": skin["price"], "payment_id": None, "created_at": at})
+        balance -= skin["price"]
+        if rnd.random() < 0.7:
+            current_skin_id = skin["id"]
+
+    daisies_left = rnd.randrange(3)
+    while balance >= DAISY_COST and rnd.random() < 0.2:
+        at = moment()
+        batch.post(next_tx(), user_id, -DAISY_COST, "daisy", ledger.SHOP_ACCOUNT, at)
+        batch.purchases.append({"user_id": user_id, "item_type": "daisy", "item_id": None,
+                                "amount": DAISY_COST, "payment_id": None, "created_at": at})
+        balance -= DAISY_COST
+
+    texts = TEXT_SETS[0] if rnd.random() < 0.6 else rnd.choice(TEXT_SETS)
+    # Парето с alpha=1.2 - среднее около 6 на пользователя, редкие пользователи с тысячами
+    results_count = min(10_000, int(rnd.paretovariate(1.2) * avg_results / 6))
+    for _ in range(results_count):
+        batch.results.append({"user_id": user_id, "result_text": rnd.choice(texts), "created_at": moment()})
+
+    batch.users.append({
+        "id": user_id,
+        "tg_id": info["id"],
+        "username": info["username"] if rnd.random() < 0.8 else None,
+        "first_name": info["first_name"],
+        "last_name": "Synthetic" if rnd.random() < 0.5 else None,
+        "balance": balance,
+        "referrals_count": counts[i],
+        "current_skin_id": current_skin_id,
+        # Дефолтный набор - NULL, остальные заранее лежат в text_sets с id = номеру в TEXT_SETS
+        "text_set_id": TEXT_SETS.index(texts) or None,
+        "daisies_left": daisies_left,
+        "texts_preset_key": None,
+        "version": 1,
+        "created_at": created_at,
+    })
+
+
+def insert_batch(conn, batch: Batch) -> int:
+    from database import LedgerEntry, Purchase, Referral, Result, User, UserSkin
+
+    rows = 0
+    # Пользователи первыми: остальные таблицы ссылаются на них
+    for model, params in ((User, batch.users), (Referral, batch.referrals), (Purchase, batch.purchases),
+                          (UserSkin, batch.user_skins), (Result, batch.results), (LedgerEntry, batch.ledger)):
+        if params:
+            conn.execute(model.__table__.insert(), params)
+            rows += len(params)
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database-url", help="куда заливать (по умолчанию bench/results/datagen-<users>-s<seed>.db)")
+    parser.add_argument("--invited-share", type=float, default=0.4, help="доля пользователей, пришедших по приглашению")
+    parser.add_argument("--avg-results", type=float, default=6.0, help="среднее число результатов на пользователя")
+    parser.add_argument("--batch-users", type=int, default=20_000, help="пользователей на одну транзакцию")
+    parser.add_argument("--verify", action="store_true", help="после заливки сверить балансы с журналом")
+    args = parser.parse_args()
+
+    url = args.database_url
+    if url is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"datagen-{args.users}-s{args.seed}.db")
+        if os.path.exists(path):
+            sys.exit(f"{path} already exists; remove it or pass --database-url")
+        url = "sqlite:///" + path
+    # До импорта database: движок создаётся при импорте
+    os.environ["DATABASE_URL"] = url
+    from sqlalchemy import event, select
+    from database import (Skin, TextSet, User, create_tables, engine, init_default_skins, migrate_schema,
+                          text_set_digest, text_set_json)
+    import ledger
+
+    if url.startswith("sqlite"):
+        @event.listens_for(engine, "connect")
+        def _bulk_load_pragmas(dbapi_connection, connection_record):
+            # Данные одноразовые: fsync на каждую транзакцию заливки не нужен
+            dbapi_connection.execute("PRAGMA synchronous=OFF")
+
+    create_tables()
+    migrate_schema()
+    init_default_skins()
+    with engine.connect() as conn:
+        if conn.execute(select(User.id).limit(1)).first() is not None:
+            sys.exit(f"{url} already has users; the generator only fills an empty database")
+        skins = [dict(row._mapping) for row in conn.execute(
+            select(Skin.id, Skin.price, Skin.is_default).order_by(Skin.id))]
+
+    with engine.begin() as conn:
+        conn.execute(TextSet.__table__.insert(), [
+            {"id": set_id, "digest": text_set_digest(texts), "texts": text_set_json(texts)}
+            for set_id, texts in enumerate(TEXT_SETS) if set_id
+        ])
+
+    rnd = random.Random(args.seed)
+    started = time.perf_counter()
+    inviters, counts = build_referral_forest(rnd, args.users, args.invited_share)
+    total_rows = 0
+    for start in range(0, args.users, args.batch_users):
+        batch = Batch()
+        for i in range(start, min(start + args.batch_users, args.users)):
+            generate_user(rnd, batch, i, args.users, inviters, counts, skins, args.avg_results)
+        with engine.begin() as conn:
+            total_rows += insert_batch(conn, batch)
+        elapsed = time.perf_counter() - started
+        print(f"{min(start + args.batch_users, args.users)}/{args.users} users, {total_rows} rows, "
+              f"{total_rows / elapsed * 60 / 1e6:.2f}M rows/min", flush=True)
+
+    top = max(range(args.users), key=counts.__getitem__) if args.users else None
+    print(f"done in {time.perf_counter() - started:.1f}s: {total_rows} rows into {url}")
+    if top is not None:
+        print(f"largest referral fan-out: user {top + 1} with {counts[top]} invited")
+    if args.verify:
+        sys.exit(ledger.main([]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Флеш-распродажа лимитированного выпуска: тысячи покупателей в одну секунду.
+
+Каждый из --users пользователей пытается купить единицу тиража --stock,
+часть (--retry-share) повторяет попытку, как нетерпеливый клиент. Запросы
+идут --concurrency задачами через WriteQueue, как обработчик buy_drop:
+быстрый отказ по drops.sold_out до очереди, затем работа в писателе.
+
+Способы:
+    naive        - остаток читается в обработчике, писатель записывает
+                   remaining = прочитанное - 1 (прочитал-проверил-записал);
+    conditional  - drops.buy_drop: условный UPDATE ... WHERE remaining > 0,
+                   --shards 1 и заданное число шардов.
+После каждого прогона сверяются продажи, остаток, уникальность покупателей
+и журнал баланса: oversold - продано сверх тиража, counter drift - продажи
+плюс остаток минус тираж (потерянные списания).
+
+Запуск из папки backend:
+    python -m bench.flash_sale [--users 5000] [--stock 500] [--shards 8]
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# База для бенчмарка - временный файл, а не daisy_game.db
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+
+from fastapi import HTTPException  # noqa: E402
+from sqlalchemy import event, func, insert, select, update  # noqa: E402
+
+from database import (  # noqa: E402
+    Drop, LedgerEntry, SessionLocal, StockClaim, StockCounter, User, create_tables, engine,
+    init_default_skins, migrate_schema,
+)
+import drops  # noqa: E402
+import ledger  # noqa: E402
+from write_queue import WriteQueue  # noqa: E402
+
+
+def naive_buy(wdb, drop: Drop, user_id: int, seen: int) -> None:
+    """Остаток прочитан вне транзакции писателя и записывается как значение, а не разность."""
+    if seen <= 0:
+        raise HTTPException(status_code=410, detail="Sold out")
+    key = drops.drop_key(drop.id)
+    wdb.execute(update(StockCounter).where(StockCounter.key == key, StockCounter.shard == 0)
+                .values(remaining=seen - 1))
+    wdb.execute(insert(StockClaim), {"key": key, "user_id": user_id})
+    ledger.post(wdb, user_id, -drop.price, "skin", ledger.SHOP_ACCOUNT, reference=str(drop.skin_id),
+                require_funds=True)
+
+
+async def run(mode: str, shards: int, skin_id: int, args, writer: WriteQueue, commits: list) -> None:
+    """skin_id у каждого прогона свой: скин выдаётся пользователю один раз."""
+    now = datetime.utcnow()
+
+    def create(wdb) -> int:
+        drop = Drop(skin_id=skin_id, price=10, stock=args.stock, shards=shards,
+                    starts_at=now - timedelta(minutes=1), ends_at=now + timedelta(hours=1))
+        wdb.add(drop)
+        wdb.flush()
+        drops.create_counter(wdb, drops.drop_key(drop.id), args.stock, shards)
+        return drop.id
+
+    # Выпуск читается как в обработчике: сессией запроса, до очереди писателя
+    drop_id = await writer.run(create)
+    with SessionLocal() as db:
+        drop = db.get(Drop, drop_id)
+    key = drops.drop_key(drop.id)
+    rnd = random.Random(args.seed)
+    attempts = list(range(1, args.users + 1))
+    attempts += rnd.sample(attempts, int(args.users * args.retry_share))
+    rnd.shuffle(attempts)
+    outcomes = {"ok": 0, "sold_out": 0, "duplicate": 0, "fast_reject": 0, "other": 0}
+    pending = iter(attempts)
+
+    async def buyer() -> None:
+        for user_id in pending:
+            try:
+                if mode == "naive":
+                    with SessionLocal() as db:
+                        seen = db.execute(select(StockCounter.remaining).where(StockCounter.key == key)).scalar()
+                    await writer.run(lambda wdb: naive_buy(wdb, drop, user_id, seen))
+                else:
+                    if key in drops.sold_out:
+                        outcomes["fast_reject"] += 1
+                        continue
+                    await writer.run(lambda wdb: drops.buy_drop(wdb, drop, user_id))
+                outcomes["ok"] += 1
+            except HTTPException as e:
+                outcomes["sold_out" if e.status_code == 410 else "duplicate" if e.status_code == 409 else "other"] += 1
+            except Exception:
+                outcomes["duplicate"] += 1  # Уникальность stock_claims в naive
+
+    commits.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*(buyer() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    with SessionLocal() as db:
+        sold = db.execute(select(func.count()).select_from(StockClaim).where(StockClaim.key == key)).scalar()
+        left = db.execute(select(func.sum(StockCounter.remaining)).where(StockCounter.key == key)).scalar()
+        negative = db.execute(select(func.count()).select_from(StockCounter)
+                              .where(StockCounter.key == key, StockCounter.remaining < 0)).scalar()
+        buyers = db.execute(select(func.count(func.distinct(StockClaim.user_id))).where(StockClaim.key == key)).scalar()
+        charged = -db.execute(select(func.sum(LedgerEntry.amount)).where(
+            LedgerEntry.account == ledger.USER_ACCOUNT, LedgerEntry.kind == "skin",
+            LedgerEntry.created_at >= now)).scalar()
+    label = f"{mode} x{shards}" if mode != "naive" else mode
+    print(f"{label:>16}: {len(attempts) / elapsed:7.0f} attempts/s  {elapsed * 1e3:6.0f} ms  "
+          f"{len(commits):5d} commits  sold {sold:5d}/{args.stock}  left {left:4d}  "
+          f"oversold {max(sold - args.stock, 0):4d}  counter drift {sold + left - args.stock:4d}  "
+          f"negative shards {negative}  buyers {buyers}  charged {charged // drop.price}  {outcomes}")
+
+
+async def main_async(args) -> None:
+    create_tables()
+    migrate_schema()
+    init_default_skins()
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {"tg_id": i, "balance": 1_000_000, "version": 1} for i in range(1, args.users + 1)
+        ])
+    commits: list = []
+    event.listen(engine, "commit", lambda conn: commits.append(1))
+    writer = WriteQueue()
+    print(f"{args.users} users (+{args.retry_share:.0%} retries), stock {args.stock}, "
+          f"concurrency {args.concurrency}, {engine.url}")
+    try:
+        await run("naive", 1, 2, args, writer, commits)
+        await run("conditional", 1, 3, args, writer, commits)
+        if args.shards > 1:
+            await run("conditional", args.shards, 4, args, writer, commits)
+    finally:
+        writer.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--stock", type=int, default=500)
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=256, help="одновременных покупателей")
+    parser.add_argument("--retry-share", type=float, default=0.2, help="доля пользователей с повторной попыткой")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+Нагрузочный генератор, имитирующий сессии Mini App от начала до конца.
+
+Поднимает локальный uvicorn с main:app на временной SQLite (или бьёт в уже
+запущенный сервер через --url), создаёт синтетических пользователей с
+корректно подписанным initData (тестовый токен бота) и проигрывает сессии:
+auth -> skins -> иногда смена пресета (key и texts одним запросом) ->
+раунды (daisies, results) -> покупка ромашки -> история.
+Печатает пропускную способность и p50/p95/p99 по эндпоинтам и сохраняет
+JSON в bench/results/ для сравнения прогонов.
+
+Запуск из папки backend:
+    python -m bench.loadtest --sessions 500 --concurrency 50
+    python -m bench.loadtest --compare bench/results/loadtest-<время>.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional, Tuple
+
+from bench.common import TEST_BOT_TOKEN, percentile, sign_init_data, synthetic_user
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+PRESET_SHARE = 0.3  # Доля сессий, меняющих пресет
+PRESET_TEXTS = [["любит", "не любит"], ["да", "нет"], ["купить", "подождать"], ["сегодня", "завтра"]]
+
+
+class HttpConnection:
+    """Минимальный HTTP/1.1 клиент с keep-alive поверх asyncio-потоков."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, params: Optional[Dict[str, Any]] = None,
+                      body: Any = None, headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if params:
+            path += "?" + urllib.parse.urlencode(params)
+        payload = json.dumps(body).encode() if body is not None else b""
+        head = (
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            + ("Content-Type: application/json\r\n" if body is not None else "")
+            + "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+            + "\r\n"
+        )
+        self.writer.write(head.encode() + payload)
+        try:
+            return await self._read_response()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            await self.close()
+            raise
+
+    async def _read_response(self) -> Tuple[int, bytes]:
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            body = b""
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                body += await self.reader.readexactly(size)
+                await self.reader.readline()
+        else:
+            body = await self.reader.readexactly(int(headers.get("content-length", "0")))
+        if headers.get("connection") == "close":
+            await self.close()
+        return status, body
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+
+    def record(self, name: str, seconds: float, status: Optional[int]) -> None:
+        """status None - соединение оборвалось; 4xx считаются отказами, 5xx - ошибками."""
+        self.latencies.setdefault(name, []).append(seconds)
+        if status is None or status >= 500:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        elif status >= 400:
+            self.rejected[name] = self.rejected.get(name, 0) + 1
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        endpoints = {}
+        total = 0
+        for name, values in sorted(self.latencies.items()):
+            values.sort()
+            total += len(values)
+            endpoints[name] = {
+                "count": len(values),
+                "errors": self.errors.get(name, 0),
+                "rejected": self.rejected.get(name, 0),
+                "rps": len(values) / elapsed,
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p95_ms": percentile(values, 0.95) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+            }
+        return {
+            "elapsed_s": elapsed,
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "rps": total / elapsed,
+            "endpoints": endpoints,
+        }
+
+
+async def call(conn: HttpConnection, stats: Stats, name: str, method: str, path: str,
+               params: Optional[Dict[str, Any]] = None, body: Any = None) -> Optional[Any]:
+    started = time.perf_counter()
+    try:
+        status, raw = await conn.request(method, path, params, body)
+    except (ConnectionError, OSError, asyncio.IncompleteReadError):
+        stats.record(name, time.perf_counter() - started, None)
+        return None
+    stats.record(name, time.perf_counter() - started, status)
+    return json.loads(raw) if raw and status < 400 else None
+
+
+async def session(conn: HttpConnection, stats: Stats, index: int, rnd: random.Random, think: float) -> None:
+    """Одна сессия игрока в Mini App."""
+    init_data = sign_init_data(TEST_BOT_TOKEN, synthetic_user(index))
+    q = {"init_data": init_data}
+
+    async def pause():
+        if think:
+            await asyncio.sleep(rnd.uniform(0, 2 * think))
+
+    user = await call(conn, stats, "POST /api/auth", "POST", "/api/auth", body={"initData": init_data})
+    if user is None:
+        return
+    await pause()
+    await call(conn, stats, "GET /api/skins", "GET", "/api/skins", q)
+    if rnd.random() < PRESET_SHARE:
+        # key и texts вместе: одна единица записи, один UPDATE users
+        await pause()
+        texts = rnd.choice(PRESET_TEXTS)
+        if await call(conn, stats, "POST /api/preset", "POST", "/api/preset", q,
+                      {"key": f"preset_{rnd.randrange(3)}", "texts": texts}) is not None:
+            user["custom_texts"] = texts
+    for _ in range(rnd.randint(2, 6)):
+        await pause()
+        state = await call(conn, stats, "GET /api/daisies", "GET", "/api/daisies", q)
+        left = state["daisies_left"] if state else 0
+        if left <= 0:
+            bought = await call(conn, stats, "POST /api/daisies/buy", "POST", "/api/daisies/buy", q)
+            if bought is None:
+                break
+            left = bought["daisies_left"]
+        await call(conn, stats, "POST /api/daisies", "POST", "/api/daisies", q, {"value": left - 1})
+        await call(conn, stats, "POST /api/results", "POST", "/api/results", q,
+                   {"text": rnd.choice(user.get("custom_texts") or ["любит", "не любит"])})
+    await pause()
+    await call(conn, stats, "GET /api/purchases", "GET", "/api/purchases", q)
+    await call(conn, stats, "GET /api/results", "GET", "/api/results", q)
+
+
+async def run_load(host: str, port: int, sessions: int, concurrency: int, seed: int,
+                   think: float, user_pool: int) -> Dict[str, Any]:
+    stats = Stats()
+    rnd = random.Random(seed)
+    # Пул пользователей меньше числа сессий - часть сессий повторные (пользователь уже есть)
+    indices = iter([rnd.randrange(user_pool) for _ in range(sessions)])
+
+    async def virtual_user(worker: int) -> None:
+        conn = HttpConnection(host, port)
+        worker_rnd = random.Random(seed * 1000 + worker)
+        try:
+            for index in indices:
+                await session(conn, stats, index, worker_rnd, think)
+        finally:
+            await conn.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(i) for i in range(concurrency)))
+    return stats.summary(time.perf_counter() - started)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, extra_env: Dict[str, str]) -> subprocess.Popen:
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": "sqlite:///" + os.path.join(tempfile.mkdtemp(), "loadtest.db"),
+        "BOT_TOKEN": TEST_BOT_TOKEN,
+    })
+    env.update(extra_env)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=backend_dir, env=env,
+    )
+
+
+async def wait_healthy(host: str, port: int, timeout: float = 30.0, poll: float = 0.1) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        conn = HttpConnection(host, port)
+        try:
+            status, _ = await conn.request("GET", "/health")
+            if status == 200:
+                return
+        except OSError:
+            pass
+        finally:
+            await conn.close()
+        await asyncio.sleep(poll)
+    raise RuntimeError("server did not become healthy")
+
+
+def print_summary(summary: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    print(f"{summary['requests']} requests in {summary['elapsed_s']:.1f}s: "
+          f"{summary['rps']:.0f} req/s, {summary['errors']} errors")
+    print(f"{'endpoint':<24}{'count':>8}{'err':>6}{'4xx':>6}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, row in summary["endpoints"].items():
+        line = (f"{name:<24}{row['count']:>8}{row['errors']:>6}{row['rejected']:>6}{row['rps']:>8.0f}"
+                f"{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}")
+        old = (baseline or {}).get("endpoints", {}).get(name)
+        if old and old["p95_ms"]:
+            line += f"   p95 {100 * (row['p95_ms'] - old['p95_ms']) / old['p95_ms']:+.0f}%"
+        print(line)
+    if summary.get("time_to_healthy_s") is not None:
+        line = f"time to first healthy response {summary['time_to_healthy_s']:.2f}s"
+        if (baseline or {}).get("time_to_healthy_s"):
+            line += f" ({summary['time_to_healthy_s'] - baseline['time_to_healthy_s']:+.2f}s vs baseline)"
+        print(line)
+    if baseline:
+        print(f"throughput {100 * (summary['rps'] - baseline['rps']) / baseline['rps']:+.0f}% vs baseline")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="уже запущенный сервер, например http://127.0.0.1:8000 "
+                                      "(его BOT_TOKEN должен совпадать с тестовым)")
+    parser.add_argument("--sessions", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=30)
+    parser.add_argument("--users", type=int, default=1000, help="размер пула синтетических пользователей")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="средняя пауза между действиями")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="переменная окружения для поднятого сервера")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--output", help="куда сохранить JSON (по умолчанию bench/results/)")
+    args = parser.parse_args()
+
+    server = None
+    launched = time.perf_counter()
+    if args.url:
+        parsed = urllib.parse.urlparse(args.url)
+        host, port = parsed.hostname, parsed.port or 80
+    else:
+        host, port = "127.0.0.1", free_port()
+        server = start_server(port, dict(item.split("=", 1) for item in args.env))
+    try:
+        asyncio.run(wait_healthy(host, port))
+        # Холодный старт: от запуска процесса до первого 200 на /health (только для своего сервера)
+        time_to_healthy = time.perf_counter() - launched if server is not None else None
+        summary = asyncio.run(run_load(host, port, args.sessions, args.concurrency, args.seed,
+                                       args.think_ms / 1000, args.users))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary["time_to_healthy_s"] = time_to_healthy
+    summary["config"] = {key: value for key, value in vars(args).items() if key not in ("compare", "output")}
+    summary["started_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"loadtest-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    print(f"saved {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""
+Микробенчмарки горячих функций бэкенда.
+
+Функции вызываются напрямую, без HTTP, на in-memory SQLite, засеянной
+--users пользователями с --purchases покупками у каждого. Каждый бенчмарк
+гоняется --rounds раундов по number вызовов; в отчёте медиана и минимум
+времени на вызов и изменение медианы относительно файла базовой линии.
+
+Запуск из папки backend:
+    python -m bench.micro                      # сравнение с bench/micro_baseline.json
+    python -m bench.micro -k purchases         # только бенчмарки с подстрокой в имени
+    python -m bench.micro --save-baseline      # записать новую базовую линию
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from bench.common import TEST_BOT_TOKEN, sign_init_data, synthetic_user
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "micro_baseline.json")
+
+# Общая in-memory база: поток-писатель видит те же таблицы, что и основной поток
+MEMORY_DATABASE_URL = "sqlite:///file:microbench?mode=memory&cache=shared&uri=true"
+
+# Индексы синтетических пользователей, которых нет в засеянной базе
+NEW_USERS_OFFSET = 100_000_000
+
+
+class Benchmark:
+    """
+    fn(i) вызывается с последовательными номерами вызова (синхронно или как
+    корутина); prepare(total) заранее готовит входные данные, чтобы их
+    подготовка не попадала в замер.
+    """
+
+    def __init__(self, name: str, fn: Callable[[int], Any], number: int,
+                 prepare: Optional[Callable[[int], None]] = None):
+        self.name = name
+        self.fn = fn
+        self.number = number
+        self.prepare = prepare
+
+    def run(self, loop: asyncio.AbstractEventLoop, rounds: int, warmup: int) -> Dict[str, float]:
+        if self.prepare is not None:
+            self.prepare((warmup + rounds) * self.number)
+        is_async = asyncio.iscoroutinefunction(self.fn)
+        fn = self.fn
+        counter = iter(range((warmup + rounds) * self.number))
+
+        def sync_round() -> float:
+            started = time.perf_counter()
+            for _ in range(self.number):
+                fn(next(counter))
+            return time.perf_counter() - started
+
+        async def async_round() -> float:
+            started = time.perf_counter()
+            for _ in range(self.number):
+                await fn(next(counter))
+            return time.perf_counter() - started
+
+        timings = []
+        for round_index in range(warmup + rounds):
+            elapsed = loop.run_until_complete(async_round()) if is_async else sync_round()
+            if round_index >= warmup:
+                timings.append(elapsed / self.number * 1e6)
+        return {
+            "median_us": statistics.median(timings),
+            "min_us": min(timings),
+            "stdev_us": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+            "number": self.number,
+            "rounds": rounds,
+        }
+
+
+def seed(users: int, purchases_per_user: int) -> None:
+    """Пользователи с большим балансом и история покупок; Core executemany одной транзакцией."""
+    from database import Purchase, User, engine
+
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {"tg_id": synthetic_user(i)["id"], "username": f"load_user_{i}", "first_name": f"Load{i}",
+             "balance": 1_000_000, "referrals_count": 0, "current_skin_id": 1 + i % 5,
+             "daisies_left": 2, "version": 1, "created_at": now}
+            for i in range(users)
+        ])
+        for start in range(0, users, 1000):
+            conn.execute(Purchase.__table__.insert(), [
+                {"user_id": user_id, "item_type": "skin", "item_id": 2 + k % 4, "amount": 23,
+                 "created_at": now - timedelta(minutes=k)}
+                for user_id in range(start + 1, min(start + 1000, users) + 1)
+                for k in range(purchases_per_user)
+            ])
+
+
+def build_benchmarks(users: int) -> List[Benchmark]:
+    import main
+    from database import SessionLocal, Skin, User
+    from sqlalchemy.orm import load_only
+
+    auth = main.telegram_auth
+    # Подписанный initData для существующих пользователей по кругу
+    existing = [sign_init_data(TEST_BOT_TOKEN, synthetic_user(i)) for i in range(min(users, 1000))]
+    new_users: List[str] = []
+
+    def prepare_new_users(total: int) -> None:
+        start = NEW_USERS_OFFSET + len(new_users)
+        new_users.extend(sign_init_data(TEST_BOT_TOKEN, synthetic_user(start + i)) for i in range(total))
+
+    def verify_init_data(i: int) -> None:
+        auth.verify_init_data(existing[i % len(existing)])
+
+    async def get_current_user_existing(i: int) -> None:
+        db = SessionLocal()
+        try:
+            await main.get_current_user(existing[i % len(existing)], db)
+        finally:
+            db.close()
+
+    async def get_current_user_new(i: int) -> None:
+        db = SessionLocal()
+        try:
+            await main.get_current_user(new_users[i], db)
+        finally:
+            db.close()
+
+    # UserResponse строится из уже загруженного пользователя, как в auth_user.
+    # Сессии короткие, как у запроса: в in-memory базе у потока одно соединение
+    with SessionLocal() as db:
+        response_user = db.get(User, 1)
+
+    def user_response(i: int) -> None:
+        db = SessionLocal()
+        try:
+            main.build_user_response(response_user, db,
+                                     custom_texts=main.text_cache.get(db, response_user.text_set_id))
+        finally:
+            db.close()
+
+    # Каждый вызов покупает ещё не купленный скин: пользователь i // 4, скины 2..5
+    def check_buy_capacity(total: int) -> None:
+        if total > 4 * users:
+            raise SystemExit(f"buy_skin needs {total} purchases, only {4 * users} possible; increase --users")
+
+    async def buy_skin(i: int) -> None:
+        db = SessionLocal()
+        try:
+            user = db.get(User, users - i // 4)  # С конца, чтобы не пересекаться с list_purchases
+            await main.buy_skin(main.BuySkinRequest(skin_id=2 + i % 4), user, db)
+        finally:
+            db.close()
+
+    async def list_purchases(i: int) -> None:
+        db = SessionLocal()
+        try:
+            await main.list_purchases(existing[i % len(existing)], 0, 20, db)
+        finally:
+            db.close()
+
+    # Горячие выборки: Query, собираемый на каждый вызов, против готового выражения
+    # из main.py. Сессия одна, коммит после каждого вызова освобождает блокировку
+    # разделяемого кэша для потока-писателя
+    lookup_db = SessionLocal()
+    tg_ids = [synthetic_user(i)["id"] for i in range(min(users, 1000))]
+
+    def timed_lookup(fn: Callable[[int], Any]) -> Callable[[int], None]:
+        def run(i: int) -> None:
+            fn(i)
+            lookup_db.commit()
+        return run
+
+    # Набор кастомных текстов из прогретого кэша: без SQL и без разбора JSON
+    text_set_id = main.db_writer.submit(lambda wdb: main.text_cache.intern(
+        wdb, ["любит", "не любит", "плюнет", "поцелует", "к сердцу прижмёт"])).result()
+    with SessionLocal() as db:
+        main.text_cache.get(db, text_set_id)
+
+    # Фильтр текстов на синтетическом списке из 5000 терминов
+    from blocklist import Automaton, normalize
+    rnd = random.Random(1)
+    letters = "абвгдежзиклмнопрстуфхцчшщыэюя"
+    blocked = Automaton("".join(rnd.choice(letters) for _ in range(rnd.randint(4, 9))) for _ in range(5000))
+    checked_texts = ["любит", "не любит", "плюнет", "поцелует", "к сердцу прижмёт", "к чёрту пошлёт"]
+
+    def blocklist_check(i: int) -> None:
+        blocked.find(normalize(checked_texts[i % len(checked_texts)]))
+
+    def text_set_lookup(i: int) -> None:
+        main.text_cache.get(lookup_db, text_set_id)
+
+    lookups = {
+        "user_by_tg_id[query]": lambda i: lookup_db.query(User).filter(User.tg_id == tg_ids[i % len(tg_ids)]).first(),
+        "user_by_tg_id[stmt]": lambda i: main.find_user(lookup_db, tg_ids[i % len(tg_ids)]),
+        "balance[query]": lambda i: lookup_db.query(User).options(load_only(User.balance, raiseload=True))
+                                              .filter(User.tg_id == tg_ids[i % len(tg_ids)]).first(),
+        "balance[stmt]": lambda i: main.find_user(lookup_db, tg_ids[i % len(tg_ids)], (User.balance,)),
+        "skin_by_id[query]": lambda i: lookup_db.query(Skin.price, Skin.is_default)
+                                                 .filter(Skin.id == 1 + i % 5).first(),
+        "skin_by_id[stmt]": lambda i: lookup_db.execute(main._SKIN_PRICE, {"skin_id": 1 + i % 5,
+                                                                             "now": datetime.utcnow()}).first(),
+    }
+
+    return [
+        *(Benchmark(name, timed_lookup(fn), number=2000) for name, fn in lookups.items()),
+        Benchmark("verify_init_data", verify_init_data, number=2000),
+        Benchmark("text_set_lookup", text_set_lookup, number=20000),
+        Benchmark("blocklist_check", blocklist_check, number=20000),
+        Benchmark("get_current_user[existing]", get_current_user_existing, number=500),
+        Benchmark("get_current_user[new]", get_current_user_new, number=100, prepare=prepare_new_users),
+        Benchmark("user_response", user_response, number=1000),
+        Benchmark("buy_skin", buy_skin, number=100, prepare=check_buy_capacity),
+        Benchmark("list_purchases", list_purchases, number=200),
+    ]
+
+
+def print_report(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Any]],
+                 threshold: float) -> int:
+    """Печатает таблицу и возвращает число регрессий больше threshold процентов."""
+    regressions = 0
+    print(f"{'benchmark':<30}{'median us':>12}{'min us':>12}{'stdev us':>12}{'ops/s':>12}")
+    for name, row in results.items():
+        line = (f"{name:<30}{row['median_us']:>12.1f}{row['min_us']:>12.1f}{row['stdev_us']:>12.1f}"
+                f"{1e6 / row['median_us']:>12.0f}")
+        old = (baseline or {}).get("benchmarks", {}).get(name)
+        if old:
+            change = 100 * (row["median_us"] - old["median_us"]) / old["median_us"]
+            line += f"   {change:+.1f}%"
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000, help="пользователей в засеянной базе")
+    parser.add_argument("--purchases", type=int, default=20, help="покупок у каждого пользователя")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--warmup", type=int, default=1, help="раундов прогрева без замера")
+    parser.add_argument("-k", dest="filter", help="только бенчмарки с этой подстрокой в имени")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="файл базовой линии")
+    parser.add_argument("--save-baseline", action="store_true", help="перезаписать базовую линию результатами")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="замедление медианы в процентах, которое считается регрессией")
+    parser.add_argument("--check", action="store_true", help="код выхода 1 при регрессиях")
+    args = parser.parse_args()
+
+    # До импорта database/main: движок создаётся при импорте
+    os.environ["DATABASE_URL"] = MEMORY_DATABASE_URL
+    os.environ["BOT_TOKEN"] = TEST_BOT_TOKEN
+    os.environ["DAISIES_WRITE_BEHIND"] = "1"
+    from database import create_tables, init_default_skins, migrate_schema
+    import main as app_main
+
+    create_tables()
+    migrate_schema()
+    init_default_skins()
+    started = time.perf_counter()
+    seed(args.users, args.purchases)
+    print(f"seeded {args.users} users, {args.users * args.purchases} purchases "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    loop = asyncio.new_event_loop()
+    results: Dict[str, Dict[str, float]] = {}
+    try:
+        for bench in build_benchmarks(args.users):
+            if args.filter and args.filter not in bench.name:
+                continue
+            results[bench.name] = bench.run(loop, args.rounds, args.warmup)
+    finally:
+        app_main.db_writer.stop()
+        loop.close()
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config", {}).get("users") != args.users:
+            print(f"warning: baseline was seeded with {baseline['config'].get('users')} users")
+    regressions = print_report(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "config": {"users": args.users, "purchases": args.purchases, "rounds": args.rounds},
+                "python": sys.version.split()[0],
+                "benchmarks": results,
+            }, f, indent=2)
+        print(f"saved {args.baseline}")
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Просмотр каталога магазина на большом каталоге и больших инвентарях.
+
+Одна и та же последовательность запросов (случайные категория, диапазон
+цен, фильтр owned и сортировка, 1-3 страницы по курсору) выполняется тремя
+способами:
+    scan  - как старый /api/skins: все скины и весь инвентарь на каждый
+            запрос, фильтр и сортировка в Python;
+    sql   - WHERE/ORDER BY/LIMIT с keyset-курсором и EXISTS по user_skins;
+    index - shop_catalog.browse по индексу в памяти.
+Страницы всех способов сверяются, в отчёте запросы в секунду и перцентили.
+
+Запуск из папки backend:
+    python -m bench.shop_catalog [--skins 10000] [--users 200] [--inventory 3000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# База для бенчмарка - временный файл, а не daisy_game.db
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+
+from sqlalchemy import and_, exists, func, or_, select, tuple_  # noqa: E402
+
+from bench.common import percentile  # noqa: E402
+from database import SessionLocal, Skin, User, UserSkin, create_tables, engine, migrate_schema  # noqa: E402
+import shop_catalog  # noqa: E402
+from shop_catalog import SORTS, CatalogSkin  # noqa: E402
+
+CATEGORIES = ["classic", "neon", "pastel", "metal", "gem", "space", "sea", "forest",
+              "candy", "retro", "holiday", "legend"]
+
+SQL_KEYS = {
+    "id": (Skin.id,),
+    "price_asc": (Skin.price, Skin.id),
+    "price_desc": (-Skin.price, Skin.id),
+    "newest": (-Skin.id,),
+    "name": (func.lower(Skin.name), Skin.id),
+}
+
+Page = Tuple[List[int], Optional[str]]
+
+
+def seed(skins: int, users: int, inventory: int, rnd: random.Random) -> None:
+    with engine.begin() as conn:
+        conn.execute(Skin.__table__.insert(), [
+            {"name": f"skin {rnd.randrange(10 ** 6):06d}", "price": rnd.randint(0, 1000), "color": "#FFFFFF",
+             "is_default": i < 3, "category": rnd.choice(CATEGORIES)}
+            for i in range(skins)
+        ])
+        conn.execute(User.__table__.insert(), [{"tg_id": i, "balance": 0, "version": 1} for i in range(users)])
+        for user_id in range(1, users + 1):
+            conn.execute(UserSkin.__table__.insert(), [
+                {"user_id": user_id, "skin_id": skin_id}
+                for skin_id in rnd.sample(range(1, skins + 1), min(inventory, skins))
+            ])
+
+
+def random_query(rnd: random.Random, users: int) -> Dict[str, Any]:
+    low = rnd.choice([None, rnd.randint(0, 800)])
+    return {
+        "user_id": rnd.randint(1, users),
+        "category": rnd.choice([None, *CATEGORIES]),
+        "sort": rnd.choice(list(SORTS)),
+        "min_price": low,
+        "max_price": rnd.choice([None, (low or 0) + rnd.randint(50, 400)]),
+        "owned": rnd.choice([None, True, False]),
+        "limit": 50,
+        "pages": rnd.randint(1, 3),
+    }
+
+
+def matches(skin: CatalogSkin, q: Dict[str, Any], owned_ids) -> bool:
+    return ((q["category"] is None or skin.category == q["category"])
+            and (q["min_price"] is None or skin.price >= q["min_price"])
+            and (q["max_price"] is None or skin.price <= q["max_price"])
+            and (q["owned"] is None or (skin.id in owned_ids or skin.is_default) == q["owned"]))
+
+
+def scan_page(db, q: Dict[str, Any], cursor: Optional[str]) -> Page:
+    skins = [CatalogSkin(*row) for row in db.execute(shop_catalog._ALL_SKINS)]
+    owned_ids = shop_catalog.owned_skin_ids(db, q["user_id"])
+    key = SORTS[q["sort"]]
+    after = shop_catalog.decode_cursor(cursor, q["sort"]) if cursor else None
+    found = sorted((skin for skin in skins if matches(skin, q, owned_ids) and (after is None or key(skin) > after)),
+                   key=key)
+    page = found[:q["limit"]]
+    more = len(found) > q["limit"]
+    return [skin.id for skin in page], shop_catalog.encode_cursor(q["sort"], key(page[-1])) if more else None
+
+
+def sql_page(db, q: Dict[str, Any], cursor: Optional[str]) -> Page:
+    keys = SQL_KEYS[q["sort"]]
+    stmt = select(Skin.id, Skin.name, Skin.price, Skin.color, Skin.is_default, Skin.category)
+    if q["category"] is not None:
+        stmt = stmt.where(Skin.category == q["category"])
+    if q["min_price"] is not None:
+        stmt = stmt.where(Skin.price >= q["min_price"])
+    if q["max_price"] is not None:
+        stmt = stmt.where(Skin.price <= q["max_price"])
+    if q["owned"] is not None:
+        owned = or_(Skin.is_default, exists().where(and_(UserSkin.user_id == q["user_id"], UserSkin.skin_id == Skin.id)))
+        stmt = stmt.where(owned if q["owned"] else ~owned)
+    if cursor:
+        stmt = stmt.where(tuple_(*keys) > tuple_(*shop_catalog.decode_cursor(cursor, q["sort"])))
+    rows = db.execute(stmt.order_by(*keys).limit(q["limit"] + 1)).all()
+    page = [CatalogSkin(*row) for row in rows[:q["limit"]]]
+    shop_catalog.owned_skin_ids(db, q["user_id"], [skin.id for skin in page])  # Флаги, как у index
+    more = len(rows) > q["limit"]
+    return [skin.id for skin in page], shop_catalog.encode_cursor(q["sort"], SORTS[q["sort"]](page[-1])) if more else None
+
+
+def index_page(catalog: shop_catalog.ShopCatalog) -> Callable[[Any, Dict[str, Any], Optional[str]], Page]:
+    def run(db, q: Dict[str, Any], cursor: Optional[str]) -> Page:
+        items, next_cursor = shop_catalog.browse(
+            db, catalog.get(db), q["user_id"], category=q["category"], sort=q["sort"], min_price=q["min_price"],
+            max_price=q["max_price"], owned=q["owned"], cursor=cursor, limit=q["limit"])
+        return [skin.id for skin, _ in items], next_cursor
+    return run
+
+
+def run(mode: str, fn, queries: List[Dict[str, Any]]) -> List[List[int]]:
+    timings: List[float] = []
+    pages: List[List[int]] = []
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        for q in queries:
+            cursor = None
+            for _ in range(q["pages"]):
+                t0 = time.perf_counter()
+                ids, cursor = fn(db, q, cursor)
+                db.commit()
+                timings.append(time.perf_counter() - t0)
+                pages.append(ids)
+                if cursor is None:
+                    break
+        elapsed = time.perf_counter() - started
+    finally:
+        db.close()
+    timings.sort()
+    print(f"{mode:>6}: {len(timings) / elapsed:8.0f} pages/s  p50 {percentile(timings, 0.5) * 1e3:7.2f} ms  "
+          f"p99 {percentile(timings, 0.99) * 1e3:7.2f} ms  max {timings[-1] * 1e3:7.2f} ms")
+    return pages
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--skins", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--inventory", type=int, default=3000, help="скинов в инвентаре каждого пользователя")
+    parser.add_argument("--queries", type=int, default=300, help="последовательностей запросов на способ")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-scan", action="store_true", help="не гонять самый медленный способ")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    create_tables()
+    migrate_schema()
+    started = time.perf_counter()
+    seed(args.skins, args.users, args.inventory, rnd)
+    print(f"seeded {args.skins} skins, {args.users} users x {args.inventory} owned "
+          f"in {time.perf_counter() - started:.1f}s")
+
+    queries = [random_query(rnd, args.users) for _ in range(args.queries)]
+    catalog = shop_catalog.ShopCatalog(check_interval=5.0)
+    with SessionLocal() as db:
+        started = time.perf_counter()
+        catalog.get(db)
+        print(f"index built in {(time.perf_counter() - started) * 1e3:.1f} ms (orderings are built on first use)")
+
+    results = {}
+    if not args.skip_scan:
+        results["scan"] = run("scan", scan_page, queries)
+    results["sql"] = run("sql", sql_page, queries)
+    results["index"] = run("index", index_page(catalog), queries)
+    reference = results["sql"]
+    for mode, pages in results.items():
+        if pages != reference:
+            raise SystemExit(f"{mode} pages differ from sql")
+    print(f"{len(reference)} pages identical across {', '.join(results)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Время холодного и тёплого старта: от запуска uvicorn до первого 200 на /health.
+
+    cold - пустая база: create_all, миграции, начальные скины, картинки;
+    warm - база уже создана предыдущим запуском (обычный рестарт/деплой).
+
+Каждый режим запускается --repeat раз, печатаются медиана, минимум и
+максимум. Если сервер отдаёт /api/debug/startup (startup_timing), к ним
+добавляются медианы фаз старта и время до первого ответа внутри процесса.
+
+--backend - папка другого backend, например git worktree с базовым
+коммитом: так сравниваются два дерева на одной машине.
+
+Запуск из папки backend:
+    python -m bench.startup [--repeat 7]
+    git worktree add /tmp/base <commit> && python -m bench.startup --backend /tmp/base/backend
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from bench.common import TEST_BOT_TOKEN
+from bench.loadtest import HttpConnection, free_port, wait_healthy
+
+ADMIN_TOKEN = "startup-bench-token"
+
+
+async def startup_report(port: int) -> Optional[Dict[str, Any]]:
+    conn = HttpConnection("127.0.0.1", port)
+    try:
+        status, body = await conn.request("GET", "/api/debug/startup", headers={"X-Admin-Token": ADMIN_TOKEN})
+    finally:
+        await conn.close()
+    return json.loads(body) if status == 200 else None
+
+
+def start_once(backend_dir: str, database: str) -> Dict[str, Any]:
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": "sqlite:///" + database,
+        "BOT_TOKEN": TEST_BOT_TOKEN,
+        "ADMIN_TOKEN": ADMIN_TOKEN,
+        # Картинки скинов - в папку рядом с базой, а не в static/ дерева
+        "SKIN_ASSET_DIR": os.path.join(os.path.dirname(database), "skins"),
+    })
+    launched = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=backend_dir, env=env,
+    )
+    try:
+        asyncio.run(wait_healthy("127.0.0.1", port, poll=0.01))
+        healthy = time.perf_counter() - launched
+        report = asyncio.run(startup_report(port))
+    finally:
+        server.terminate()
+        server.wait()
+    return {"time_to_healthy_s": healthy, "report": report}
+
+
+def summarize(mode: str, runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    times = sorted(run["time_to_healthy_s"] for run in runs)
+    summary: Dict[str, Any] = {
+        "median_s": statistics.median(times), "min_s": times[0], "max_s": times[-1], "runs": len(times),
+    }
+    line = (f"{mode:>5}: time to healthy median {summary['median_s']:.2f}s  "
+            f"min {summary['min_s']:.2f}s  max {summary['max_s']:.2f}s")
+    reports = [run["report"] for run in runs if run["report"]]
+    if reports:
+        phases = {name: statistics.median(r["phases_ms"].get(name, 0.0) for r in reports)
+                  for name in reports[0]["phases_ms"]}
+        summary["in_process_ms"] = statistics.median(r["time_to_first_response_ms"] for r in reports)
+        summary["phases_ms"] = phases
+        line += f"  in-process {summary['in_process_ms']:.0f} ms  phases " + ", ".join(
+            f"{name} {ms:.0f}" for name, ms in phases.items())
+    print(line)
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        help="папка backend, который запускать")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="куда сохранить JSON")
+    args = parser.parse_args()
+
+    cold: List[Dict[str, Any]] = []
+    warm: List[Dict[str, Any]] = []
+    for _ in range(args.repeat):
+        database = os.path.join(tempfile.mkdtemp(), "startup.db")
+        cold.append(start_once(args.backend, database))
+        warm.append(start_once(args.backend, database))
+    print(f"{args.backend}, {args.repeat} runs per mode")
+    result = {"backend": args.backend, "cold": summarize("cold", cold), "warm": summarize("warm", warm)}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Нагрузочный тест со смешанной конкуренцией для блокировок по пользователю.
+
+Каждый запрос - read-modify-write счётчика пользователя с ожиданием внутри
+(как ожидание писателя БД в обработчике). Часть запросов бьёт в несколько
+"горячих" пользователей, остальные распределены по многим. Сравниваются:
+без блокировок (потерянные обновления), одна глобальная блокировка и
+StripedLocks.
+
+Запуск из папки backend: python -m bench.user_locks [--requests 20000]
+"""
+import argparse
+import asyncio
+import contextlib
+import random
+import statistics
+import time
+
+from user_locks import StripedLocks
+
+
+async def run(mode: str, args) -> None:
+    rnd = random.Random(args.seed)
+    keys = [
+        rnd.randrange(args.hot_users) if rnd.random() < args.hot_share
+        else args.hot_users + rnd.randrange(args.users)
+        for _ in range(args.requests)
+    ]
+    counters = {}
+    expected = {}
+    for key in keys:
+        expected[key] = expected.get(key, 0) + 1
+
+    striped = StripedLocks()
+    global_lock = asyncio.Lock()
+
+    def lock_for(key):
+        if mode == "striped":
+            return striped.for_key(key)
+        if mode == "global":
+            return global_lock
+        return contextlib.nullcontext()
+
+    latencies = []
+    queue = iter(keys)
+
+    async def client() -> None:
+        for key in queue:
+            started = time.perf_counter()
+            async with lock_for(key):
+                value = counters.get(key, 0)
+                await asyncio.sleep(args.service_ms / 1000)
+                counters[key] = value + 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    lost = sum(expected[key] - counters.get(key, 0) for key in expected)
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95)]
+    print(f"{mode:>8}: {len(keys) / elapsed:8.0f} req/s  p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+          f"p95 {p95 * 1000:7.1f} ms  lost updates {lost}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--hot-users", type=int, default=10)
+    parser.add_argument("--hot-share", type=float, default=0.2, help="доля запросов к горячим пользователям")
+    parser.add_argument("--service-ms", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for mode in ("none", "global", "striped"):
+        asyncio.run(run(mode, args))
+
+
+if __name__ == "__main__":
+    main()
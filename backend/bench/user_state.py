@@ -0,0 +1,107 @@
+"""
+Записи в users на раунд игры: запись сразу против отложенной записи
+UserStateCache, плюс проверка поведения при аварийном завершении.
+
+Раунд - GET /api/daisies и POST /api/daisies с новым значением.
+
+Запуск из папки backend: python -m bench.user_state [--users 200] [--rounds 50]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+
+from sqlalchemy import event, select  # noqa: E402
+
+from database import SessionLocal, User, create_tables, engine, migrate_schema  # noqa: E402
+from user_state import UserStateCache  # noqa: E402
+from write_queue import WriteQueue  # noqa: E402
+
+
+class Counter:
+    def __init__(self):
+        self.updates = 0
+        self.commits = 0
+
+    def install(self):
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("UPDATE users"):
+            self.updates += len(parameters) if executemany else 1
+
+    def _on_commit(self, conn):
+        self.commits += 1
+
+
+def load_users(count: int):
+    db = SessionLocal()
+    try:
+        return db.scalars(select(User).order_by(User.id).limit(count)).all()
+    finally:
+        db.close()
+
+
+async def play(cache: UserStateCache, users, rounds: int) -> None:
+    for _ in range(rounds):
+        for user in users:
+            value = cache.get_daisies(user)
+            await cache.set_daisies(user.id, value + 1)
+
+
+async def measure(write_behind: bool, users, rounds: int, counter: Counter) -> None:
+    writer = WriteQueue()
+    cache = UserStateCache(writer, write_behind=write_behind, flush_interval=1.0)
+    cache.start()
+    counter.updates = counter.commits = 0
+    await play(cache, users, rounds)
+    await cache.stop()
+    writer.stop()
+    total = len(users) * rounds
+    mode = "write-behind" if write_behind else "write-through"
+    print(f"{mode:>14}: {counter.updates / total:.3f} row updates/round, "
+          f"{counter.commits / total:.4f} commits/round")
+
+
+async def crash_check(users) -> None:
+    """Аварийное завершение: в БД остаются ровно значения последнего сброса."""
+    writer = WriteQueue()
+    cache = UserStateCache(writer, write_behind=True, flush_interval=3600)
+    for user in users:
+        await cache.set_daisies(user.id, 1000 + user.id)
+    await cache.flush()
+    for user in users:
+        await cache.set_daisies(user.id, 5000 + user.id)
+    # "Падение": кэш брошен без stop(), несброшенные значения теряются
+    writer.stop()
+    stored = {user.id: user.daisies_left for user in load_users(len(users))}
+    assert stored == {user.id: 1000 + user.id for user in users}, "partial or lost flush"
+    print("crash check: unflushed changes lost, last flush intact")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    create_tables()
+    migrate_schema()
+    db = SessionLocal()
+    db.add_all([User(tg_id=i, balance=0, daisies_left=2) for i in range(1, args.users + 1)])
+    db.commit()
+    db.close()
+    users = load_users(args.users)
+
+    counter = Counter()
+    counter.install()
+    asyncio.run(measure(False, users, args.rounds, counter))
+    asyncio.run(measure(True, users, args.rounds, counter))
+    asyncio.run(crash_check(users))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Сравнение записей в секунду: коммит на каждый запрос против группового
+коммита через WriteQueue.
+
+Запуск из папки backend: python -m bench.write_queue [--threads 16] [--writes 200]
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+# База для бенчмарка - временный файл, а не daisy_game.db
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+
+from sqlalchemy import event  # noqa: E402
+
+from database import SessionLocal, User, Result, create_tables, engine, migrate_schema  # noqa: E402
+from write_queue import WriteQueue  # noqa: E402
+
+USERS = 100
+
+
+def unit(db, user_id: int) -> None:
+    """Типичная мутация обработчика: строка результата + обновление пользователя."""
+    db.add(Result(user_id=user_id, result_text="любит"))
+    user = db.get(User, user_id)
+    user.daisies_left = (user.daisies_left or 0) + 1
+
+
+def per_request_commit(user_id: int) -> None:
+    db = SessionLocal()
+    try:
+        unit(db, user_id)
+        db.commit()
+    finally:
+        db.close()
+
+
+def run(mode: str, threads: int, writes: int, commits: list) -> None:
+    writer = WriteQueue() if mode == "queue" else None
+    errors = []
+    barrier = threading.Barrier(threads)
+
+    def worker(seed: int) -> None:
+        rnd = random.Random(seed)
+        barrier.wait()
+        for _ in range(writes):
+            user_id = rnd.randint(1, USERS)
+            try:
+                if writer is not None:
+                    writer.submit(lambda db: unit(db, user_id)).result()
+                else:
+                    per_request_commit(user_id)
+            except Exception as exc:
+                errors.append(exc)
+
+    commits.clear()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    if writer is not None:
+        writer.stop()
+
+    ok = threads * writes - len(errors)
+    print(f"{mode:>18}: {ok / elapsed:9.0f} writes/s  {len(commits):6d} commits  "
+          f"{ok / max(len(commits), 1):5.1f} writes/commit  {len(errors)} errors"
+          + (f" ({str(errors[0]).splitlines()[0]})" if errors else ""))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--writes", type=int, default=200, help="записей на поток")
+    args = parser.parse_args()
+
+    create_tables()
+    migrate_schema()
+    db = SessionLocal()
+    db.add_all([User(tg_id=i, balance=0) for i in range(1, USERS + 1)])
+    db.commit()
+    db.close()
+
+    commits = []
+    event.listen(engine, "commit", lambda conn: commits.append(1))
+    print(f"{args.threads} threads x {args.writes} writes, {engine.url}")
+    run("per-request commit", args.threads, args.writes, commits)
+    run("queue", args.threads, args.writes, commits)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Фильтр запрещённых слов для кастомных текстов.
+
+Термины читаются из BLOCKLIST_FILE (по одному в строке, # - комментарий)
+и компилируются в автомат Ахо-Корасик: текст проверяется за один проход
+по символам независимо от числа терминов.
+
+Текст и термины проходят одну нормализацию: NFKC, casefold, латинские и
+цифровые двойники кириллицы (a, o, 0, 3, @ ...) заменяются на кириллицу,
+ё -> е, й -> и. Слова делятся пробелами; внутри слова всё, кроме букв,
+выбрасывается, повторы одной буквы схлопываются. Так "Х.У-Й", "xуй" и "хууй"
+совпадают с одним термином, а "их уйти" - нет.
+
+Термин совпадает с целым словом (или несколькими словами подряд); * с края
+разрешает продолжение слова в эту сторону: "бля*" - слова, начинающиеся с
+"бля", "*хуй*" - слова, содержащие "хуй". "Оскорбля" не совпадает ни с "бля",
+ни с "бля*". В автомате это пробелы по краям: текст нормализуется в
+" слово слово ", термин "бля*" - в " бля".
+
+Blocklist.reload() перечитывает файл и подменяет автомат целиком, так что
+проверки во время перезагрузки видят либо старый, либо новый. check() сам
+сверяет mtime файла не чаще раза в BLOCKLIST_CHECK_INTERVAL секунд: так
+новый список подхватывают все воркеры, а не только тот, что ответил на
+POST /api/debug/blocklist/reload. После обновления списка rescan()
+проходит text_sets чанками по id и возвращает наборы, которые теперь
+запрещены.
+
+Отдельно: python blocklist.py [--chunk-size N] - отчёт по сохранённым наборам;
+python blocklist.py --text "..." [--text ...] - проверка фраз по списку.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import unicodedata
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+BLOCKLIST_FILE = os.getenv("BLOCKLIST_FILE", "blocklist.txt")
+BLOCKLIST_CHECK_INTERVAL = float(os.getenv("BLOCKLIST_CHECK_INTERVAL", "5"))
+
+# Латинские буквы и цифры, похожие на кириллические, и варианты самой кириллицы
+_HOMOGLYPHS = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м", "o": "о",
+    "p": "р", "t": "т", "x": "х", "y": "у", "u": "и", "r": "г", "n": "п",
+    "0": "о", "3": "з", "4": "ч", "6": "б", "@": "а", "$": "с",
+    "ё": "е", "й": "и", "ъ": "ь",
+})
+
+
+WILDCARD = "*"
+
+
+def _letters(word: str) -> str:
+    out: List[str] = []
+    for char in word:
+        if char.isalpha() and (not out or out[-1] != char):
+            out.append(char)
+    return "".join(out)
+
+
+def normalize(text: str) -> str:
+    """Слова текста через пробел и с пробелами по краям; "" - если слов нет."""
+    text = unicodedata.normalize("NFKC", text).casefold().translate(_HOMOGLYPHS)
+    words = [word for word in map(_letters, text.split()) if word]
+    return f" {' '.join(words)} " if words else ""
+
+
+def pattern(term: str) -> str:
+    """Термин в виде подстроки нормализованного текста: пробел с края без *."""
+    words = normalize(term.strip(WILDCARD)).strip()
+    if not words:
+        return ""
+    start = "" if term.startswith(WILDCARD) else " "
+    end = "" if term.endswith(WILDCARD) else " "
+    return start + words + end
+
+
+class Automaton:
+    """
+    Ахо-Корасик над нормализованными терминами. goto - переходы бора
+    (словарь на узел), fail - суффиксные ссылки, outputs[node] - длина
+    термина, оканчивающегося в узле или в его суффиксе (0 - ни одного).
+    """
+
+    def __init__(self, terms: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.outputs: List[int] = [0]
+        self.size = 0
+        for term in terms:
+            term = pattern(term)
+            if term:
+                self._add(term)
+        self.fail = self._link()
+
+    def _add(self, term: str) -> None:
+        node = 0
+        for char in term:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.outputs.append(0)
+            node = nxt
+        if not self.outputs[node]:
+            self.size += 1
+        self.outputs[node] = len(term)
+
+    def _link(self) -> List[int]:
+        goto, outputs = self.goto, self.outputs
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in goto[node].items():
+                queue.append(nxt)
+                link = fail[node]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                fail[nxt] = goto[link].get(char, 0)
+                if not outputs[nxt]:
+                    outputs[nxt] = outputs[fail[nxt]]
+        return fail
+
+    def find(self, text: str) -> Optional[str]:
+        """Первый найденный термин в уже нормализованном тексте или None."""
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        for i, char in enumerate(text):
+            nxt = goto[node].get(char)
+            while nxt is None and node:
+                node = fail[node]
+                nxt = goto[node].get(char)
+            node = nxt or 0
+            if outputs[node]:
+                return text[i + 1 - outputs[node]:i + 1].strip()
+        return None
+
+
+def read_terms(path: str) -> List[str]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    except FileNotFoundError:
+        return []
+
+
+class Blocklist:
+    def __init__(self, path: str = BLOCKLIST_FILE, check_interval: float = BLOCKLIST_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.automaton = Automaton(())
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+
+    def reload(self, force: bool = False) -> bool:
+        """Перечитывает файл, если он изменился; True - автомат заменён."""
+        self._checked_at = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if not force and mtime == self._mtime:
+            return False
+        self.automaton = Automaton(read_terms(self.path))
+        self._mtime = mtime
+        return True
+
+    def find(self, text: str) -> Optional[str]:
+        return self.automaton.find(normalize(text))
+
+    def check(self, texts: Sequence[str]) -> Optional[str]:
+        """Первый запрещённый термин в любом из текстов или None."""
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            self.reload()  # Один stat в интервал; список, изменённый в другом воркере
+        automaton = self.automaton
+        for text in texts:
+            term = automaton.find(normalize(text))
+            if term is not None:
+                return term
+        return None
+
+    def rescan(self, chunk_size: int = 1000) -> Iterator[Tuple[int, str]]:
+        """
+        (id набора, термин) для каждого запрещённого набора в text_sets.
+        Каждый чанк читается одним запросом на отдельном соединении.
+        """
+        from sqlalchemy import select
+
+        from database import TextSet, engine
+
+        automaton = self.automaton
+        last_id = 0
+        while True:
+            with engine.connect() as conn:
+                rows = conn.execute(
+                    select(TextSet.id, TextSet.texts).where(TextSet.id > last_id).order_by(TextSet.id).limit(chunk_size)
+                ).all()
+            if not rows:
+                return
+            for set_id, raw in rows:
+                for text in json.loads(raw):
+                    term = automaton.find(normalize(text))
+                    if term is not None:
+                        yield set_id, term
+                        break
+            last_id = rows[-1][0]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Проверка сохранённых наборов текстов по BLOCKLIST_FILE")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--text", action="append", help="проверить фразу вместо сохранённых наборов")
+    args = parser.parse_args(argv)
+
+    blocklist = Blocklist()
+    blocklist.reload()
+    print(f"{blocklist.automaton.size} terms from {blocklist.path}")
+    if args.text:
+        blocked = 0
+        for text in args.text:
+            term = blocklist.find(text)
+            blocked += term is not None
+            print(f"{text!r}: {term or 'ok'}")
+        return 1 if blocked else 0
+    flagged = 0
+    for set_id, term in blocklist.rescan(args.chunk_size):
+        flagged += 1
+        print(f"text set {set_id}: {term}")
+    print(f"{flagged} text sets blocked")
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,49 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, BigInteger, text
+from sqlalchemy import create_engine, event, Column, Integer, String, Boolean, DateTime, ForeignKey, BigInteger, Index, UniqueConstraint, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
+from typing import Optional
+import hashlib
+import json
 import os
 
 # Database URL
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./daisy_game.db")
 
 # Create engine
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if "sqlite" in DATABASE_URL:
+    # Соединение SQLite - просто файловый дескриптор; лимит пула только
+    # заблокировал бы event loop на синхронном checkout. In-memory база
+    # (бенчмарки) живёт на SingletonThreadPool, у которого overflow нет.
+    in_memory = DATABASE_URL in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in DATABASE_URL
+    pool_args = {} if in_memory else {"max_overflow": -1}
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, **pool_args)
+else:
+    engine = create_engine(DATABASE_URL)
+# expire_on_commit=False: запрос завершает читающую транзакцию перед await (см. run_write
+# в main.py), а загруженные объекты остаются пригодными
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+if "sqlite" in DATABASE_URL:
+    @event.listens_for(engine, "connect")
+    def _sqlite_connect(dbapi_connection, connection_record):
+        # Транзакциями управляет SQLAlchemy, а не pysqlite - иначе не работают SAVEPOINT
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")  # Читатели не блокируют писателя
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _sqlite_begin(conn):
+        # Писатель берёт блокировку сразу (BEGIN IMMEDIATE), см. write_queue.py
+        conn.exec_driver_sql(conn.get_execution_options().get("sqlite_begin", "BEGIN"))
 
 Base = declarative_base()
 
+# Все связи lazy="raise": неявная подгрузка - ошибка, а не скрытый SELECT.
+# Нужные связи маршрут загружает явно (joinedload/selectinload) или запрашивает колонки.
+
 # Database Models
 class User(Base):
     __tablename__ = "users"
@@ -25,16 +56,36 @@ class User(Base):
     balance = Column(Integer, default=0)  # Листики
     referrals_count = Column(Integer, default=0)
     current_skin_id = Column(Integer, default=1)  # ID текущего скина
-    custom_texts = Column(String, nullable=True)  # JSON с кастомными текстами
+    text_set_id = Column(Integer, ForeignKey("text_sets.id"), nullable=True)  # Кастомные тексты; NULL - дефолтные
     daisies_left = Column(Integer, default=2)  # Остаток ромашек
     texts_preset_key = Column(String, nullable=True)  # Ключ выбранного пресета
+    version = Column(Integer, nullable=False, default=1)  # Оптимистическая блокировка, основа ETag
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    __mapper_args__ = {"version_id_col": version}
+    
     # Relationships
-    referrals = relationship("Referral", foreign_keys="Referral.inviter_id", back_populates="inviter")
-    invited_by = relationship("Referral", foreign_keys="Referral.invited_id", back_populates="invited")
-    user_skins = relationship("UserSkin", back_populates="user")
-    purchases = relationship("Purchase", back_populates="user")
+    referrals = relationship("Referral", foreign_keys="Referral.inviter_id", back_populates="inviter", lazy="raise")
+    invited_by = relationship("Referral", foreign_keys="Referral.invited_id", back_populates="invited", lazy="raise")
+    user_skins = relationship("UserSkin", back_populates="user", lazy="raise")
+    purchases = relationship("Purchase", back_populates="user", lazy="raise")
+
+class TextSet(Base):
+    """Набор кастомных текстов; одинаковые наборы хранятся один раз (по хэшу содержимого)."""
+    __tablename__ = "text_sets"
+    
+    id = Column(Integer, primary_key=True)
+    digest = Column(String, nullable=False, unique=True)  # sha256 от канонического JSON
+    texts = Column(String, nullable=False)  # JSON-массив строк
+
+DEFAULT_TEXTS = ("любит", "не любит")
+
+def text_set_json(texts) -> str:
+    """Канонический JSON набора: по нему считается digest и он же хранится в text_sets.texts."""
+    return json.dumps(list(texts), ensure_ascii=False, separators=(",", ":"))
+
+def text_set_digest(texts) -> str:
+    return hashlib.sha256(text_set_json(texts).encode()).hexdigest()
 
 class Referral(Base):
     __tablename__ = "referrals"
@@ -46,8 +97,8 @@ class Referral(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
-    inviter = relationship("User", foreign_keys=[inviter_id], back_populates="referrals")
-    invited = relationship("User", foreign_keys=[invited_id], back_populates="invited_by")
+    inviter = relationship("User", foreign_keys=[inviter_id], back_populates="referrals", lazy="raise")
+    invited = relationship("User", foreign_keys=[invited_id], back_populates="invited_by", lazy="raise")
 
 class Skin(Base):
     __tablename__ = "skins"
@@ -58,10 +109,18 @@ class Skin(Base):
     image_url = Column(String, nullable=True)
     color = Column(String, nullable=True)  # Цвет ромашки
     is_default = Column(Boolean, default=False)
+    category = Column(String, nullable=False, default="classic")  # Раздел магазина
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
-    user_skins = relationship("UserSkin", back_populates="skin")
+    user_skins = relationship("UserSkin", back_populates="skin", lazy="raise")
+
+class CatalogState(Base):
+    """Одна строка (id = 1): version растёт при любом изменении skins (триггеры в migrate_schema)."""
+    __tablename__ = "catalog_state"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
 
 class UserSkin(Base):
     __tablename__ = "user_skins"
@@ -70,24 +129,38 @@ class UserSkin(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     skin_id = Column(Integer, ForeignKey("skins.id"))
     purchased_at = Column(DateTime, default=datetime.utcnow)
+
+    # Инвентарь пользователя и проверка владения - только по индексу. Уникальный:
+    # скин выдаётся один раз даже при покупках из разных процессов (см. grant_skin)
+    __table_args__ = (Index("ux_user_skins_user_id_skin_id", "user_id", "skin_id", unique=True),)
     
     # Relationships
-    user = relationship("User", back_populates="user_skins")
-    skin = relationship("Skin", back_populates="user_skins")
+    user = relationship("User", back_populates="user_skins", lazy="raise")
+    skin = relationship("Skin", back_populates="user_skins", lazy="raise")
+
+def grant_skin(db, user_id: int, skin_id: int) -> bool:
+    """Скин в инвентарь в SAVEPOINT; False - уже есть (уникальный индекс, в том числе между воркерами)."""
+    try:
+        with db.begin_nested():
+            db.execute(UserSkin.__table__.insert(), {"user_id": user_id, "skin_id": skin_id,
+                                                     "purchased_at": datetime.utcnow()})
+    except IntegrityError:
+        return False
+    return True
 
 class Purchase(Base):
     __tablename__ = "purchases"
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
-    item_type = Column(String, nullable=False)  # "skin", "balance", "referral_bonus"
+    item_type = Column(String, nullable=False)  # "skin", "balance", "referral_bonus", "promo"
     item_id = Column(Integer, nullable=True)  # ID скина или null для баланса
     amount = Column(Integer, nullable=False)  # Сумма в листиках
     payment_id = Column(String, nullable=True)  # ID платежа Telegram
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
-    user = relationship("User", back_populates="purchases")
+    user = relationship("User", back_populates="purchases", lazy="raise")
 
 class Result(Base):
     __tablename__ = "results"
@@ -97,7 +170,83 @@ class Result(Base):
     result_text = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    user = relationship("User")
+    user = relationship("User", lazy="raise")
+
+class LedgerEntry(Base):
+    __tablename__ = "ledger_entries"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    tx_id = Column(String, nullable=False, index=True)  # Общий ID проводки для обеих сторон
+    account = Column(String, nullable=False)  # "user" или системный счёт "system:..."
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)  # Только для account == "user"
+    amount = Column(Integer, nullable=False)  # Приход (+) / расход (-) в листиках
+    kind = Column(String, nullable=False)  # "balance", "skin", "daisy", "referral_bonus", "signup_bonus", "opening", "promo"
+    reference = Column(String, nullable=True)  # ID платежа Telegram, скина и т.п.
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class StockCounter(Base):
+    """
+    Остаток ограниченного тиража ("drop:<id>", "promo:<id>"), разбитый на
+    шарды: покупатели расходятся по разным строкам, см. drops.py.
+    """
+    __tablename__ = "stock_counters"
+
+    key = Column(String, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    remaining = Column(Integer, nullable=False)
+
+class StockClaim(Base):
+    """Кто уже получил единицу тиража: не больше одной на пользователя."""
+    __tablename__ = "stock_claims"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("key", "user_id"),)
+
+class Drop(Base):
+    """Лимитированный выпуск скина: тираж stock, продаётся с starts_at до ends_at."""
+    __tablename__ = "drops"
+
+    id = Column(Integer, primary_key=True)
+    skin_id = Column(Integer, ForeignKey("skins.id"), nullable=False)
+    price = Column(Integer, nullable=False)  # Цена в листиках
+    stock = Column(Integer, nullable=False)
+    shards = Column(Integer, nullable=False, default=1)
+    starts_at = Column(DateTime, nullable=False)
+    ends_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class PromoCode(Base):
+    """Промокод на листики (amount) или скин (skin_id), не больше max_redemptions активаций."""
+    __tablename__ = "promo_codes"
+
+    id = Column(Integer, primary_key=True)
+    code = Column(String, nullable=False, unique=True)  # В верхнем регистре
+    amount = Column(Integer, nullable=True)
+    skin_id = Column(Integer, ForeignKey("skins.id"), nullable=True)
+    max_redemptions = Column(Integer, nullable=False)
+    shards = Column(Integer, nullable=False, default=1)
+    expires_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Версия схемы в PRAGMA user_version: при совпадении старт пропускает DDL и заполнение.
+# Увеличивать при каждом изменении create_tables/migrate_schema/init_default_skins.
+SCHEMA_VERSION = 5
+
+def schema_version() -> Optional[int]:
+    """Записанная версия схемы; None - не SQLite, проверка всегда выполняется."""
+    if "sqlite" not in DATABASE_URL:
+        return None
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+def set_schema_version():
+    if "sqlite" in DATABASE_URL:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
 # Create tables
 def create_tables():
@@ -114,9 +263,62 @@ def migrate_schema():
             conn.execute(text("ALTER TABLE users ADD COLUMN daisies_left INTEGER DEFAULT 2"))
         if 'texts_preset_key' not in cols:
             conn.execute(text("ALTER TABLE users ADD COLUMN texts_preset_key TEXT"))
+        if 'version' not in cols:
+            conn.execute(text("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+        if 'text_set_id' not in cols:
+            conn.execute(text("ALTER TABLE users ADD COLUMN text_set_id INTEGER REFERENCES text_sets(id)"))
+        if 'custom_texts' in cols:
+            _move_custom_texts(conn)
+            conn.execute(text("ALTER TABLE users DROP COLUMN custom_texts"))
+        skin_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(skins);"))]
+        if 'category' not in skin_cols:
+            conn.execute(text("ALTER TABLE skins ADD COLUMN category TEXT NOT NULL DEFAULT 'classic'"))
+        if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'ux_user_skins_user_id_skin_id'")).first() is None:
+            # Повторы от прежних гонок между воркерами: остаётся самая ранняя строка
+            conn.execute(text(
+                "DELETE FROM user_skins WHERE id NOT IN (SELECT MIN(id) FROM user_skins GROUP BY user_id, skin_id)"))
+            conn.execute(text("DROP INDEX IF EXISTS ix_user_skins_user_id_skin_id"))
+            conn.execute(text(
+                "CREATE UNIQUE INDEX ux_user_skins_user_id_skin_id ON user_skins (user_id, skin_id)"))
+        # Версия каталога для индекса магазина в памяти (shop_catalog.py)
+        conn.execute(text("INSERT OR IGNORE INTO catalog_state (id, version) VALUES (1, 0)"))
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS skins_catalog_{op.lower()} AFTER {op} ON skins "
+                "BEGIN UPDATE catalog_state SET version = version + 1 WHERE id = 1; END"
+            ))
+        # Журнал баланса только дописывается
+        conn.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS ledger_entries_no_update BEFORE UPDATE ON ledger_entries "
+            "BEGIN SELECT RAISE(ABORT, 'ledger_entries is append-only'); END"
+        ))
+        conn.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS ledger_entries_no_delete BEFORE DELETE ON ledger_entries "
+            "BEGIN SELECT RAISE(ABORT, 'ledger_entries is append-only'); END"
+        ))
+
+def _move_custom_texts(conn):
+    """Переносит JSON из users.custom_texts в text_sets: по строке на различный набор."""
+    raws = [raw for (raw,) in conn.execute(text(
+        "SELECT DISTINCT custom_texts FROM users WHERE custom_texts IS NOT NULL"))]
+    for raw in raws:
+        try:
+            texts = json.loads(raw)
+        except ValueError:
+            continue  # Битый JSON и раньше читался как дефолтный набор
+        if not isinstance(texts, list) or tuple(texts) == DEFAULT_TEXTS:
+            continue
+        digest = text_set_digest(texts)
+        conn.execute(text("INSERT OR IGNORE INTO text_sets (digest, texts) VALUES (:digest, :texts)"),
+                     {"digest": digest, "texts": text_set_json(texts)})
+        conn.execute(text(
+            "UPDATE users SET text_set_id = (SELECT id FROM text_sets WHERE digest = :digest) "
+            "WHERE custom_texts = :raw"), {"digest": digest, "raw": raw})
 
 # Get database session
-def get_db():
+# async: сессия создаётся и закрывается в задаче запроса, без переходов в threadpool,
+# и соединение возвращается в пул сразу после ответа
+async def get_db():
     db = SessionLocal()
     try:
         yield db
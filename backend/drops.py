@@ -0,0 +1,132 @@
+"""
+Лимитированные выпуски скинов (drops) и промокоды.
+
+У обоих есть тираж - счётчик в stock_counters - и правило "одна единица на
+пользователя" - уникальная пара (key, user_id) в stock_claims. Выдача
+единицы в потоке-писателе, в SAVEPOINT единицы работы:
+
+    1. INSERT в stock_claims - повторная попытка того же пользователя
+       падает на уникальности (409);
+    2. UPDATE stock_counters SET remaining = remaining - 1
+       WHERE key = ? AND shard = ? AND remaining > 0 - проверка и списание
+       одним условным UPDATE, продать больше тиража нельзя (410);
+    3. оплата или награда.
+
+Любая ошибка откатывает SAVEPOINT целиком, вместе со списанием.
+
+Тираж можно разбить на shards строк: пользователь начинает со своего шарда
+(user_id % shards) и переходит к следующим, только если его шард пуст. Для
+SQLite с одним писателем это мало что меняет, но на СУБД с блокировками
+строк (PostgreSQL) одна горячая строка сериализует всех покупателей.
+
+Распроданный тираж уже не пополняется, поэтому процесс запоминает его в
+sold_out: после распродажи запросы отвечают 410 без очереди писателя.
+"""
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Set
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import Drop, PromoCode, Purchase, StockClaim, StockCounter, grant_skin
+import ledger
+import query_audit
+
+_TAKE = (
+    update(StockCounter)
+    .where(StockCounter.key == bindparam("counter_key"), StockCounter.shard == bindparam("counter_shard"),
+           StockCounter.remaining > 0)
+    .values(remaining=StockCounter.remaining - 1)
+)
+_CLAIM = insert(StockClaim)
+_REMAINING = (
+    select(StockCounter.key, func.sum(StockCounter.remaining))
+    .where(StockCounter.key.in_(bindparam("keys", expanding=True)))
+    .group_by(StockCounter.key)
+)
+
+sold_out: Set[str] = set()  # Ключи распроданных тиражей в этом процессе
+
+
+def drop_key(drop_id: int) -> str:
+    return f"drop:{drop_id}"
+
+
+def promo_key(promo_id: int) -> str:
+    return f"promo:{promo_id}"
+
+
+def normalize_code(code: str) -> str:
+    return code.strip().upper()
+
+
+def create_counter(wdb: Session, key: str, total: int, shards: int = 1) -> None:
+    """Строки тиража: total поровну по shards шардам."""
+    wdb.execute(insert(StockCounter), [
+        {"key": key, "shard": shard, "remaining": total // shards + (1 if shard < total % shards else 0)}
+        for shard in range(shards)
+    ])
+
+
+def remaining(db: Session, keys: Iterable[str]) -> Dict[str, int]:
+    keys = list(keys)
+    if not keys:
+        return {}
+    return {key: int(left) for key, left in db.execute(_REMAINING, {"keys": keys})}
+
+
+def claim(wdb: Session, key: str, user_id: int, shards: int) -> None:
+    """Одна единица тиража пользователю; вызывается в единице работы писателя."""
+    try:
+        with wdb.begin_nested():
+            wdb.execute(_CLAIM, {"key": key, "user_id": user_id})
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Already claimed")
+    start = user_id % shards
+    if wdb.execute(_TAKE, {"counter_key": key, "counter_shard": start}).rowcount == 1:
+        return
+    # Свой шард пуст - обход остальных в бюджет запроса не входит
+    with query_audit.unbudgeted():
+        for step in range(1, shards):
+            if wdb.execute(_TAKE, {"counter_key": key, "counter_shard": (start + step) % shards}).rowcount == 1:
+                return
+    # Записи сериализованы (писатель, BEGIN IMMEDIATE): пусто во всех шардах - распродано
+    sold_out.add(key)
+    raise HTTPException(status_code=410, detail="Sold out")
+
+
+def check_open(key: str, starts_at: Optional[datetime], ends_at: Optional[datetime]) -> None:
+    """Быстрые отказы до очереди писателя: не начался, закончился, распродан."""
+    now = datetime.utcnow()
+    if starts_at is not None and now < starts_at:
+        raise HTTPException(status_code=403, detail="Not started yet")
+    if ends_at is not None and now >= ends_at:
+        raise HTTPException(status_code=410, detail="Expired")
+    if key in sold_out:
+        raise HTTPException(status_code=410, detail="Sold out")
+
+
+def buy_drop(wdb: Session, drop: Drop, user_id: int) -> int:
+    """Покупка единицы выпуска в потоке-писателе; возвращает новый баланс."""
+    claim(wdb, drop_key(drop.id), user_id, drop.shards)
+    if not grant_skin(wdb, user_id, drop.skin_id):
+        raise HTTPException(status_code=400, detail="Skin already owned")
+    balance = ledger.post(wdb, user_id, -drop.price, "skin", ledger.SHOP_ACCOUNT,
+                          reference=str(drop.skin_id), require_funds=True)
+    wdb.add(Purchase(user_id=user_id, item_type="skin", item_id=drop.skin_id, amount=drop.price))
+    return balance
+
+
+def redeem_promo(wdb: Session, promo: PromoCode, user_id: int) -> Optional[int]:
+    """Активация промокода в потоке-писателе; новый баланс, если награда - листики."""
+    claim(wdb, promo_key(promo.id), user_id, promo.shards)
+    balance = None
+    if promo.amount:
+        balance = ledger.post(wdb, user_id, promo.amount, "promo", ledger.PROMO_ACCOUNT, reference=promo.code)
+    if promo.skin_id is not None:
+        if not grant_skin(wdb, user_id, promo.skin_id):
+            raise HTTPException(status_code=400, detail="Skin already owned")
+        wdb.add(Purchase(user_id=user_id, item_type="promo", item_id=promo.skin_id, amount=0))
+    return balance
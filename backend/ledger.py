@@ -0,0 +1,148 @@
+"""
+Журнал движения листиков (двойная запись).
+
+Источник истины - таблица ledger_entries: каждая проводка состоит из двух
+строк с общим tx_id, сумма которых равна нулю (счёт пользователя и
+системный счёт). Поле users.balance - материализованный снимок суммы по
+счёту пользователя; он меняется тем же UPDATE ... RETURNING в той же
+транзакции, что и запись в журнал.
+
+Сверка снимков с журналом: python ledger.py [--chunk-size N]
+"""
+import argparse
+import sys
+import uuid
+from datetime import datetime
+from typing import Dict, Any, Iterator, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import String, cast, func, insert, literal, null, select, update
+from sqlalchemy.orm import Session
+
+from database import engine, LedgerEntry, User
+
+USER_ACCOUNT = "user"
+
+# Системные счета - вторая сторона проводки
+PAYMENTS_ACCOUNT = "system:payments"
+SHOP_ACCOUNT = "system:shop"
+REFERRALS_ACCOUNT = "system:referrals"
+BONUS_ACCOUNT = "system:bonus"
+PROMO_ACCOUNT = "system:promo"
+OPENING_ACCOUNT = "system:opening"
+
+
+def post(db: Session, user_id: int, amount: int, kind: str, counter_account: str,
+         reference: Optional[str] = None, require_funds: bool = False) -> int:
+    """
+    Проводит amount по счёту пользователя (и -amount по counter_account).
+    Возвращает новый баланс. Коммит остаётся за вызывающим.
+    """
+    stmt = update(User).where(User.id == user_id)
+    if require_funds and amount < 0:
+        # Проверка и списание одним условным UPDATE - без гонки между ними
+        stmt = stmt.where(User.balance >= -amount)
+    stmt = stmt.values(balance=User.balance + amount).returning(User.balance)
+    new_balance = db.execute(stmt, execution_options={"synchronize_session": "fetch"}).scalar()
+    if new_balance is None:
+        if require_funds:
+            raise HTTPException(status_code=400, detail="Insufficient balance")
+        raise HTTPException(status_code=404, detail="User not found")
+
+    tx_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+    db.execute(insert(LedgerEntry), [
+        {"tx_id": tx_id, "account": USER_ACCOUNT, "user_id": user_id, "amount": amount,
+         "kind": kind, "reference": reference, "created_at": now},
+        {"tx_id": tx_id, "account": counter_account, "user_id": None, "amount": -amount,
+         "kind": kind, "reference": reference, "created_at": now},
+    ])
+    return new_balance
+
+
+def backfill_opening_balances(db: Session) -> int:
+    """
+    Одноразово переносит существующие балансы в пустой журнал
+    проводками "opening". Возвращает число перенесённых пользователей.
+    """
+    if db.execute(select(LedgerEntry.id).limit(1)).first() is not None:
+        return 0
+    now = datetime.utcnow()
+    opening = select(User.id, User.balance).where(User.balance != 0).subquery()
+    tx_id = literal("opening-") + cast(opening.c.id, String)
+    columns = ["tx_id", "account", "user_id", "amount", "kind", "created_at"]
+    result = db.execute(insert(LedgerEntry).from_select(columns, select(
+        tx_id, literal(USER_ACCOUNT), opening.c.id, opening.c.balance, literal("opening"), literal(now),
+    )))
+    db.execute(insert(LedgerEntry).from_select(columns, select(
+        tx_id, literal(OPENING_ACCOUNT), null(), -opening.c.balance, literal("opening"), literal(now),
+    )))
+    db.commit()
+    return result.rowcount
+
+
+def reconcile(chunk_size: int = 1000) -> Iterator[Dict[str, Any]]:
+    """
+    Потоково сверяет users.balance с суммой журнала и отдаёт расхождения.
+    Каждый чанк читается одним запросом на отдельном соединении, поэтому
+    длинная читающая транзакция не держится даже на большой базе.
+    """
+    ledger_sum = (
+        select(func.coalesce(func.sum(LedgerEntry.amount), 0))
+        .where(LedgerEntry.user_id == User.id, LedgerEntry.account == USER_ACCOUNT)
+        .correlate(User)
+        .scalar_subquery()
+    )
+    last_id = 0
+    while True:
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(User.id, func.coalesce(User.balance, 0), ledger_sum)
+                .where(User.id > last_id)
+                .order_by(User.id)
+                .limit(chunk_size)
+            ).all()
+        if not rows:
+            return
+        for user_id, balance, expected in rows:
+            if balance != expected:
+                yield {"user_id": user_id, "balance": balance, "ledger": expected}
+        last_id = rows[-1][0]
+
+
+def ledger_total(chunk_size: int = 10000) -> int:
+    """Сумма всех проводок, считается чанками по id; при двойной записи равна нулю."""
+    total = 0
+    last_id = 0
+    while True:
+        chunk = (
+            select(LedgerEntry.id, LedgerEntry.amount)
+            .where(LedgerEntry.id > last_id)
+            .order_by(LedgerEntry.id)
+            .limit(chunk_size)
+            .subquery()
+        )
+        with engine.connect() as conn:
+            max_id, amount = conn.execute(select(func.max(chunk.c.id), func.sum(chunk.c.amount))).one()
+        if max_id is None:
+            return total
+        total += amount
+        last_id = max_id
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Сверка users.balance с журналом проводок")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    mismatches = 0
+    for mismatch in reconcile(args.chunk_size):
+        mismatches += 1
+        print(f"user {mismatch['user_id']}: balance={mismatch['balance']} ledger={mismatch['ledger']}")
+    total = ledger_total()
+    print(f"mismatched users: {mismatches}, ledger total: {total}")
+    return 1 if mismatches or total != 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
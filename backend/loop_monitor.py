@@ -0,0 +1,146 @@
+"""
+Сторож event loop: задержка цикла и поиск блокирующего кода.
+
+Задача в цикле каждые LOOP_LAG_INTERVAL_MS засыпает и меряет, насколько
+позже срока проснулась - это задержка цикла (event_loop_lag_seconds).
+Заодно она обновляет отметку "цикл жив". Отдельный поток-сторож
+проверяет отметку; если цикл молчит дольше LOOP_BLOCK_MS, сторож снимает
+стек потока цикла через sys._current_frames() - в этот момент там как раз
+выполняется блокирующий код.
+
+По стеку определяются маршрут (кадр endpoint-функции) и функция - самый
+глубокий кадр из кода бэкенда, например TelegramPaymentService.create_invoice.
+Обёртки инструментирования (metrics, query_audit, tracing, profiling,
+startup_timing) пропускаются: при ожидании соединения пула виноват не
+metrics.timed_connect, а код, который его запросил.
+Блокировка логируется со стеком один раз за остановку, считается в
+event_loop_blocks_total{route, function} и попадает в буфер
+GET /api/debug/loop-blocks.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from types import CodeType, FrameType
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+
+INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL_MS", "100")) / 1000
+BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_MS", "200")) / 1000
+
+logger = logging.getLogger("loop_monitor")
+
+loop_lag = metrics.Histogram(metrics.registry, "event_loop_lag_seconds", "Event loop wake-up delay",
+                             buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+loop_blocks = metrics.Counter(metrics.registry, "event_loop_blocks_total",
+                              "Event loop stalls longer than LOOP_BLOCK_MS by route and function",
+                              ("route", "function"))
+
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+_INSTRUMENTATION = frozenset(_BACKEND_DIR + name for name in (
+    "metrics.py", "query_audit.py", "tracing.py", "profiling.py", "startup_timing.py"))
+
+
+def _qualname(code: CodeType) -> str:
+    return getattr(code, "co_qualname", code.co_name)
+
+
+class LoopMonitor:
+    def __init__(self, app, interval: float = INTERVAL, threshold: float = BLOCK_THRESHOLD):
+        self.app = app
+        self.interval = interval
+        self.threshold = threshold
+        self.blocks: "deque[Dict[str, Any]]" = deque(maxlen=50)
+        self._beat = time.perf_counter()
+        self._last_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop_thread_id = 0
+        self._endpoints: Dict[CodeType, str] = {}
+
+    def start(self) -> None:
+        """Вызывается из startup, то есть в потоке event loop."""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._endpoints = {route.endpoint.__code__: route.path for route in self.app.routes
+                           if hasattr(getattr(route, "endpoint", None), "__code__")}
+        self._beat = time.perf_counter()
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self._measure())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    async def _measure(self) -> None:
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self._beat = now
+            self._last_lag = max(0.0, now - expected)
+            loop_lag.observe(self._last_lag)
+
+    def current_lag(self) -> float:
+        """Последняя задержка цикла или время с последней отметки, если цикл сейчас стоит."""
+        if self._task is None:
+            return 0.0
+        return max(self._last_lag, time.perf_counter() - self._beat - self.interval)
+
+    def _watch(self) -> None:
+        reported_beat = None
+        while not self._stopped.wait(self.threshold / 2):
+            beat = self._beat
+            stalled = time.perf_counter() - beat - self.interval
+            if stalled < self.threshold or beat == reported_beat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            reported_beat = beat
+            self._report(frame, stalled)
+
+    def _report(self, frame: FrameType, stalled: float) -> None:
+        route, function = self.locate(frame)
+        stack = "".join(traceback.format_stack(frame))
+        loop_blocks.inc(route, function)
+        self.blocks.append({"time": time.time(), "stalled_ms": round(stalled * 1000, 1),
+                            "route": route, "function": function, "stack": stack})
+        logger.warning("event loop blocked for %.0fms+ in %s by %s\n%s", stalled * 1000, route, function, stack)
+
+    def locate(self, frame: Optional[FrameType]) -> Tuple[str, str]:
+        """(маршрут, функция) для стека: endpoint-кадр и самый глубокий кадр кода бэкенда."""
+        route = "<none>"
+        function = "<unknown>"
+        while frame is not None:
+            code = frame.f_code
+            if (function == "<unknown>" and code.co_filename.startswith(_BACKEND_DIR)
+                    and code.co_filename not in _INSTRUMENTATION):
+                function = _qualname(code)
+            path = self._endpoints.get(code)
+            if path is not None:
+                route = path
+                break
+            frame = frame.f_back
+        return route, function
+
+    def recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        return list(self.blocks)[-limit:][::-1]
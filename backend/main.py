@@ -1,17 +1,42 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+import startup_timing  # Первым: замер импортов начинается отсюда
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
-from sqlalchemy.orm import Session
+from typing import List, Optional, Dict, Any, Sequence, Tuple
+from sqlalchemy import bindparam, exists, insert, select, update
+from sqlalchemy.orm import Session, configure_mappers, joinedload, load_only, make_transient_to_detached
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 import uvicorn
+import asyncio
 import os
-import json
+from datetime import datetime, timezone
+import re
+import time
 from dotenv import load_dotenv
 
 # Import our modules
-from database import get_db, create_tables, migrate_schema, init_default_skins, User, Skin, UserSkin, Referral, Purchase, Result
+from database import get_db, create_tables, migrate_schema, init_default_skins, schema_version, set_schema_version, SCHEMA_VERSION, grant_skin, engine, SessionLocal, User, Skin, UserSkin, Referral, Purchase, Result, Drop, PromoCode
 from telegram_auth import TelegramAuth
-from payment_service import TelegramPaymentService
+from admin_auth import require_admin
+import ledger
+from write_queue import WriteQueue
+from user_state import UserStateCache
+from user_locks import StripedLocks
+from text_sets import TextSetCache
+import presets
+from blocklist import Blocklist
+import share_card
+import skin_assets
+import shop_catalog
+import drops
+import metrics
+import query_audit
+import tracing
+import profiling
+from loop_monitor import LoopMonitor
+import admission
 
 # Load environment variables
 load_dotenv()
@@ -30,13 +55,52 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(query_audit.QueryAuditMiddleware)
+app.add_middleware(tracing.TracingMiddleware)
+# Сервисы ниже создаются позже, поэтому сигналы читаются через lambda
+app.add_middleware(admission.AdmissionMiddleware, loop_lag=lambda: loop_monitor.current_lag(),
+                   write_queue_depth=lambda: db_writer.qsize())
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(startup_timing.FirstResponseMiddleware)
+metrics.instrument_engine(engine)
+query_audit.instrument_engine(engine)
+tracing.instrument_engine(engine)
 
 # Initialize services
 BOT_TOKEN = os.getenv("BOT_TOKEN", "your_bot_token_here")
 PROVIDER_TOKEN = os.getenv("PROVIDER_TOKEN", "your_provider_token_here")
 
 telegram_auth = TelegramAuth(BOT_TOKEN)
-payment_service = TelegramPaymentService(BOT_TOKEN, PROVIDER_TOKEN)
+_payment_service = None
+
+def get_payment_service():
+    """payment_service (и requests) импортируется при первом платеже, а не при старте"""
+    global _payment_service
+    if _payment_service is None:
+        from payment_service import TelegramPaymentService
+        _payment_service = TelegramPaymentService(BOT_TOKEN, PROVIDER_TOKEN)
+    return _payment_service
+db_writer = WriteQueue()  # Все изменения БД идут через единственный поток-писатель
+user_locks = StripedLocks()
+daisy_state = UserStateCache(db_writer, write_behind=os.getenv("DAISIES_WRITE_BEHIND", "1") == "1")
+loop_monitor = LoopMonitor(app)
+text_cache = TextSetCache()  # id набора кастомных текстов -> разобранный кортеж
+preset_stats = presets.PresetStats()
+blocklist = Blocklist()
+share_cards = share_card.ShareCardCache()
+skin_images = skin_assets.SkinAssets()
+skin_assets_task: Optional[asyncio.Task] = None
+catalog = shop_catalog.ShopCatalog()  # Снимок skins в памяти для магазина
+
+metrics.GaugeCallback(metrics.registry, "db_writer_queue_depth", "Units waiting for the writer thread",
+                      db_writer.qsize)
+metrics.GaugeCallback(metrics.registry, "daisy_state_dirty", "Users with unflushed daisies_left",
+                      daisy_state.dirty_count)
+metrics.GaugeCallback(metrics.registry, "user_locks_held", "User lock stripes currently held",
+                      user_locks.locked_count)
+metrics.GaugeCallback(metrics.registry, "db_pool_checked_out", "Pooled connections in use",
+                      lambda: engine.pool.checkedout())
 
 # Pydantic models
 class AuthRequest(BaseModel):
@@ -56,6 +120,13 @@ class UserResponse(BaseModel):
     current_skin_color: Optional[str] = None
     texts_preset_key: Optional[str] = None
 
+class SkinSprite(BaseModel):
+    url: str
+    x: int
+    y: int
+    width: int
+    height: int
+
 class SkinResponse(BaseModel):
     id: int
     name: str
@@ -63,6 +134,17 @@ class SkinResponse(BaseModel):
     color: str
     is_default: bool
     owned: bool = False
+    category: str = "classic"
+    image_url: Optional[str] = None
+    sprite: Optional[SkinSprite] = None  # Ячейка в общем спрайт-листе магазина
+
+class ShopPageResponse(BaseModel):
+    items: List[SkinResponse]
+    next_cursor: Optional[str] = None  # None - страница последняя
+
+class ShopCategoryResponse(BaseModel):
+    key: str
+    count: int
 
 class BuySkinRequest(BaseModel):
     skin_id: int
@@ -86,9 +168,94 @@ class PaymentCallback(BaseModel):
 class CustomTextRequest(BaseModel):
     texts: List[str]
 
+class DropResponse(BaseModel):
+    id: int
+    skin_id: int
+    name: str
+    color: str
+    price: int
+    stock: int
+    remaining: int
+    starts_at: str
+    ends_at: str
+
+class PromoRedeemRequest(BaseModel):
+    code: str
+
+class DropCreateRequest(BaseModel):
+    skin_id: int
+    price: int
+    stock: int
+    shards: int = 1
+    starts_at: datetime
+    ends_at: datetime
+
+class PromoCodeCreateRequest(BaseModel):
+    code: str
+    amount: Optional[int] = None  # Листики
+    skin_id: Optional[int] = None
+    max_redemptions: int
+    shards: int = 1
+    expires_at: Optional[datetime] = None
+
+def utc_naive(moment: Optional[datetime]) -> Optional[datetime]:
+    """Время из запроса в том же виде, что и datetime.utcnow() в базе."""
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+async def run_write(db: Session, work):
+    """
+    Отдаёт работу писателю. Читающая транзакция запроса завершается заранее:
+    соединение пула нельзя держать через await, иначе при числе запросов
+    больше размера пула синхронный checkout заблокирует event loop.
+    """
+    db.commit()
+    return await db_writer.run(work)
+
+# Самые частые выражения собираются один раз при импорте. Ключ кэша компиляции
+# у готового выражения мемоизирован, так что на вызов остаётся только execute,
+# без построения Query и вычисления ключа.
+_USER_BY_TG_ID = select(User).where(User.tg_id == bindparam("tg_id"))
+_USER_ID_BY_TG_ID = select(User.id).where(User.tg_id == bindparam("tg_id"))
+_INSERT_USER = insert(User).returning(*User.__table__.c)
+_SKIN_COLOR = select(Skin.color).where(Skin.id == bindparam("skin_id"))
+# in_drop: у скина есть незакончившийся выпуск - он продаётся только там, в пределах тиража
+_SKIN_PRICE = select(
+    Skin.price, Skin.is_default,
+    exists().where(Drop.skin_id == Skin.id, Drop.ends_at > bindparam("now")).label("in_drop"),
+).where(Skin.id == bindparam("skin_id"))
+_SKIN_IS_DEFAULT = select(Skin.is_default).where(Skin.id == bindparam("skin_id"))
+_SKIN_OWNED = select(UserSkin.id).where(UserSkin.user_id == bindparam("user_id"),
+                                        UserSkin.skin_id == bindparam("skin_id")).limit(1)
+_DROP_BY_ID = select(Drop).where(Drop.id == bindparam("drop_id"))
+_PROMO_BY_CODE = select(PromoCode).where(PromoCode.code == bindparam("code"))
+_user_columns_by_tg_id: Dict[Tuple[str, ...], Any] = {}
+
+def user_columns_stmt(only: Sequence[Any]):
+    """SELECT id и колонок only по tg_id; по одному готовому выражению на набор колонок."""
+    key = tuple(column.key for column in only)
+    stmt = _user_columns_by_tg_id.get(key)
+    if stmt is None:
+        columns = [User.id] + [column for column in only if column.key != "id"]
+        stmt = _user_columns_by_tg_id[key] = select(*columns).where(User.tg_id == bindparam("tg_id"))
+    return stmt
+
+def find_user(db: Session, tg_id: int, only: Sequence[Any] = ()):
+    if only:
+        return db.execute(user_columns_stmt(only), {"tg_id": tg_id}).first()
+    return db.execute(_USER_BY_TG_ID, {"tg_id": tg_id}).scalars().first()
+
 # Helper function to get current user
-def get_current_user(init_data: str, db: Session = Depends(get_db)) -> User:
-    verified_data = telegram_auth.verify_init_data(init_data)
+async def get_current_user(init_data: str, db: Session = Depends(get_db), only: Sequence[Any] = ()) -> User:
+    """
+    only - колонки User, нужные маршруту. Тогда возвращается не объект User, а
+    строка (id и эти колонки) с теми же атрибутами: без построения объекта ORM.
+    """
+    started = time.perf_counter()
+    with tracing.span("auth.verify_init_data"):
+        verified_data = telegram_auth.verify_init_data(init_data)
+    metrics.auth_verify.observe(time.perf_counter() - started, "ok" if verified_data else "invalid")
     if not verified_data:
         raise HTTPException(status_code=401, detail="Invalid init data")
     
@@ -96,64 +263,73 @@ def get_current_user(init_data: str, db: Session = Depends(get_db)) -> User:
     tg_id = user_info['tg_id']
     
     # Find or create user
-    user = db.query(User).filter(User.tg_id == tg_id).first()
+    user = find_user(db, tg_id, only)
     if not user:
-        user = User(
-            tg_id=tg_id,
-            username=user_info.get('username'),
-            first_name=user_info.get('first_name'),
-            last_name=user_info.get('last_name'),
-            balance=100,  # Стартовый бонус
-            custom_texts=json.dumps(["любит", "не любит"])  # Дефолтные тексты
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
+        def create_user(wdb: Session) -> Optional[Dict[str, Any]]:
+            # Повторная проверка: параллельный запрос мог уже создать пользователя
+            if wdb.execute(_USER_ID_BY_TG_ID, {"tg_id": tg_id}).first():
+                return None
+            # INSERT ... RETURNING отдаёт всю строку с серверными id и умолчаниями
+            row = dict(wdb.execute(_INSERT_USER, {
+                "tg_id": tg_id,
+                "username": user_info.get('username'),
+                "first_name": user_info.get('first_name'),
+                "last_name": user_info.get('last_name'),
+                "balance": 0,
+            }).one()._mapping)
+            row["balance"] = ledger.post(wdb, row["id"], 100, "signup_bonus", ledger.BONUS_ACCOUNT)  # Стартовый бонус
+            return row
+
+        # run_write завершает читающую транзакцию - после неё виден коммит писателя.
+        # Регистрация разовая и может случиться на любом маршруте - не в его бюджете запросов
+        with query_audit.unbudgeted():
+            row = await run_write(db, create_user)
+            if row is None:
+                return find_user(db, tg_id, only)
+            # Строка уже известна целиком: объект попадает в сессию без SELECT
+            user = User(**row)
+            make_transient_to_detached(user)
+            db.add(user)
     
     return user
 
-# Routes
-@app.on_event("startup")
-async def startup_event():
-    create_tables()
-    migrate_schema()
-    init_default_skins()
+async def get_locked_user(init_data: str, db: Session = Depends(get_db)):
+    """
+    Текущий пользователь под его блокировкой: изменения одного пользователя
+    выполняются по очереди, разных - параллельно.
+    """
+    user = await get_current_user(init_data, db)
+    db.commit()  # Не держим соединение пула, пока ждём блокировку
+    async with user_locks.for_key(user.id):
+        # Свежий снимок: предыдущий запрос пользователя мог закоммитить, пока мы ждали
+        db.refresh(user)
+        db.commit()
+        yield user
 
-@app.get("/")
-async def root():
-    return {"message": "Welcome to Daisy Game Telegram Mini App API!"}
+def user_etag(version: int, *parts: Any) -> str:
+    """ETag настроек пользователя, выводится из users.version."""
+    return '"' + ".".join(str(part) for part in (version, *parts)) + '"'
 
-@app.get("/health")
-async def health_check():
-    return {"status": "healthy"}
+def check_if_match(if_match: Optional[str], etag: str) -> None:
+    """Быстрый 409 до очереди писателя, если клиент правит устаревшую версию."""
+    if if_match is None:
+        return
+    tags = [tag.strip() for tag in if_match.split(",")]
+    if "*" not in tags and etag not in tags:
+        raise HTTPException(status_code=409, detail="Version conflict", headers={"ETag": etag})
 
-# Duplicate health endpoint under /api for Nginx proxy prefix
-@app.get("/api/health")
-async def api_health_check():
-    return {"status": "healthy"}
+def load_versioned(wdb: Session, user_id: int, version: int) -> User:
+    """Пользователь для изменения в потоке-писателе; 409, если его версию уже обогнали."""
+    target = wdb.get(User, user_id)
+    if target.version != version:
+        raise HTTPException(status_code=409, detail="Version conflict", headers={"ETag": user_etag(target.version)})
+    return target
 
-# Auth endpoints
-@app.post("/api/auth", response_model=UserResponse)
-async def auth_user(auth_request: AuthRequest, db: Session = Depends(get_db)):
-    """Авторизация пользователя через Telegram WebApp"""
-    user = get_current_user(auth_request.initData, db)
-    
-    # Парсим кастомные тексты
-    custom_texts = []
-    if user.custom_texts:
-        try:
-            custom_texts = json.loads(user.custom_texts)
-        except:
-            custom_texts = ["любит", "не любит"]
-    else:
-        custom_texts = ["любит", "не любит"]
-    
+def build_user_response(user: User, db: Session, custom_texts: Optional[Sequence[str]] = None) -> UserResponse:
     # Определяем цвет текущего скина
     current_skin_color = None
     if user.current_skin_id:
-        skin_obj = db.query(Skin).filter(Skin.id == user.current_skin_id).first()
-        if skin_obj and skin_obj.color:
-            current_skin_color = skin_obj.color
+        current_skin_color = db.execute(_SKIN_COLOR, {"skin_id": user.current_skin_id}).scalar()
 
     return UserResponse(
         id=user.id,
@@ -165,60 +341,168 @@ async def auth_user(auth_request: AuthRequest, db: Session = Depends(get_db)):
         referrals_count=user.referrals_count,
         current_skin_id=user.current_skin_id,
         custom_texts=custom_texts,
-        daisies_left=user.daisies_left,
+        daisies_left=daisy_state.get_daisies(user),
         current_skin_color=current_skin_color,
         texts_preset_key=user.texts_preset_key
     )
 
+@app.exception_handler(query_audit.QueryBudgetExceeded)
+async def query_budget_handler(request: Request, exc: query_audit.QueryBudgetExceeded):
+    # Только в строгом режиме (тесты): маршрут выполнил больше SQL, чем объявил
+    return JSONResponse(status_code=500, content={"detail": str(exc)})
+
+@app.exception_handler(StaleDataError)
+async def stale_data_handler(request: Request, exc: StaleDataError):
+    # Строку users изменили параллельно (другой процесс) - клиент может повторить запрос
+    return JSONResponse(status_code=409, content={"detail": "Version conflict"})
+
+def init_database():
+    """Схема, миграции и начальные данные. serve.py выполняет это один раз до запуска воркеров."""
+    with startup_timing.phase("schema_check"):
+        schema_current = schema_version() == SCHEMA_VERSION
+    if not schema_current:
+        with startup_timing.phase("schema_init"):
+            create_tables()
+            migrate_schema()
+            init_default_skins()
+            db = SessionLocal()
+            try:
+                ledger.backfill_opening_balances(db)
+            finally:
+                db.close()
+            set_schema_version()
+
+async def build_skin_assets():
+    """
+    Картинки скинов - в фоне после старта: холодная сборка большого каталога
+    идёт минуты, а без изменений это лишь чтение исходников и manifest.
+    """
+    try:
+        db = SessionLocal()
+        try:
+            skins = db.execute(select(Skin.id, Skin.color)).all()
+        finally:
+            db.close()
+        changed = await asyncio.to_thread(skin_images.build, skins)
+        updated = await db_writer.run(lambda wdb: skin_assets.sync_image_urls(wdb, skin_images))
+        if changed or updated:
+            skin_assets.logger.info("skin assets: %d skins rendered, %d image urls updated", len(changed), updated)
+    except Exception:
+        skin_assets.logger.exception("skin asset build failed")
+
+# Routes
+@app.on_event("startup")
+async def startup_event():
+    global skin_assets_task
+    # Мапперы настраиваются при старте, а не на первом запросе
+    with startup_timing.phase("configure_mappers"):
+        configure_mappers()
+    with startup_timing.phase("blocklist"):
+        blocklist.reload()
+    if os.getenv("DB_INIT_DONE") != "1":
+        init_database()
+    db_writer.start()
+    daisy_state.start()
+    loop_monitor.start()
+    preset_stats.start()
+    skin_images.refresh()
+    skin_assets_task = asyncio.ensure_future(build_skin_assets())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if skin_assets_task is not None:
+        skin_assets_task.cancel()  # Сам поток сборки не прервать - он допишет файлы и выйдет
+    await loop_monitor.stop()
+    await preset_stats.stop()
+    await daisy_state.stop()
+    db_writer.stop()
+
+@app.get("/")
+async def root():
+    return {"message": "Welcome to Daisy Game Telegram Mini App API!"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+async def health_check():
+    return {"status": "healthy"}
+
+# Duplicate health endpoint under /api for Nginx proxy prefix
+@app.get("/api/health")
+async def api_health_check():
+    return {"status": "healthy"}
+
+# Auth endpoints
+@app.post("/api/auth", response_model=UserResponse, dependencies=[Depends(query_audit.query_budget(2))])
+async def auth_user(auth_request: AuthRequest, db: Session = Depends(get_db)):
+    """Авторизация пользователя через Telegram WebApp"""
+    user = await get_current_user(auth_request.initData, db)
+    return build_user_response(user, db, custom_texts=text_cache.get(db, user.text_set_id))
+
 # User endpoints
-@app.get("/api/user/{user_id}", response_model=UserResponse)
+@app.get("/api/user/{user_id}", response_model=UserResponse, dependencies=[Depends(query_audit.query_budget(2))])
 async def get_user(user_id: int, db: Session = Depends(get_db)):
     """Получение профиля пользователя"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Определяем цвет текущего скина
-    current_skin_color = None
-    if user.current_skin_id:
-        skin_obj = db.query(Skin).filter(Skin.id == user.current_skin_id).first()
-        if skin_obj and skin_obj.color:
-            current_skin_color = skin_obj.color
-
-    return UserResponse(
-        id=user.id,
-        tg_id=user.tg_id,
-        username=user.username,
-        first_name=user.first_name,
-        last_name=user.last_name,
-        balance=user.balance,
-        referrals_count=user.referrals_count,
-        current_skin_id=user.current_skin_id,
-        daisies_left=user.daisies_left,
-        current_skin_color=current_skin_color,
-        texts_preset_key=user.texts_preset_key
-    )
+    return build_user_response(user, db)
 
 class PresetUpdate(BaseModel):
     key: Optional[str] = None
     texts: Optional[List[str]] = None
 
-@app.post("/api/preset")
-async def set_preset(update: PresetUpdate, init_data: str, db: Session = Depends(get_db)):
-    user = get_current_user(init_data, db)
-    if update.key:
-        user.texts_preset_key = update.key
-    if update.texts is not None:
-        user.custom_texts = json.dumps(update.texts)
-    db.commit()
-    return {"texts_preset_key": user.texts_preset_key}
+@app.post("/api/preset", dependencies=[Depends(query_audit.query_budget(6))])
+async def set_preset(update: PresetUpdate, response: Response, user: User = Depends(get_locked_user),
+                     db: Session = Depends(get_db), if_match: Optional[str] = Header(None)):
+    check_if_match(if_match, user_etag(user.version))
+    if update.texts is not None and blocklist.check(update.texts):
+        raise HTTPException(status_code=400, detail="Text contains blocked words")
+    user_id, version = user.id, user.version
+
+    def work(wdb: Session):
+        target = load_versioned(wdb, user_id, version)
+        # intern до правок target: его SAVEPOINT сбрасывает изменения сессии,
+        # и key с texts ушли бы двумя UPDATE users с двумя сменами версии
+        if update.texts is not None:
+            target.text_set_id = text_cache.intern(wdb, update.texts)
+        if update.key:
+            target.texts_preset_key = update.key
+        wdb.flush()
+        return {"texts_preset_key": target.texts_preset_key}, target.version
+
+    result, new_version = await run_write(db, work)
+    # Тексты пресета клиент отдельно шлёт в /api/custom-texts - там они и считаются
+    preset_stats.record(key=update.key, texts=None if update.key else update.texts)
+    response.headers["ETag"] = user_etag(new_version)
+    return result
+
+@app.get("/api/presets")
+async def list_presets(if_none_match: Optional[str] = Header(None)):
+    """Каталог пресетов текстов (из памяти, с ETag)"""
+    if if_none_match == presets.CATALOG_ETAG:
+        return Response(status_code=304, headers={"ETag": presets.CATALOG_ETAG})
+    return Response(presets.CATALOG_BODY, media_type="application/json", headers={"ETag": presets.CATALOG_ETAG})
 
-@app.get("/api/purchases")
+@app.get("/api/presets/popular")
+async def popular_presets(if_none_match: Optional[str] = Header(None)):
+    """Популярные пресеты и наборы текстов - последний снимок скетчей, без запросов к БД"""
+    body, etag = preset_stats.body, preset_stats.etag
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+@app.get("/api/purchases", dependencies=[Depends(query_audit.query_budget(2))])
 async def list_purchases(init_data: str, offset: int = 0, limit: int = 20, db: Session = Depends(get_db)):
-    user = get_current_user(init_data, db)
+    user = await get_current_user(init_data, db, only=(User.id,))
     limit = max(1, min(limit, 100))
     purchases = (
         db.query(Purchase)
+        .options(load_only(Purchase.id, Purchase.item_type, Purchase.item_id, Purchase.amount, Purchase.created_at))
         .filter(Purchase.user_id == user.id)
         .order_by(Purchase.created_at.desc())
         .offset(max(0, offset))
@@ -237,12 +521,13 @@ async def list_purchases(init_data: str, offset: int = 0, limit: int = 20, db: S
         ]
     }
 
-@app.get("/api/results")
+@app.get("/api/results", dependencies=[Depends(query_audit.query_budget(2))])
 async def list_results(init_data: str, offset: int = 0, limit: int = 20, db: Session = Depends(get_db)):
-    user = get_current_user(init_data, db)
+    user = await get_current_user(init_data, db, only=(User.id,))
     limit = max(1, min(limit, 100))
     results = (
         db.query(Result)
+        .options(load_only(Result.id, Result.result_text, Result.created_at))
         .filter(Result.user_id == user.id)
         .order_by(Result.created_at.desc())
         .offset(max(0, offset))
@@ -258,93 +543,135 @@ async def list_results(init_data: str, offset: int = 0, limit: int = 20, db: Ses
 class DaisiesUpdate(BaseModel):
     value: int
 
-@app.get("/api/daisies")
-async def get_daisies_left(init_data: str, db: Session = Depends(get_db)):
-    user = get_current_user(init_data, db)
-    return {"daisies_left": user.daisies_left}
+@app.get("/api/daisies", dependencies=[Depends(query_audit.query_budget(1))])
+async def get_daisies_left(init_data: str, db: Session = Depends(get_db),
+                           if_none_match: Optional[str] = Header(None)):
+    user = await get_current_user(init_data, db, only=(User.daisies_left, User.version))
+    daisies_left = daisy_state.get_daisies(user)
+    # daisies_left живёт в кэше и не двигает version, поэтому входит в ETag отдельно
+    etag = user_etag(user.version, daisies_left)
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse({"daisies_left": daisies_left}, headers={"ETag": etag})
 
-@app.post("/api/daisies")
-async def set_daisies_left(update: DaisiesUpdate, init_data: str, db: Session = Depends(get_db)):
-    user = get_current_user(init_data, db)
-    user.daisies_left = max(0, int(update.value))
-    db.commit()
-    return {"daisies_left": user.daisies_left}
+@app.post("/api/daisies", dependencies=[Depends(query_audit.query_budget(2))])
+async def set_daisies_left(update: DaisiesUpdate, response: Response, user: User = Depends(get_locked_user),
+                           db: Session = Depends(get_db), if_match: Optional[str] = Header(None)):
+    check_if_match(if_match, user_etag(user.version, daisy_state.get_daisies(user)))
+    value = await daisy_state.set_daisies(user.id, max(0, int(update.value)))
+    response.headers["ETag"] = user_etag(user.version, value)
+    return {"daisies_left": value}
 
-@app.post("/api/daisies/buy")
-async def buy_daisy(init_data: str, db: Session = Depends(get_db)):
+@app.post("/api/daisies/buy", dependencies=[Depends(query_audit.query_budget(6))])
+async def buy_daisy(user: User = Depends(get_locked_user), db: Session = Depends(get_db)):
     """Покупка 1 ромашки за 50 листиков."""
-    user = get_current_user(init_data, db)
     cost = 50
-    if user.balance < cost:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-    user.balance -= cost
-    user.daisies_left = (user.daisies_left or 0) + 1
-    purchase = Purchase(user_id=user.id, item_type="daisy", amount=cost)
-    db.add(purchase)
-    db.commit()
-    return {"daisies_left": user.daisies_left, "balance": user.balance}
+    daisies_left = daisy_state.get_daisies(user) + 1
+
+    def work(wdb: Session):
+        balance = ledger.post(wdb, user.id, -cost, "daisy", ledger.SHOP_ACCOUNT, require_funds=True)
+        # Оплаченная ромашка пишется сразу, в транзакции списания
+        wdb.get(User, user.id).daisies_left = daisies_left
+        purchase = Purchase(user_id=user.id, item_type="daisy", amount=cost)
+        wdb.add(purchase)
+        return {"daisies_left": daisies_left, "balance": balance}
+
+    result = await run_write(db, work)
+    daisy_state.mark_written(user.id, daisies_left)
+    return result
 
 # Balance endpoints
-@app.get("/api/balance")
+@app.get("/api/balance", dependencies=[Depends(query_audit.query_budget(1))])
 async def get_balance(init_data: str, db: Session = Depends(get_db)):
     """Получение текущего баланса"""
-    user = get_current_user(init_data, db)
+    user = await get_current_user(init_data, db, only=(User.balance,))
     return {"balance": user.balance}
 
-@app.post("/api/balance/add")
-async def add_balance(amount: int, init_data: str, db: Session = Depends(get_db)):
+@app.post("/api/balance/add", dependencies=[Depends(query_audit.query_budget(5))])
+async def add_balance(amount: int, user: User = Depends(get_locked_user), db: Session = Depends(get_db)):
     """Добавление валюты (по оплате или рефералу)"""
-    user = get_current_user(init_data, db)
-    user.balance += amount
-    
-    # Записываем покупку
-    purchase = Purchase(
-        user_id=user.id,
-        item_type="balance",
-        amount=amount
-    )
-    db.add(purchase)
-    db.commit()
-    
-    return {"message": "Balance updated", "new_balance": user.balance}
+    def work(wdb: Session):
+        balance = ledger.post(wdb, user.id, amount, "balance", ledger.PAYMENTS_ACCOUNT)
+        
+        # Записываем покупку
+        purchase = Purchase(
+            user_id=user.id,
+            item_type="balance",
+            amount=amount
+        )
+        wdb.add(purchase)
+        return {"message": "Balance updated", "new_balance": balance}
+
+    return await run_write(db, work)
 
 # Skins endpoints
-@app.get("/api/skins", response_model=List[SkinResponse])
+def skin_response(skin: shop_catalog.CatalogSkin, owned: bool) -> SkinResponse:
+    return SkinResponse(
+        id=skin.id,
+        name=skin.name,
+        price=skin.price,
+        color=skin.color or "#FFFFFF",
+        is_default=skin.is_default,
+        owned=owned,
+        category=skin.category,
+        image_url=skin_images.image_url(skin.id),
+        sprite=skin_images.sprite(skin.id),
+    )
+
+@app.get("/api/skins", response_model=List[SkinResponse], dependencies=[Depends(query_audit.query_budget(2))])
 async def get_skins(init_data: str, db: Session = Depends(get_db)):
-    """Получение всех доступных скинов ромашек"""
-    user = get_current_user(init_data, db)
-    skins = db.query(Skin).all()
-    
-    # Получаем скины пользователя
-    user_skin_ids = {us.skin_id for us in user.user_skins}
-    
-    result = []
-    for skin in skins:
-        result.append(SkinResponse(
-            id=skin.id,
-            name=skin.name,
-            price=skin.price,
-            color=skin.color or "#FFFFFF",
-            is_default=skin.is_default,
-            owned=skin.id in user_skin_ids or skin.is_default
-        ))
-    
-    return result
+    """Получение всех доступных скинов ромашек (весь каталог; постранично - /api/shop/skins)"""
+    user = await get_current_user(init_data, db, only=(User.id,))
+    skin_images.refresh()
+    index = catalog.get(db)
+    user_skin_ids = shop_catalog.owned_skin_ids(db, user.id)
+    return [skin_response(skin, skin.id in user_skin_ids or skin.is_default) for skin in index.skins]
+
+# Пользователь + флаги владения (с фильтром owned - до OWNED_PROBES + 1 запросов)
+@app.get("/api/shop/skins", response_model=ShopPageResponse,
+         dependencies=[Depends(query_audit.query_budget(2 + shop_catalog.OWNED_PROBES))])
+async def browse_shop(init_data: str, category: Optional[str] = None, min_price: Optional[int] = None,
+                      max_price: Optional[int] = None, owned: Optional[bool] = None, sort: str = "price_asc",
+                      cursor: Optional[str] = None, limit: int = 50, db: Session = Depends(get_db)):
+    """Страница каталога с фильтрами; следующая - с cursor=next_cursor и теми же фильтрами"""
+    if sort not in shop_catalog.SORTS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of: {', '.join(shop_catalog.SORTS)}")
+    if not 1 <= limit <= shop_catalog.MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be 1-{shop_catalog.MAX_PAGE_SIZE}")
+    user = await get_current_user(init_data, db, only=(User.id,))
+    skin_images.refresh()
+    try:
+        items, next_cursor = shop_catalog.browse(
+            db, catalog.get(db), user.id, category=category, sort=sort, min_price=min_price,
+            max_price=max_price, owned=owned, cursor=cursor, limit=limit)
+    except shop_catalog.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ShopPageResponse(items=[skin_response(skin, is_owned) for skin, is_owned in items],
+                            next_cursor=next_cursor)
 
-@app.post("/api/skins/buy")
-async def buy_skin(request: BuySkinRequest, init_data: str, db: Session = Depends(get_db)):
+@app.get("/api/shop/categories", response_model=List[ShopCategoryResponse],
+         dependencies=[Depends(query_audit.query_budget(0))])
+async def shop_categories(db: Session = Depends(get_db)):
+    """Разделы магазина и число скинов в каждом"""
+    index = catalog.get(db)
+    return [ShopCategoryResponse(key=key, count=count) for key, count in sorted(index.categories.items())]
+
+@app.post("/api/skins/buy", dependencies=[Depends(query_audit.query_budget(8))])
+async def buy_skin(request: BuySkinRequest, user: User = Depends(get_locked_user), db: Session = Depends(get_db)):
     """Покупка скина ромашки"""
-    user = get_current_user(init_data, db)
-    skin = db.query(Skin).filter(Skin.id == request.skin_id).first()
+    skin = db.execute(_SKIN_PRICE, {"skin_id": request.skin_id, "now": datetime.utcnow()}).first()
     
     if not skin:
         raise HTTPException(status_code=404, detail="Skin not found")
     
     if skin.is_default:
         raise HTTPException(status_code=400, detail="Cannot buy default skin")
+
+    if skin.in_drop:
+        raise HTTPException(status_code=409, detail="Skin is sold only in its limited drop")
     
     # Проверяем, есть ли уже этот скин
-    existing_skin = db.query(UserSkin).filter(
+    existing_skin = db.query(UserSkin.id).filter(
         UserSkin.user_id == user.id,
         UserSkin.skin_id == request.skin_id
     ).first()
@@ -352,39 +679,43 @@ async def buy_skin(request: BuySkinRequest, init_data: str, db: Session = Depend
     if existing_skin:
         raise HTTPException(status_code=400, detail="Skin already owned")
     
-    if user.balance < skin.price:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-    
-    # Покупаем скин
-    user.balance -= skin.price
-    user_skin = UserSkin(user_id=user.id, skin_id=request.skin_id)
-    
-    # Записываем покупку
-    purchase = Purchase(
-        user_id=user.id,
-        item_type="skin",
-        item_id=request.skin_id,
-        amount=skin.price
-    )
-    
-    db.add(user_skin)
-    db.add(purchase)
-    db.commit()
-    
-    return {"message": "Skin purchased successfully", "new_balance": user.balance}
+    price = skin.price
 
-@app.post("/api/skins/select")
-async def select_skin(skin_id: int, init_data: str, db: Session = Depends(get_db)):
+    def work(wdb: Session):
+        # Проверка выше - быстрый отказ; от гонки запросов из разных воркеров
+        # (блокировка пользователя - только в процессе) защищает уникальный индекс
+        if not grant_skin(wdb, user.id, request.skin_id):
+            raise HTTPException(status_code=400, detail="Skin already owned")
+        # Покупаем скин
+        balance = ledger.post(wdb, user.id, -price, "skin", ledger.SHOP_ACCOUNT,
+                              reference=str(request.skin_id), require_funds=True)
+        
+        # Записываем покупку
+        purchase = Purchase(
+            user_id=user.id,
+            item_type="skin",
+            item_id=request.skin_id,
+            amount=price
+        )
+        
+        wdb.add(purchase)
+        return {"message": "Skin purchased successfully", "new_balance": balance}
+
+    return await run_write(db, work)
+
+@app.post("/api/skins/select", dependencies=[Depends(query_audit.query_budget(6))])
+async def select_skin(skin_id: int, response: Response, user: User = Depends(get_locked_user),
+                      db: Session = Depends(get_db), if_match: Optional[str] = Header(None)):
     """Выбор текущего скина"""
-    user = get_current_user(init_data, db)
+    check_if_match(if_match, user_etag(user.version))
     
     # Проверяем, есть ли у пользователя этот скин
-    user_skin = db.query(UserSkin).filter(
+    user_skin = db.query(UserSkin.id).filter(
         UserSkin.user_id == user.id,
         UserSkin.skin_id == skin_id
     ).first()
     
-    skin = db.query(Skin).filter(Skin.id == skin_id).first()
+    skin = db.execute(_SKIN_IS_DEFAULT, {"skin_id": skin_id}).first()
     
     if not skin:
         raise HTTPException(status_code=404, detail="Skin not found")
@@ -392,21 +723,89 @@ async def select_skin(skin_id: int, init_data: str, db: Session = Depends(get_db
     if not user_skin and not skin.is_default:
         raise HTTPException(status_code=400, detail="Skin not owned")
     
-    user.current_skin_id = skin_id
-    db.commit()
+    user_id, version = user.id, user.version
+
+    def work(wdb: Session):
+        target = load_versioned(wdb, user_id, version)
+        target.current_skin_id = skin_id
+        wdb.flush()
+        return target.version
+
+    response.headers["ETag"] = user_etag(await run_write(db, work))
     
     return {"message": "Skin selected successfully"}
 
+# Drops and promo codes endpoints
+@app.get("/api/drops", response_model=List[DropResponse], dependencies=[Depends(query_audit.query_budget(2))])
+async def list_drops(db: Session = Depends(get_db)):
+    """Текущие и будущие лимитированные выпуски с остатком тиража"""
+    rows = db.execute(
+        select(Drop, Skin.name, Skin.color).join(Skin, Skin.id == Drop.skin_id)
+        .where(Drop.ends_at > datetime.utcnow()).order_by(Drop.starts_at, Drop.id)
+    ).all()
+    left = drops.remaining(db, [drops.drop_key(drop.id) for drop, _, _ in rows])
+    result = []
+    for drop, name, color in rows:
+        remaining = left.get(drops.drop_key(drop.id), 0)
+        if remaining == 0:
+            drops.sold_out.add(drops.drop_key(drop.id))
+        result.append(DropResponse(
+            id=drop.id, skin_id=drop.skin_id, name=name, color=color or "#FFFFFF", price=drop.price,
+            stock=drop.stock, remaining=remaining,
+            starts_at=drop.starts_at.isoformat(), ends_at=drop.ends_at.isoformat(),
+        ))
+    return result
+
+@app.post("/api/drops/{drop_id}/buy", dependencies=[Depends(query_audit.query_budget(10))])
+async def buy_drop(drop_id: int, user: User = Depends(get_locked_user), db: Session = Depends(get_db)):
+    """Покупка скина из лимитированного выпуска: не больше одного на пользователя"""
+    drop = db.execute(_DROP_BY_ID, {"drop_id": drop_id}).scalars().first()
+    if drop is None:
+        raise HTTPException(status_code=404, detail="Drop not found")
+    # Не начался, закончился, распродан - отказ без очереди писателя
+    drops.check_open(drops.drop_key(drop.id), drop.starts_at, drop.ends_at)
+    if db.execute(_SKIN_OWNED, {"user_id": user.id, "skin_id": drop.skin_id}).first():
+        raise HTTPException(status_code=400, detail="Skin already owned")
+
+    user_id = user.id
+    balance = await run_write(db, lambda wdb: drops.buy_drop(wdb, drop, user_id))
+    return {"message": "Skin purchased successfully", "new_balance": balance}
+
+@app.post("/api/promo/redeem", dependencies=[Depends(query_audit.query_budget(10))])
+async def redeem_promo(request: PromoRedeemRequest, user: User = Depends(get_locked_user),
+                       db: Session = Depends(get_db)):
+    """Активация промокода: листики и/или скин, один раз на пользователя"""
+    promo = db.execute(_PROMO_BY_CODE, {"code": drops.normalize_code(request.code)}).scalars().first()
+    if promo is None:
+        raise HTTPException(status_code=404, detail="Promo code not found")
+    drops.check_open(drops.promo_key(promo.id), None, promo.expires_at)
+    if promo.skin_id is not None and db.execute(_SKIN_OWNED, {"user_id": user.id, "skin_id": promo.skin_id}).first():
+        raise HTTPException(status_code=400, detail="Skin already owned")
+
+    user_id, balance = user.id, user.balance
+    new_balance = await run_write(db, lambda wdb: drops.redeem_promo(wdb, promo, user_id))
+    return {
+        "message": "Promo code redeemed",
+        "new_balance": new_balance if new_balance is not None else balance,
+        "skin_id": promo.skin_id,
+    }
+
 # Referrals endpoints
-@app.get("/api/referrals", response_model=List[ReferralResponse])
+@app.get("/api/referrals", response_model=List[ReferralResponse], dependencies=[Depends(query_audit.query_budget(2))])
 async def get_referrals(init_data: str, db: Session = Depends(get_db)):
     """Получение списка приглашенных пользователей"""
-    user = get_current_user(init_data, db)
-    referrals = db.query(Referral).filter(Referral.inviter_id == user.id).all()
+    user = await get_current_user(init_data, db, only=(User.id,))
+    # Приглашённые - одним JOIN, а не запросом на каждого
+    referrals = (
+        db.query(Referral)
+        .options(joinedload(Referral.invited, innerjoin=True).load_only(User.id, User.username, User.first_name))
+        .filter(Referral.inviter_id == user.id)
+        .all()
+    )
     
     result = []
     for ref in referrals:
-        invited_user = db.query(User).filter(User.id == ref.invited_id).first()
+        invited_user = ref.invited
         result.append(ReferralResponse(
             id=ref.id,
             invited_user={
@@ -420,10 +819,9 @@ async def get_referrals(init_data: str, db: Session = Depends(get_db)):
     
     return result
 
-@app.post("/api/referrals/apply")
-async def apply_referral(referral_code: str, init_data: str, db: Session = Depends(get_db)):
+@app.post("/api/referrals/apply", dependencies=[Depends(query_audit.query_budget(10))])
+async def apply_referral(referral_code: str, user: User = Depends(get_locked_user), db: Session = Depends(get_db)):
     """Применение реферального кода"""
-    user = get_current_user(init_data, db)
     
     # Извлекаем ID пригласившего из кода
     if not referral_code.startswith("ref"):
@@ -438,43 +836,44 @@ async def apply_referral(referral_code: str, init_data: str, db: Session = Depen
     if inviter_id == user.id:
         raise HTTPException(status_code=400, detail="Cannot refer yourself")
     
-    # Проверяем, что реферал уже не был применен
-    existing_referral = db.query(Referral).filter(
-        Referral.invited_id == user.id
-    ).first()
-    
-    if existing_referral:
-        raise HTTPException(status_code=400, detail="Referral already applied")
-    
-    # Создаем реферал
-    referral = Referral(inviter_id=inviter_id, invited_id=user.id)
-    db.add(referral)
-    
-    # Даем бонусы обоим пользователям
-    inviter = db.query(User).filter(User.id == inviter_id).first()
-    if inviter:
-        inviter.balance += 50  # Бонус за приглашение
-        inviter.referrals_count += 1
+    def work(wdb: Session):
+        # Проверяем, что реферал уже не был применен
+        existing_referral = wdb.query(Referral).filter(
+            Referral.invited_id == user.id
+        ).first()
+        
+        if existing_referral:
+            raise HTTPException(status_code=400, detail="Referral already applied")
+        
+        # Создаем реферал
+        referral = Referral(inviter_id=inviter_id, invited_id=user.id)
+        wdb.add(referral)
+        
+        # Даем бонусы обоим пользователям
+        inviter = wdb.query(User).filter(User.id == inviter_id).first()
+        if inviter:
+            ledger.post(wdb, inviter.id, 50, "referral_bonus", ledger.REFERRALS_ACCOUNT)  # Бонус за приглашение
+            inviter.referrals_count += 1
+            
+            # Записываем покупку
+            purchase = Purchase(
+                user_id=inviter.id,
+                item_type="referral_bonus",
+                amount=50
+            )
+            wdb.add(purchase)
+        
+        ledger.post(wdb, user.id, 25, "referral_bonus", ledger.REFERRALS_ACCOUNT)  # Бонус за регистрацию по рефералу
         
         # Записываем покупку
         purchase = Purchase(
-            user_id=inviter.id,
+            user_id=user.id,
             item_type="referral_bonus",
-            amount=50
+            amount=25
         )
-        db.add(purchase)
-    
-    user.balance += 25  # Бонус за регистрацию по рефералу
-    
-    # Записываем покупку
-    purchase = Purchase(
-        user_id=user.id,
-        item_type="referral_bonus",
-        amount=25
-    )
-    db.add(purchase)
-    
-    db.commit()
+        wdb.add(purchase)
+
+    await run_write(db, work)
     
     return {"message": "Referral applied successfully", "bonus": 25}
 
@@ -482,13 +881,13 @@ async def apply_referral(referral_code: str, init_data: str, db: Session = Depen
 @app.post("/api/payments/create")
 async def create_payment(request: CreatePaymentRequest, init_data: str, db: Session = Depends(get_db)):
     """Создание счета для пополнения баланса"""
-    user = get_current_user(init_data, db)
+    user = await get_current_user(init_data, db, only=(User.tg_id,))
     
     if request.amount < 10:
         raise HTTPException(status_code=400, detail="Minimum amount is 10 rubles")
     
     try:
-        invoice = payment_service.create_invoice(
+        invoice = get_payment_service().create_invoice(
             user_id=user.tg_id,
             title="Пополнение баланса",
             description=f"Пополнение баланса на {request.amount} листиков",
@@ -505,7 +904,7 @@ async def create_payment(request: CreatePaymentRequest, init_data: str, db: Sess
 async def payment_callback(payment: PaymentCallback, db: Session = Depends(get_db)):
     """Обработка успешного платежа"""
     try:
-        payment_data = payment_service.process_successful_payment(payment.dict())
+        payment_data = get_payment_service().process_successful_payment(payment.dict())
         
         # Извлекаем данные из payload
         payload_parts = payment_data["payload"].split("_")
@@ -514,21 +913,25 @@ async def payment_callback(payment: PaymentCallback, db: Session = Depends(get_d
             amount = int(payload_parts[2])
             
             # Обновляем баланс пользователя
-            user = db.query(User).filter(User.id == user_id).first()
+            user = db.query(User.id).filter(User.id == user_id).first()
             if user:
-                user.balance += amount
-                
-                # Записываем покупку
-                purchase = Purchase(
-                    user_id=user.id,
-                    item_type="balance",
-                    amount=amount,
-                    payment_id=payment_data["payment_id"]
-                )
-                db.add(purchase)
-                db.commit()
+                def work(wdb: Session):
+                    balance = ledger.post(wdb, user_id, amount, "balance", ledger.PAYMENTS_ACCOUNT,
+                                          reference=payment_data["payment_id"])
+                    
+                    # Записываем покупку
+                    purchase = Purchase(
+                        user_id=user_id,
+                        item_type="balance",
+                        amount=amount,
+                        payment_id=payment_data["payment_id"]
+                    )
+                    wdb.add(purchase)
+                    return balance
+
+                balance = await run_write(db, work)
                 
-                return {"status": "success", "new_balance": user.balance}
+                return {"status": "success", "new_balance": balance}
         
         return {"status": "error", "message": "Invalid payload"}
         
@@ -536,26 +939,22 @@ async def payment_callback(payment: PaymentCallback, db: Session = Depends(get_d
         raise HTTPException(status_code=400, detail=str(e))
 
 # Custom texts endpoints
-@app.get("/api/custom-texts")
-async def get_custom_texts(init_data: str, db: Session = Depends(get_db)):
+@app.get("/api/custom-texts", dependencies=[Depends(query_audit.query_budget(1))])
+async def get_custom_texts(init_data: str, db: Session = Depends(get_db),
+                           if_none_match: Optional[str] = Header(None)):
     """Получение кастомных текстов пользователя"""
-    user = get_current_user(init_data, db)
-    
-    custom_texts = []
-    if user.custom_texts:
-        try:
-            custom_texts = json.loads(user.custom_texts)
-        except:
-            custom_texts = ["любит", "не любит"]
-    else:
-        custom_texts = ["любит", "не любит"]
+    user = await get_current_user(init_data, db, only=(User.text_set_id, User.version))
+    etag = user_etag(user.version)
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
     
-    return {"texts": custom_texts}
+    return JSONResponse({"texts": list(text_cache.get(db, user.text_set_id))}, headers={"ETag": etag})
 
-@app.post("/api/custom-texts")
-async def update_custom_texts(request: CustomTextRequest, init_data: str, db: Session = Depends(get_db)):
+@app.post("/api/custom-texts", dependencies=[Depends(query_audit.query_budget(6))])
+async def update_custom_texts(request: CustomTextRequest, response: Response, user: User = Depends(get_locked_user),
+                              db: Session = Depends(get_db), if_match: Optional[str] = Header(None)):
     """Обновление кастомных текстов пользователя"""
-    user = get_current_user(init_data, db)
+    check_if_match(if_match, user_etag(user.version))
     
     # Проверяем количество текстов (максимум 3 бесплатно)
     if len(request.texts) > 3:
@@ -567,24 +966,223 @@ async def update_custom_texts(request: CustomTextRequest, init_data: str, db: Se
             raise HTTPException(status_code=400, detail="Text too long (max 20 characters)")
         if len(text.strip()) == 0:
             raise HTTPException(status_code=400, detail="Text cannot be empty")
+    if blocklist.check(request.texts):
+        raise HTTPException(status_code=400, detail="Text contains blocked words")
     
     # Обновляем тексты
-    user.custom_texts = json.dumps(request.texts)
-    db.commit()
+    user_id, version = user.id, user.version
+
+    def work(wdb: Session):
+        target = load_versioned(wdb, user_id, version)
+        target.text_set_id = text_cache.intern(wdb, request.texts)
+        wdb.flush()
+        return target.version
+
+    response.headers["ETag"] = user_etag(await run_write(db, work))
+    preset_stats.record(texts=request.texts)
     
     return {"message": "Custom texts updated successfully", "texts": request.texts}
 
 class SaveResultRequest(BaseModel):
     text: str
 
-@app.post("/api/results")
+@app.post("/api/results", dependencies=[Depends(query_audit.query_budget(2))])
 async def save_result(request: SaveResultRequest, init_data: str, db: Session = Depends(get_db)):
-    user = get_current_user(init_data, db)
-    result = Result(user_id=user.id, result_text=request.text)
-    db.add(result)
+    user = await get_current_user(init_data, db, only=(User.id,))
+
+    def work(wdb: Session):
+        result = Result(user_id=user.id, result_text=request.text)
+        wdb.add(result)
+        wdb.flush()
+        return {"id": result.id, "result_text": result.result_text, "created_at": result.created_at.isoformat()}
+
+    return await run_write(db, work)
+
+# Share card endpoints
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# /api/share-card рисует по текущему скину пользователя: тот же URL после смены
+# скина - другая картинка, поэтому каждый раз сверка по ETag (дёшево - 304)
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+def share_card_response(digest: str, path: str, cache_control: str) -> FileResponse:
+    return FileResponse(path, media_type="image/png", headers={
+        "ETag": f'"{digest}"',
+        "Cache-Control": cache_control,
+        "Content-Location": f"/api/share-card/{digest}.png",
+    })
+
+@app.get("/api/share-card", dependencies=[Depends(query_audit.query_budget(2))])
+async def get_share_card(init_data: str, text: str = "любит / не любит", db: Session = Depends(get_db),
+                         if_none_match: Optional[str] = Header(None)):
+    """PNG-карточка результата; Content-Location - постоянная ссылка на неё"""
+    text = text.strip()
+    if not text or len(text) > 40:
+        raise HTTPException(status_code=400, detail="Text must be 1-40 characters")
+    if blocklist.check([text]):
+        raise HTTPException(status_code=400, detail="Text contains blocked words")
+    user = await get_current_user(init_data, db, only=(User.username, User.first_name, User.current_skin_id))
+    color = None
+    if user.current_skin_id:
+        color = db.execute(_SKIN_COLOR, {"skin_id": user.current_skin_id}).scalar()
+    db.commit()  # Соединение пула не держим, пока рисуется картинка
+    color = color or share_card.DEFAULT_COLOR
+    username = f"@{user.username}" if user.username else (user.first_name or "").strip()
+
+    digest = share_card.card_digest(text, color, username)
+    if if_none_match == f'"{digest}"':
+        return Response(status_code=304, headers={"ETag": f'"{digest}"', "Cache-Control": REVALIDATE_CACHE_CONTROL})
+    digest, path = await share_cards.get(text, color, username)
+    return share_card_response(digest, path, REVALIDATE_CACHE_CONTROL)
+
+@app.get("/api/share-card/{digest}.png")
+async def get_share_card_file(digest: str, if_none_match: Optional[str] = Header(None)):
+    """Уже нарисованная карточка по хэшу: содержимое не меняется, кэшируется навсегда"""
+    if len(digest) != 64 or any(char not in "0123456789abcdef" for char in digest):
+        raise HTTPException(status_code=404, detail="Card not found")
+    if if_none_match == f'"{digest}"':
+        return Response(status_code=304, headers={"ETag": f'"{digest}"', "Cache-Control": IMMUTABLE_CACHE_CONTROL})
+    path = share_cards.path_for(digest)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Card not found")
+    return share_card_response(digest, path, IMMUTABLE_CACHE_CONTROL)
+
+# Skin asset endpoints
+@app.get("/api/skin-assets/{name}")
+async def get_skin_asset(name: str):
+    """Вариант или спрайт-лист скина; имя содержит хэш содержимого"""
+    if not re.fullmatch(r"(skin-\d+|sprite)-\d+-[0-9a-f]{12}\.png", name):
+        raise HTTPException(status_code=404, detail="Asset not found")
+    path = os.path.join(skin_images.asset_dir, name)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Asset not found")
+    return FileResponse(path, media_type="image/png", headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL})
+
+# Debug endpoints (нужен X-Admin-Token)
+@app.get("/api/debug/traces", dependencies=[Depends(require_admin)])
+async def list_traces(limit: int = 50):
+    """Последние записанные трассы, без спанов"""
+    return {"traces": [
+        {key: trace[key] for key in ("trace_id", "name", "start", "duration_ms")} | {"spans": len(trace["spans"])}
+        for trace in tracing.recent(max(1, min(limit, 200)))
+    ]}
+
+@app.get("/api/debug/traces/{trace_id}", dependencies=[Depends(require_admin)])
+async def get_trace(trace_id: str):
+    trace = tracing.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return trace
+
+@app.get("/api/debug/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles(limit: int = 20):
+    """Последние профили запросов с X-Profile: 1"""
+    return {"profiles": profiling.recent(max(1, min(limit, 100)))}
+
+@app.get("/api/debug/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def get_profile(profile_id: str, format: str = "text"):
+    """Отчёт pstats текстом или сырой .prof (format=prof) для snakeviz/flamegraph"""
+    profile = profiling.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "prof":
+        return Response(profile["stats"], media_type="application/octet-stream",
+                        headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'})
+    return PlainTextResponse(profiling.render_text(profile))
+
+@app.get("/api/debug/loop-blocks", dependencies=[Depends(require_admin)])
+async def list_loop_blocks(limit: int = 20):
+    """Последние блокировки event loop со стеком блокирующего кода"""
+    return {"blocks": loop_monitor.recent(max(1, min(limit, 50)))}
+
+@app.get("/api/debug/startup", dependencies=[Depends(require_admin)])
+async def get_startup_report():
+    """Время холодного старта: импорты, фазы, первый ответ"""
+    return startup_timing.report()
+
+@app.post("/api/debug/blocklist/reload", dependencies=[Depends(require_admin)])
+async def reload_blocklist():
+    """
+    Перечитывает BLOCKLIST_FILE и проверяет все сохранённые наборы текстов.
+    Пользователи с запрещённым набором возвращаются к дефолтным текстам.
+    """
+    blocklist.reload(force=True)
+    flagged = await asyncio.to_thread(lambda: [set_id for set_id, _ in blocklist.rescan()])
+
+    def work(wdb: Session) -> int:
+        reset = 0
+        for start in range(0, len(flagged), 500):
+            reset += wdb.execute(
+                update(User).where(User.text_set_id.in_(flagged[start:start + 500]))
+                .values(text_set_id=None, version=User.version + 1),
+                execution_options={"synchronize_session": False},
+            ).rowcount
+        return reset
+
+    users_reset = await db_writer.run(work) if flagged else 0
+    return {"terms": blocklist.automaton.size, "blocked_text_sets": len(flagged), "users_reset": users_reset}
+
+@app.post("/api/debug/skin-assets/rebuild", dependencies=[Depends(require_admin)])
+async def rebuild_skin_assets(force: bool = False, db: Session = Depends(get_db)):
+    """Пересобирает картинки изменившихся скинов (force - всех) и спрайт-листы"""
+    skins = db.execute(select(Skin.id, Skin.color)).all()
     db.commit()
-    db.refresh(result)
-    return {"id": result.id, "result_text": result.result_text, "created_at": result.created_at.isoformat()}
+    changed = await asyncio.to_thread(skin_images.build, skins, force)
+    updated = await db_writer.run(lambda wdb: skin_assets.sync_image_urls(wdb, skin_images))
+    return {"skins": len(skins), "rendered": changed, "image_urls_updated": updated}
+
+@app.post("/api/debug/drops", dependencies=[Depends(require_admin)])
+async def create_drop(request: DropCreateRequest, db: Session = Depends(get_db)):
+    """Новый лимитированный выпуск; тираж делится на shards строк-счётчиков"""
+    starts_at, ends_at = utc_naive(request.starts_at), utc_naive(request.ends_at)
+    if request.stock < 1 or request.price < 0 or not 1 <= request.shards <= 64 or ends_at <= starts_at:
+        raise HTTPException(status_code=400, detail="Need stock >= 1, price >= 0, shards 1-64, ends_at > starts_at")
+    skin = db.execute(_SKIN_IS_DEFAULT, {"skin_id": request.skin_id}).first()
+    if skin is None:
+        raise HTTPException(status_code=404, detail="Skin not found")
+    if skin.is_default:
+        raise HTTPException(status_code=400, detail="Default skins are owned by everyone")
+
+    def work(wdb: Session) -> int:
+        drop = Drop(skin_id=request.skin_id, price=request.price, stock=request.stock, shards=request.shards,
+                    starts_at=starts_at, ends_at=ends_at)
+        wdb.add(drop)
+        wdb.flush()
+        drops.create_counter(wdb, drops.drop_key(drop.id), request.stock, request.shards)
+        return drop.id
+
+    return {"id": await run_write(db, work)}
+
+@app.post("/api/debug/promo-codes", dependencies=[Depends(require_admin)])
+async def create_promo_code(request: PromoCodeCreateRequest, db: Session = Depends(get_db)):
+    """Новый промокод на листики и/или скин"""
+    code = drops.normalize_code(request.code)
+    if not code or request.max_redemptions < 1 or not 1 <= request.shards <= 64:
+        raise HTTPException(status_code=400, detail="Need a code, max_redemptions >= 1, shards 1-64")
+    if not request.amount and request.skin_id is None:
+        raise HTTPException(status_code=400, detail="Promo code needs amount or skin_id")
+    if request.amount is not None and request.amount < 0:
+        raise HTTPException(status_code=400, detail="Amount must be positive")
+    if request.skin_id is not None:
+        skin = db.execute(_SKIN_IS_DEFAULT, {"skin_id": request.skin_id}).first()
+        if skin is None:
+            raise HTTPException(status_code=404, detail="Skin not found")
+        if skin.is_default:
+            raise HTTPException(status_code=400, detail="Default skins are owned by everyone")
+
+    def work(wdb: Session) -> int:
+        promo = PromoCode(code=code, amount=request.amount, skin_id=request.skin_id,
+                          max_redemptions=request.max_redemptions, shards=request.shards,
+                          expires_at=utc_naive(request.expires_at))
+        try:
+            with wdb.begin_nested():
+                wdb.add(promo)
+                wdb.flush()
+        except IntegrityError:
+            raise HTTPException(status_code=409, detail="Promo code already exists")
+        drops.create_counter(wdb, drops.promo_key(promo.id), request.max_redemptions, request.shards)
+        return promo.id
+
+    return {"id": await run_write(db, work), "code": code}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
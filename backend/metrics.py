@@ -0,0 +1,306 @@
+"""
+Метрики процесса в формате Prometheus (GET /metrics).
+
+Запись без блокировок: у каждого потока свой шард со счётчиками (event
+loop, поток-писатель, потоки threadpool), инкремент - обычная операция со
+словарём своего потока. Блокировка берётся только при появлении нового
+потока и при чтении /metrics, который суммирует шарды. Поэтому сбор
+можно держать включённым постоянно.
+
+/metrics наружу не проксируется (nginx отдаёт бэкенду только /api/).
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+class _Shard:
+    __slots__ = ("values", "histograms")
+
+    def __init__(self):
+        self.values: Dict[Tuple[str, Labels], float] = {}
+        # [счётчики по корзинам..., +Inf, сумма]
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+
+
+class Registry:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: List[_Shard] = []
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, "_Metric"] = {}
+
+    def shard(self) -> _Shard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def register(self, metric: "_Metric") -> "_Metric":
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            shards = list(self._shards)
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            metric.render(shards, lines)
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, registry: Registry, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def _merged(self, shards: List[_Shard]) -> Dict[Labels, float]:
+        merged: Dict[Labels, float] = {}
+        for shard in shards:
+            for (name, labels), value in list(shard.values.items()):
+                if name == self.name:
+                    merged[labels] = merged.get(labels, 0) + value
+        return merged
+
+    def render(self, shards: List[_Shard], lines: List[str]) -> None:
+        for labels, value in sorted(self._merged(shards).items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        values = self.registry.shard().values
+        key = (self.name, labels)
+        values[key] = values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    """Сумма по шардам: inc в одном потоке и dec в другом дают верный итог."""
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class GaugeCallback(_Metric):
+    """Значение читается при каждом запросе /metrics (размер очереди, пула и т.п.)."""
+    kind = "gauge"
+
+    def __init__(self, registry: Registry, name: str, help: str, fn: Callable[[], float]):
+        super().__init__(registry, name, help)
+        self.fn = fn
+
+    def render(self, shards: List[_Shard], lines: List[str]) -> None:
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        lines.append(f"{self.name} {_format_value(value)}")
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry: Registry, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str) -> None:
+        histograms = self.registry.shard().histograms
+        key = (self.name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self, shards: List[_Shard], lines: List[str]) -> None:
+        merged: Dict[Labels, List[float]] = {}
+        for shard in shards:
+            for (name, labels), counts in list(shard.histograms.items()):
+                if name != self.name:
+                    continue
+                total = merged.setdefault(labels, [0] * len(counts))
+                for i, value in enumerate(counts):
+                    total[i] += value
+        for labels, counts in sorted(merged.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} "
+                             f"{_format_value(cumulative)}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{label_str} {_format_value(cumulative)}")
+
+
+registry = Registry()
+
+http_requests = Counter(registry, "http_requests_total", "HTTP requests by route and status",
+                        ("method", "route", "status"))
+http_latency = Histogram(registry, "http_request_duration_seconds", "HTTP request latency",
+                         ("method", "route"))
+http_in_flight = Gauge(registry, "http_requests_in_flight", "HTTP requests being processed")
+auth_verify = Histogram(registry, "auth_verify_seconds", "Telegram initData verification time", ("result",),
+                        buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01))
+sql_statements = Counter(registry, "sql_statements_total", "SQL statements executed", ("route",))
+sql_duration = Histogram(registry, "sql_statement_duration_seconds", "SQL statement execution time",
+                         ("route",), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                                              0.05, 0.1, 0.25, 1.0))
+sql_per_request = Histogram(registry, "sql_statements_per_request", "SQL statements per HTTP request",
+                            ("route",), buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 100))
+pool_wait = Histogram(registry, "db_pool_checkout_seconds", "Time to check out a pooled connection",
+                      buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+cache_requests = Counter(registry, "cache_requests_total", "Cache lookups by result", ("cache", "result"))
+
+
+_routes: Dict[Callable, str] = {}
+
+
+def route_of(scope) -> str:
+    """Шаблон маршрута (/api/user/{user_id}) по endpoint, который роутер кладёт в scope."""
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "<unmatched>"
+    route = _routes.get(endpoint)
+    if route is None:
+        for candidate in scope["app"].routes:
+            if getattr(candidate, "endpoint", None) is not None:
+                _routes[candidate.endpoint] = candidate.path
+        route = _routes.get(endpoint, "<unmatched>")
+    return route
+
+
+class RequestStats:
+    """Счётчики одного запроса. Маршрут известен только после роутинга, поэтому вычисляется по scope."""
+    __slots__ = ("scope", "sql_count", "sql_seconds")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+
+    @property
+    def route(self) -> str:
+        return route_of(self.scope)
+
+
+# Запрос, в контексте которого идёт SQL; писатель получает его через copy_context
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def instrument_engine(engine) -> None:
+    """SQL-метрики через события курсора и время ожидания соединения пула."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info["metrics_started"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("metrics_started", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        stats = current_request.get()
+        if stats is not None:
+            stats.sql_count += 1
+            stats.sql_seconds += elapsed
+            route = stats.route
+        else:
+            route = "<background>"
+        sql_statements.inc(route)
+        sql_duration.observe(elapsed, route)
+
+    instrument_pool(engine.pool)
+
+
+def instrument_pool(pool) -> None:
+    """
+    Время ожидания соединения пула. Привязано к объекту пула, поэтому после
+    engine.dispose() (новый пул, например в воркере после fork) вызывается снова.
+    """
+    # У пула нет события "до checkout", поэтому оборачиваем сам connect
+    connect = pool.connect
+
+    def timed_connect():
+        started = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            pool_wait.observe(time.perf_counter() - started)
+
+    pool.connect = timed_connect
+
+
+class MetricsMiddleware:
+    """
+    Чистый ASGI middleware (без BaseHTTPMiddleware и его лишней задачи на
+    запрос). Маршрут в метках - шаблон пути, чтобы число серий не зависело
+    от параметров.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec()
+            current_request.reset(token)
+            route = stats.route
+            http_requests.inc(scope["method"], route, str(status))
+            http_latency.observe(elapsed, scope["method"], route)
+            sql_per_request.observe(stats.sql_count, route)
@@ -3,6 +3,8 @@ import json
 from typing import Dict, Any, Optional
 from fastapi import HTTPException
 
+import tracing
+
 class TelegramPaymentService:
     def __init__(self, bot_token: str, provider_token: str):
         self.bot_token = bot_token
@@ -30,7 +32,8 @@ class TelegramPaymentService:
                 "prices": [{"label": title, "amount": price_amount}]
             }
             
-            response = requests.post(url, json=data)
+            with tracing.span("telegram.sendInvoice"):
+                response = requests.post(url, json=data)
             response.raise_for_status()
             
             return response.json()
@@ -0,0 +1,206 @@
+"""
+Каталог пресетов текстов и их популярность.
+
+Каталог - константа процесса: тело ответа и ETag считаются один раз при
+импорте, GET /api/presets отдаёт готовые байты или 304.
+
+Популярность считается потоково, без сканирования users: PresetStats
+держит по скетчу Space-Saving для ключей пресетов (set_preset) и для
+наборов кастомных текстов (update_custom_texts). У скетча фиксированное
+число счётчиков; любой элемент, встретившийся чаще N/capacity раз из N,
+гарантированно в нём есть, а счёт завышен не больше чем на error.
+
+Раз в snapshot_interval секунд верхушка скетчей копируется в снимок,
+который и отдаёт GET /api/presets/popular (с ETag).
+
+Если задан PRESET_STATS_FILE, в нём общий для всех воркеров скетч.
+Воркер копит только приращения с прошлого снимка и при снимке под flock
+(PRESET_STATS_FILE.lock) вливает их в файл: скетчи Space-Saving
+складываются (счета и ошибки суммируются, остаются capacity старших).
+Снимок строится по общему скетчу, так что любой воркер отдаёт сводку по
+всем, а перезапуск воркера ничего не обнуляет и не считает дважды.
+Остальные методы вызываются из потока event loop и блокировок не требуют.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from database import text_set_json
+
+logger = logging.getLogger("presets")
+
+PRESET_STATS_FILE = os.getenv("PRESET_STATS_FILE", "")
+
+PRESETS = [
+    {"key": "preset_0", "texts": ["любит", "не любит"]},
+    {"key": "preset_1", "texts": ["купить", "не покупать"]},
+    {"key": "preset_2", "texts": ["позвонит", "не позвонит"]},
+]
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+
+
+CATALOG_BODY = json.dumps({"presets": PRESETS}, ensure_ascii=False).encode()
+CATALOG_ETAG = _etag(CATALOG_BODY)
+
+
+class SpaceSaving:
+    """
+    Top-k по потоку (Metwally et al.) в capacity счётчиках. Новый элемент при
+    заполненном скетче вытесняет минимальный и наследует его счёт как ошибку.
+    Минимум ищется перебором: при capacity в сотни это дешевле кучи.
+    """
+
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self.counters: Dict[str, List[int]] = {}  # элемент -> [счёт, ошибка]
+
+    def add(self, item: str, count: int = 1) -> None:
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += count
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[item] = [count, 0]
+            return
+        victim = min(self.counters, key=lambda key: self.counters[key][0])
+        floor = self.counters.pop(victim)[0]
+        self.counters[item] = [floor + count, floor]
+
+    def merge(self, other: "SpaceSaving") -> None:
+        """Сложение скетчей: счета и ошибки суммируются, остаются capacity старших."""
+        for item, (count, error) in other.counters.items():
+            counter = self.counters.setdefault(item, [0, 0])
+            counter[0] += count
+            counter[1] += error
+        if len(self.counters) > self.capacity:
+            ranked = sorted(self.counters.items(), key=lambda entry: -entry[1][0])[:self.capacity]
+            self.counters = dict(ranked)
+
+    def top(self, n: int) -> List[Tuple[str, int, int]]:
+        """(элемент, счёт, ошибка) по убыванию счёта."""
+        ranked = sorted(self.counters.items(), key=lambda entry: -entry[1][0])[:n]
+        return [(item, count, error) for item, (count, error) in ranked]
+
+
+class PresetStats:
+    def __init__(self, capacity: int = 256, top_n: int = 20, snapshot_interval: float = 60.0,
+                 path: str = PRESET_STATS_FILE):
+        self.capacity = capacity
+        # С файлом - приращения этого воркера с прошлого снимка, без файла - вся статистика
+        self.presets = SpaceSaving(capacity)
+        self.texts = SpaceSaving(capacity)
+        self.top_n = top_n
+        self.snapshot_interval = snapshot_interval
+        self.path = path
+        self.body = b'{"presets": [], "texts": []}'
+        self.etag = _etag(self.body)
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, key: Optional[str] = None, texts: Optional[Sequence[str]] = None) -> None:
+        if key:
+            self.presets.add(key)
+        if texts is not None:
+            self.texts.add(text_set_json(texts))
+
+    def snapshot(self, presets: Optional[SpaceSaving] = None, texts: Optional[SpaceSaving] = None) -> Dict[str, Any]:
+        presets = self.presets if presets is None else presets
+        texts = self.texts if texts is None else texts
+        return {
+            "generated_at": int(time.time()),
+            "presets": [{"key": key, "count": count, "error": error}
+                        for key, count, error in presets.top(self.top_n)],
+            "texts": [{"texts": json.loads(item), "count": count, "error": error}
+                      for item, count, error in texts.top(self.top_n)],
+        }
+
+    async def take_snapshot(self) -> None:
+        if self.path:
+            # Приращения забираются в потоке цикла: record() дальше пишет уже в новые скетчи
+            presets, texts = self.presets, self.texts
+            self.presets, self.texts = SpaceSaving(self.capacity), SpaceSaving(self.capacity)
+            try:
+                data = await asyncio.to_thread(self._merge, presets, texts)
+            except Exception:
+                # Вернуть приращения, чтобы их влил следующий снимок
+                presets.merge(self.presets)
+                texts.merge(self.texts)
+                self.presets, self.texts = presets, texts
+                raise
+        else:
+            data = self.snapshot()
+        self.body = json.dumps(data, ensure_ascii=False).encode()
+        self.etag = _etag(self.body)
+
+    def _merge(self, presets: SpaceSaving, texts: SpaceSaving) -> Dict[str, Any]:
+        """Вливает приращения в общий файл под flock; снимок по общему скетчу."""
+        try:
+            import fcntl
+        except ImportError:
+            # Windows: там запускается один процесс (python main.py), делить файл не с кем
+            fcntl = None
+        with open(self.path + ".lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                shared_presets, shared_texts = self._load()
+                shared_presets.merge(presets)
+                shared_texts.merge(texts)
+                if presets.counters or texts.counters or not os.path.exists(self.path):
+                    self._save({"presets": shared_presets.counters, "texts": shared_texts.counters})
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return self.snapshot(shared_presets, shared_texts)
+
+    def _save(self, data: Dict[str, Any]) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def _load(self) -> Tuple[SpaceSaving, SpaceSaving]:
+        presets, texts = SpaceSaving(self.capacity), SpaceSaving(self.capacity)
+        try:
+            with open(self.path, "rb") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return presets, texts
+        if isinstance(data.get("presets"), list):
+            # Прежний формат - сам снимок: верхушка, счета без ошибок
+            for entry in data["presets"]:
+                presets.add(entry["key"], entry["count"])
+            for entry in data.get("texts", []):
+                texts.add(text_set_json(entry["texts"]), entry["count"])
+            return presets, texts
+        presets.counters = {item: list(counter) for item, counter in data.get("presets", {}).items()}
+        texts.counters = {item: list(counter) for item, counter in data.get("texts", {}).items()}
+        return presets, texts
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._snapshot_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.take_snapshot()
+
+    async def _snapshot_periodically(self) -> None:
+        while True:
+            try:
+                await self.take_snapshot()
+            except Exception:
+                logger.exception("Error taking preset stats snapshot")
+            await asyncio.sleep(self.snapshot_interval)
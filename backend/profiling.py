@@ -0,0 +1,136 @@
+"""
+Профилирование одного запроса по заголовку.
+
+Запрос с X-Profile: 1 и верным X-Admin-Token выполняется под cProfile.
+Результат (pstats) хранится в кольцевом буфере на PROFILE_BUFFER штук,
+его id приходит в заголовке ответа X-Profile-Id. Если задан PROFILE_DIR,
+профиль ещё и пишется туда файлом <id>.prof (snakeviz, gprof2dot).
+
+GET /api/debug/profiles/{id} - текстовый отчёт по cumulative time,
+?format=prof - сырой pstats для построения call-tree или flamegraph.
+
+Обычные запросы только просматривают заголовки: cProfile и pstats
+импортируются при первом профилируемом запросе. Профайлер работает на
+потоке event loop, поэтому в профиль попадают и корутины других запросов,
+выполнявшихся в то же время, но не код в потоке-писателе и threadpool.
+Одновременно профилируется только один запрос, остальные с X-Profile
+выполняются как обычно (без X-Profile-Id).
+"""
+import io
+import marshal
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from admin_auth import is_admin_token
+from metrics import route_of
+
+BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER", "20"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+
+_buffer: "deque[Dict[str, Any]]" = deque(maxlen=BUFFER_SIZE)
+_buffer_lock = threading.Lock()
+_active = False
+
+
+def recent(limit: int = 20) -> List[Dict[str, Any]]:
+    """Последние профили без самих данных."""
+    with _buffer_lock:
+        profiles = list(_buffer)
+    return [{key: value for key, value in profile.items() if key != "stats"} for profile in profiles[-limit:][::-1]]
+
+
+def get(profile_id: str) -> Optional[Dict[str, Any]]:
+    with _buffer_lock:
+        for profile in _buffer:
+            if profile["profile_id"] == profile_id:
+                return profile
+    return None
+
+
+def render_text(profile: Dict[str, Any], limit: int = 60) -> str:
+    import pstats
+
+    stream = io.StringIO()
+    stats = pstats.Stats(_StatsSource(profile["stats"]), stream=stream)
+    stats.sort_stats("cumulative").print_stats(limit)
+    stats.print_callees(limit)
+    return stream.getvalue()
+
+
+class _StatsSource:
+    """pstats.Stats принимает объект с create_stats()/stats - так же, как cProfile.Profile."""
+
+    def __init__(self, raw: bytes):
+        self.stats = marshal.loads(raw)
+
+    def create_stats(self) -> None:
+        pass
+
+
+def _wants_profile(scope) -> bool:
+    flag = token = None
+    for name, value in scope["headers"]:
+        if name == b"x-profile":
+            flag = value
+        elif name == b"x-admin-token":
+            token = value
+    return flag == b"1" and token is not None and is_admin_token(token)
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _active
+        if scope["type"] != "http" or _active or not _wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        import cProfile
+        import pstats
+
+        _active = True
+        profile_id = uuid.uuid4().hex
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        profiler = cProfile.Profile()
+        start = time.time()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - started
+            _active = False
+            raw = marshal.dumps(pstats.Stats(profiler).stats)
+            _store({
+                "profile_id": profile_id,
+                "name": f'{scope["method"]} {route_of(scope)}',
+                "path": scope["path"],
+                "status": status,
+                "start": start,
+                "duration_ms": round(elapsed * 1000, 3),
+                "stats": raw,
+            })
+
+
+def _store(profile: Dict[str, Any]) -> None:
+    with _buffer_lock:
+        _buffer.append(profile)
+    if PROFILE_DIR:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f'{profile["profile_id"]}.prof'), "wb") as f:
+            f.write(profile["stats"])
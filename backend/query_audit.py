@@ -0,0 +1,165 @@
+"""
+Аудит SQL на уровне движка: медленные запросы, N+1 и бюджет запросов.
+
+- Запрос дольше SLOW_QUERY_MS пишется в лог вместе с EXPLAIN QUERY PLAN
+  (план снимается тем же DBAPI-соединением, сразу после выполнения).
+- Внутри HTTP-запроса считаются выполненные SQL; одинаковый текст
+  выражения, повторённый N_PLUS_ONE_THRESHOLD раз и больше (отличаются
+  только параметры), помечается как N+1.
+- Маршрут объявляет бюджет: dependencies=[Depends(query_budget(3))].
+  Превышение пишется в лог, а при QUERY_AUDIT_STRICT=1 (тесты) запрос
+  падает с QueryBudgetExceeded на первом лишнем выражении.
+
+BEGIN/SAVEPOINT/RELEASE и прочее управление транзакциями не считаются, как
+и разовая работа в блоке unbudgeted() (регистрация нового пользователя).
+Работа, отданная писателю, учитывается в запросе-источнике: WriteQueue
+выполняет её в копии контекста вызывающего.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, Optional
+
+from metrics import Counter, registry, route_of
+
+logger = logging.getLogger("query_audit")
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "5"))
+STRICT = os.getenv("QUERY_AUDIT_STRICT", "0") == "1"
+
+_TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "PRAGMA")
+_EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+slow_queries = Counter(registry, "sql_slow_queries_total", "Statements slower than SLOW_QUERY_MS", ("route",))
+repeated_statements = Counter(registry, "sql_repeated_statements_total",
+                              "Requests with a statement repeated N_PLUS_ONE_THRESHOLD+ times (N+1)", ("route",))
+budget_exceeded = Counter(registry, "sql_query_budget_exceeded_total",
+                          "Requests over their declared query budget", ("route",))
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestAudit:
+    __slots__ = ("scope", "count", "budget", "statements")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.count = 0
+        self.budget: Optional[int] = None
+        self.statements: Dict[str, int] = {}
+
+    @property
+    def route(self) -> str:
+        return route_of(self.scope)
+
+
+current_audit: ContextVar[Optional[RequestAudit]] = ContextVar("current_audit", default=None)
+_unbudgeted: ContextVar[bool] = ContextVar("unbudgeted", default=False)
+
+
+def query_budget(limit: int) -> Callable[[], None]:
+    """Зависимость маршрута: не больше limit SQL-выражений на запрос."""
+    def declare_budget() -> None:
+        audit = current_audit.get()
+        if audit is not None:
+            audit.budget = limit
+    return declare_budget
+
+
+@contextmanager
+def unbudgeted() -> Iterator[None]:
+    """SQL внутри блока (и отданный из него писателю) не входит в бюджет маршрута."""
+    token = _unbudgeted.set(True)
+    try:
+        yield
+    finally:
+        _unbudgeted.reset(token)
+
+
+def _is_transaction_control(statement: str) -> bool:
+    return statement.lstrip()[:9].upper().startswith(_TRANSACTION_CONTROL)
+
+
+def _explain(cursor, statement: str, parameters) -> str:
+    try:
+        plan_cursor = cursor.connection.cursor()
+        try:
+            plan_cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            return "\n".join(f"  {row[-1]}" for row in plan_cursor.fetchall())
+        finally:
+            plan_cursor.close()
+    except Exception as e:
+        return f"  (no plan: {e})"
+
+
+def instrument_engine(engine) -> None:
+    from sqlalchemy import event
+
+    explain = engine.dialect.name == "sqlite"
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info["audit_started"] = time.perf_counter()
+        audit = current_audit.get()
+        if audit is None or _unbudgeted.get() or _is_transaction_control(statement):
+            return
+        audit.count += 1
+        audit.statements[statement] = audit.statements.get(statement, 0) + 1
+        if STRICT and audit.budget is not None and audit.count > audit.budget:
+            raise QueryBudgetExceeded(
+                f"{audit.route}: statement #{audit.count} exceeds query budget {audit.budget}: {statement}"
+            )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("audit_started", None)
+        if started is None:
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms < SLOW_QUERY_MS:
+            return
+        audit = current_audit.get()
+        route = audit.route if audit is not None else "<background>"
+        slow_queries.inc(route)
+        plan = ""
+        if explain and not executemany and statement.lstrip()[:6].upper().startswith(_EXPLAINABLE):
+            plan = "\n" + _explain(cursor, statement, parameters)
+        logger.warning("slow query %.1fms in %s: %s%s", elapsed_ms, route, " ".join(statement.split()), plan)
+
+
+def finish(audit: RequestAudit) -> None:
+    """Итог запроса: N+1 и бюджет (в нестрогом режиме) - в лог."""
+    route = audit.route
+    repeated = [(statement, count) for statement, count in audit.statements.items()
+                if count >= N_PLUS_ONE_THRESHOLD]
+    if repeated:
+        repeated_statements.inc(route)
+    for statement, count in repeated:
+        logger.warning("possible N+1 in %s: statement executed %d times: %s",
+                       route, count, " ".join(statement.split()))
+    if audit.budget is not None and audit.count > audit.budget:
+        budget_exceeded.inc(route)
+        if not STRICT:
+            logger.warning("%s executed %d statements, budget is %d", route, audit.count, audit.budget)
+
+
+class QueryAuditMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        audit = RequestAudit(scope)
+        token = current_audit.set(audit)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_audit.reset(token)
+            finish(audit)
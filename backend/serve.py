@@ -0,0 +1,135 @@
+"""
+Продакшен-запуск: gunicorn с воркерами uvicorn.
+
+    python serve.py
+
+- Число воркеров - WEB_CONCURRENCY, по умолчанию по числу доступных
+  процессу ядер: с учётом affinity и квоты CPU контейнера (cgroup), а не
+  всех ядер машины - иначе ограниченный под получит лишних воркеров, и
+  каждый со своим писателем SQLite.
+- Приложение загружается в мастере (preload) и воркеры получают его через
+  fork. До этого мастер один раз выполняет init_database() под файловой
+  блокировкой DB_INIT_LOCK, так что схема и начальные данные не гоняются
+  между воркерами и соседними запусками. Воркеры видят DB_INIT_DONE=1 и
+  этот шаг пропускают.
+- Воркер завершается штатно (дописав текущие запросы, сбросив кэш и
+  очередь записи) после MAX_REQUESTS +- MAX_REQUESTS_JITTER запросов и
+  заменяется новым - это ограничивает рост памяти.
+- uvloop и httptools подхватываются uvicorn автоматически.
+
+Состояние в памяти у каждого воркера своё. Поэтому при нескольких
+воркерах отложенная запись daisies_left выключается (см. user_state.py),
+а /metrics и /api/debug/* показывают только тот воркер, который ответил.
+Блокировки пользователя (user_locks.StripedLocks) и очередь писателя тоже
+свои в каждом воркере: запросы одного пользователя в разные воркеры между
+собой не упорядочены. Инварианты между процессами держит база - версия
+строки users (409 при гонке), уникальные (user_id, skin_id) в user_skins и
+(key, user_id) в stock_claims, условный UPDATE тиража.
+Для разработки по-прежнему: uvicorn main:app --reload.
+"""
+import logging
+import math
+import os
+
+from dotenv import load_dotenv
+from gunicorn.app.base import BaseApplication
+
+load_dotenv()
+
+logger = logging.getLogger("serve")
+
+
+def _cgroup_cpu_quota() -> float:
+    """Квота CPU контейнера в ядрах; 0 - квоты нет или cgroup недоступна."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:  # cgroup v2: "<quota> <period>" или "max <period>"
+            quota, period = f.read().split()
+        return 0.0 if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:  # cgroup v1, -1 - без квоты
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else 0.0
+    except (OSError, ValueError):
+        return 0.0
+
+
+def available_cpus() -> int:
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    quota = _cgroup_cpu_quota()
+    if quota:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+BIND = os.getenv("BIND", "0.0.0.0:8000")
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "0")) or available_cpus()
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", "10000"))
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", "1000"))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+DB_INIT_LOCK = os.getenv("DB_INIT_LOCK", ".db_init.lock")
+
+
+def init_database_once() -> None:
+    """init_database() под эксклюзивной flock: параллельный запуск ждёт и видит уже готовую схему."""
+    import fcntl
+
+    from main import init_database
+
+    with open(DB_INIT_LOCK, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            init_database()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def post_fork(server, worker) -> None:
+    # Соединения пула, открытые мастером, не должны использоваться из двух процессов
+    from database import engine
+    import metrics
+
+    engine.dispose(close=False)
+    # dispose создаёт новый пул - без обёртки connect из instrument_engine
+    metrics.instrument_pool(engine.pool)
+
+
+class Launcher(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from main import app
+
+        return app
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    if WORKERS > 1 and os.getenv("DAISIES_WRITE_BEHIND", "1") == "1":
+        logger.info("%d workers: daisies_left write-behind disabled", WORKERS)
+        os.environ["DAISIES_WRITE_BEHIND"] = "0"
+    init_database_once()
+    os.environ["DB_INIT_DONE"] = "1"
+    Launcher({
+        "bind": BIND,
+        "workers": WORKERS,
+        "worker_class": "uvicorn_worker.UvicornWorker",
+        "preload_app": True,
+        "max_requests": MAX_REQUESTS,
+        "max_requests_jitter": MAX_REQUESTS_JITTER,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "post_fork": post_fork,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Картинка результата для шаринга (600x600 PNG), как у MainScreen.handleShare:
+диагональный градиент, круг цвета скина, "Результат:", текст результата и
+подпись с именем игрока.
+
+Карточка определяется своими входными данными, поэтому кэшируется на диске
+по их хэшу: SHARE_CARD_DIR/<2 символа>/<digest>.png. Повторный запрос тех же
+данных отдаёт готовый файл; одинаковые одновременные запросы рисуют картинку
+один раз. Рисование (Pillow) идёт в пуле потоков, Pillow импортируется при
+первой карточке.
+
+Шрифты - DejaVu (fonts-dejavu-core в Dockerfile), в нём есть кириллица.
+Размер кэша не ограничивается: карточки маленькие (десятки КБ), чистить
+старые можно по atime.
+"""
+import asyncio
+import hashlib
+import json
+import os
+from typing import Dict, Tuple
+
+SHARE_CARD_DIR = os.getenv("SHARE_CARD_DIR", "share_cards")
+FONT_DIR = os.getenv("SHARE_CARD_FONT_DIR", "/usr/share/fonts/truetype/dejavu")
+
+SIZE = 600
+DEFAULT_COLOR = "#FFD700"
+# Меняется вместе с рисованием: старые файлы кэша перестают совпадать
+RENDER_VERSION = 1
+
+
+def card_digest(text: str, color: str, username: str) -> str:
+    key = json.dumps([RENDER_VERSION, text, color, username], ensure_ascii=False)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _font(bold: bool, size: int):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype(os.path.join(FONT_DIR, "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf"), size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+def render(text: str, color: str, username: str) -> bytes:
+    from io import BytesIO
+
+    from PIL import Image, ImageChops, ImageDraw
+
+    # Градиент из левого верхнего угла в правый нижний: среднее вертикального и горизонтального
+    vertical = Image.linear_gradient("L").resize((SIZE, SIZE))
+    mask = ImageChops.add(vertical, vertical.rotate(90), scale=2.0)
+    image = Image.composite(Image.new("RGB", (SIZE, SIZE), "#98FB98"),
+                            Image.new("RGB", (SIZE, SIZE), "#87CEEB"), mask)
+
+    draw = ImageDraw.Draw(image)
+    cx = cy = SIZE // 2
+    radius = 90
+    try:
+        draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill=color)
+    except ValueError:
+        draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill=DEFAULT_COLOR)
+    draw.text((cx, cy - 60), "Результат:", fill="#333333", font=_font(True, 40), anchor="mm")
+    draw.text((cx, cy), text, fill="#333333", font=_font(True, 56), anchor="mm")
+    draw.text((cx, cy + 70), f'Играй в "Ромашка" в Telegram {username}'.rstrip(),
+              fill="#1b5e20", font=_font(False, 24), anchor="mm")
+
+    out = BytesIO()
+    image.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+class ShareCardCache:
+    def __init__(self, directory: str = SHARE_CARD_DIR):
+        self.directory = directory
+        self._rendering: Dict[str, "asyncio.Future[str]"] = {}
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest + ".png")
+
+    async def get(self, text: str, color: str, username: str) -> Tuple[str, str]:
+        """(digest, путь к PNG); рисует карточку, если её ещё нет на диске."""
+        digest = card_digest(text, color, username)
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            return digest, path
+        pending = self._rendering.get(digest)
+        if pending is not None:
+            return digest, await asyncio.shield(pending)
+        future = self._rendering[digest] = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.to_thread(self._render_to_file, path, text, color, username)
+            future.set_result(path)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Ждущих может не быть - не предупреждать о непрочитанной ошибке
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._rendering[digest]
+        return digest, path
+
+    @staticmethod
+    def _render_to_file(path: str, text: str, color: str, username: str) -> None:
+        data = render(text, color, username)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
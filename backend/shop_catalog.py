@@ -0,0 +1,222 @@
+"""
+Каталог магазина в памяти процесса: фильтры, сортировки и курсорная пагинация.
+
+CatalogIndex - неизменяемый снимок таблицы skins. Для каждой пары
+(категория, сортировка) при первом обращении строится отсортированный
+список скинов и параллельный список ключей сортировки; страница - это
+bisect по ключу курсора и проход до limit подходящих. Для сортировок по
+цене диапазон цен тоже сужается bisect, без перебора.
+
+Курсор - ключ сортировки последнего отданного скина, а не смещение: он
+остаётся верным после пересборки индекса и не пропускает и не повторяет
+скины, если каталог изменился между страницами.
+
+Снимок пересобирается, когда меняется catalog_state.version (триггеры
+SQLite на skins, см. migrate_schema). Версия проверяется не чаще раза в
+CATALOG_CHECK_INTERVAL секунд, так что обычный запрос каталога не тратит
+на это SQL (на других СУБД триггеров нет, и каталог перечитывается только
+при перезапуске).
+
+Флаги "куплено" - один запрос на страницу по id её скинов. С фильтром owned
+инвентарь целиком не читается (у коллекционеров это тысячи строк): владение
+проверяется у следующих кандидатов пачками, каждая вдвое больше прежней, и
+только если за OWNED_PROBES пачек страница не набралась, читается весь
+инвентарь. Так цена запроса зависит от размера страницы, а не инвентаря.
+"""
+import base64
+import binascii
+import json
+import os
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from itertools import islice
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import bindparam, select
+from sqlalchemy.orm import Session
+
+from database import CatalogState, Skin, UserSkin
+from metrics import cache_requests
+import query_audit
+
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "5"))
+MAX_PAGE_SIZE = 200
+OWNED_PROBES = 4  # Пачек проверки владения до чтения всего инвентаря
+
+
+class CatalogSkin:
+    __slots__ = ("id", "name", "price", "color", "is_default", "category")
+
+    def __init__(self, id: int, name: str, price: int, color: Optional[str], is_default: bool, category: str):
+        self.id = id
+        self.name = name
+        self.price = price
+        self.color = color
+        self.is_default = bool(is_default)
+        self.category = category
+
+
+_SAMPLE_SKIN = CatalogSkin(0, "", 0, None, False, "")
+
+SORTS: Dict[str, Callable[[CatalogSkin], Tuple[Any, ...]]] = {
+    "id": lambda skin: (skin.id,),
+    "price_asc": lambda skin: (skin.price, skin.id),
+    "price_desc": lambda skin: (-skin.price, skin.id),
+    "newest": lambda skin: (-skin.id,),
+    "name": lambda skin: (skin.name.casefold(), skin.id),
+}
+
+_CATALOG_VERSION = select(CatalogState.version).where(CatalogState.id == 1)
+_ALL_SKINS = select(Skin.id, Skin.name, Skin.price, Skin.color, Skin.is_default, Skin.category)
+_OWNED = select(UserSkin.skin_id).where(UserSkin.user_id == bindparam("user_id"))
+_OWNED_AMONG = _OWNED.where(UserSkin.skin_id.in_(bindparam("skin_ids", expanding=True)))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(sort: str, key: Tuple[Any, ...]) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort, *key], ensure_ascii=False).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str) -> Tuple[Any, ...]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        raise InvalidCursor("Invalid cursor")
+    if not isinstance(data, list) or len(data) < 2 or data[0] != sort:
+        raise InvalidCursor("Cursor belongs to another sort order")
+    key = tuple(data[1:])
+    # Форма ключа должна совпадать с ключом сортировки, иначе bisect упадёт на сравнении
+    sample = SORTS[sort](_SAMPLE_SKIN)
+    if len(key) != len(sample) or any(type(part) is not type(like) for part, like in zip(key, sample)):
+        raise InvalidCursor("Invalid cursor")
+    return key
+
+
+class CatalogIndex:
+    def __init__(self, skins: Sequence[CatalogSkin], version: int):
+        self.version = version
+        self.skins = sorted(skins, key=lambda skin: skin.id)
+        self.default_ids: FrozenSet[int] = frozenset(skin.id for skin in skins if skin.is_default)
+        self.categories = Counter(skin.category for skin in skins)
+        self._orderings: Dict[Tuple[Optional[str], str], Tuple[List[CatalogSkin], List[Tuple[Any, ...]]]] = {}
+
+    def ordering(self, category: Optional[str], sort: str) -> Tuple[List[CatalogSkin], List[Tuple[Any, ...]]]:
+        ordering = self._orderings.get((category, sort))
+        if ordering is None:
+            if category is None:
+                key = SORTS[sort]
+                skins = sorted(self.skins, key=key)
+                keys = [key(skin) for skin in skins]
+            else:
+                # Раздел - выборка из уже отсортированного каталога, без своей сортировки
+                pairs = [pair for pair in zip(*self.ordering(None, sort)) if pair[0].category == category]
+                skins, keys = [skin for skin, _ in pairs], [key for _, key in pairs]
+            # Гонка двух запросов даст два одинаковых списка - не страшно
+            ordering = self._orderings[(category, sort)] = (skins, keys)
+        return ordering
+
+    def candidates(self, *, category: Optional[str] = None, sort: str = "price_asc",
+                   min_price: Optional[int] = None, max_price: Optional[int] = None,
+                   after: Optional[Tuple[Any, ...]] = None) -> Iterator[CatalogSkin]:
+        """Скины после курсора в порядке сортировки, прошедшие фильтры категории и цены."""
+        skins, keys = self.ordering(category, sort)
+        start, end = 0, len(skins)
+        if after is not None:
+            start = bisect_right(keys, after)
+        if sort == "price_asc":
+            if min_price is not None:
+                start = max(start, bisect_left(keys, (min_price,)))
+            if max_price is not None:
+                end = bisect_left(keys, (max_price + 1,))
+        elif sort == "price_desc":
+            if max_price is not None:
+                start = max(start, bisect_left(keys, (-max_price,)))
+            if min_price is not None:
+                end = bisect_left(keys, (-min_price + 1,))
+
+        for i in range(start, end):
+            skin = skins[i]
+            if min_price is not None and skin.price < min_price:
+                continue
+            if max_price is not None and skin.price > max_price:
+                continue
+            yield skin
+
+
+class ShopCatalog:
+    def __init__(self, check_interval: float = CATALOG_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.index: Optional[CatalogIndex] = None
+        self._checked_at = 0.0
+
+    def get(self, db: Session) -> CatalogIndex:
+        """Актуальный снимок каталога; SQL - только при проверке версии и пересборке."""
+        now = time.monotonic()
+        index = self.index
+        if index is not None and now - self._checked_at < self.check_interval:
+            cache_requests.inc("catalog", "hit")
+            return index
+        # Проверка версии - раз в интервал на процесс, в бюджет маршрута не входит
+        with query_audit.unbudgeted():
+            version = db.execute(_CATALOG_VERSION).scalar() or 0
+            if index is None or index.version != version:
+                cache_requests.inc("catalog", "miss")
+                # Версия и строки читаются в одной транзакции - снимок согласован
+                index = self.index = CatalogIndex([CatalogSkin(*row) for row in db.execute(_ALL_SKINS)], version)
+        self._checked_at = now
+        return index
+
+    def invalidate(self) -> None:
+        """Следующий get() проверит версию сразу, не дожидаясь интервала."""
+        self._checked_at = 0.0
+
+
+def owned_skin_ids(db: Session, user_id: int, among: Optional[Sequence[int]] = None) -> Set[int]:
+    """Купленные пользователем скины: все или только из among - одним запросом."""
+    if among is None:
+        return set(db.execute(_OWNED, {"user_id": user_id}).scalars())
+    if not among:
+        return set()
+    return set(db.execute(_OWNED_AMONG, {"user_id": user_id, "skin_ids": list(among)}).scalars())
+
+
+def browse(db: Session, index: CatalogIndex, user_id: int, *, category: Optional[str] = None,
+           sort: str = "price_asc", min_price: Optional[int] = None, max_price: Optional[int] = None,
+           owned: Optional[bool] = None, cursor: Optional[str] = None,
+           limit: int = 50) -> Tuple[List[Tuple[CatalogSkin, bool]], Optional[str]]:
+    """
+    Страница каталога для пользователя: [(скин, куплен)], курсор следующей
+    страницы. SQL: один запрос без фильтра owned, с ним - до OWNED_PROBES + 1.
+    Дефолтные скины куплены всегда.
+    """
+    after = decode_cursor(cursor, sort) if cursor else None
+    candidates = index.candidates(category=category, sort=sort, min_price=min_price, max_price=max_price,
+                                  after=after)
+    if owned is None:
+        skins = list(islice(candidates, limit + 1))
+        owned_ids = owned_skin_ids(db, user_id, [skin.id for skin in skins[:limit] if not skin.is_default])
+    else:
+        skins = []
+        owned_ids = set()
+        batch = limit + 1
+        for probe in range(OWNED_PROBES + 1):
+            if probe == OWNED_PROBES:
+                # Подходящие редки: дешевле один раз прочитать инвентарь, чем проверять дальше
+                owned_ids = owned_skin_ids(db, user_id)
+                chunk = list(candidates)
+            else:
+                chunk = list(islice(candidates, batch))
+                owned_ids |= owned_skin_ids(db, user_id, [skin.id for skin in chunk if not skin.is_default])
+            skins.extend(skin for skin in chunk if (skin.id in owned_ids or skin.is_default) == owned)
+            if len(skins) > limit or len(chunk) < batch:
+                break
+            batch *= 2
+    more = len(skins) > limit
+    skins = skins[:limit]
+    items = [(skin, skin.id in owned_ids or skin.is_default) for skin in skins]
+    next_cursor = encode_cursor(sort, SORTS[sort](skins[-1])) if more else None
+    return items, next_cursor
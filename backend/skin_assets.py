@@ -0,0 +1,286 @@
+"""
+Картинки скинов: исходник -> варианты нескольких размеров и спрайт-листы.
+
+Исходник скина - SKIN_SOURCE_DIR/<skin_id>.png (.jpg, .webp); для скина без
+исходника рисуется ромашка его цвета. Из исходника получаются квадратные
+варианты SIZES, а из вариантов SPRITE_SIZE - спрайт-листы: скины по id
+раскладываются на страницы сеткой не больше SHEET_COLUMNS x SHEET_ROWS,
+так что лист не больше 2048x2048 при любом размере каталога. В именах
+файлов хэш содержимого, поэтому они отдаются с Cache-Control: immutable, а
+магазин грузит картинки страницы одним запросом листа.
+
+Сборка инкрементальная: SKIN_ASSET_DIR/manifest.json хранит для каждого скина
+хэш входа (байты исходника или цвет) и имена его вариантов. Скин
+перерисовывается, только если вход изменился или файла нет; лист - только
+если изменился набор вариантов на его странице. Без изменений build() лишь
+читает исходники и не импортирует Pillow. Старые файлы не удаляются: их ещё
+могут запросить клиенты с прежним ответом /api/skins.
+
+build() вызывается в фоне после старта (холодная сборка большого каталога -
+минуты, старт её не ждёт; до её конца у новых скинов нет картинки) и из
+POST /api/debug/skin-assets/rebuild. Сборки разных воркеров идут по очереди
+под flock, вторая видит готовый manifest. Воркеры подхватывают новый
+manifest через refresh() (по mtime).
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+SKIN_SOURCE_DIR = os.getenv("SKIN_SOURCE_DIR", "skin_sources")
+SKIN_ASSET_DIR = os.getenv("SKIN_ASSET_DIR", "static/skins")
+URL_PREFIX = "/api/skin-assets/"
+
+SIZES = (64, 128, 256)
+SPRITE_SIZE = 128  # Размер, листом которого пользуется магазин
+SHEET_COLUMNS = SHEET_ROWS = 16  # Скинов на странице листа - не больше 256
+SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+# Меняется вместе с рисованием: все скины перерисуются при следующей сборке
+RENDER_VERSION = 1
+
+logger = logging.getLogger("skin_assets")
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def find_source(skin_id: int, source_dir: str = SKIN_SOURCE_DIR) -> Optional[str]:
+    for ext in SOURCE_EXTENSIONS:
+        path = os.path.join(source_dir, f"{skin_id}{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _draw_daisy(color: str):
+    """Ромашка цвета скина на прозрачном фоне, 512x512 - уменьшается до вариантов."""
+    from PIL import Image, ImageDraw
+
+    size = 512
+    image = Image.new("RGBA", (size, size))
+    petal = Image.new("RGBA", (size, size))
+    draw = ImageDraw.Draw(petal)
+    try:
+        draw.ellipse((size * 0.38, size * 0.04, size * 0.62, size * 0.5), fill=color, outline="#BDBDBD", width=6)
+    except ValueError:
+        draw.ellipse((size * 0.38, size * 0.04, size * 0.62, size * 0.5), fill="#FFFFFF", outline="#BDBDBD", width=6)
+    for i in range(8):
+        image.alpha_composite(petal.rotate(i * 45, resample=Image.BICUBIC))
+    ImageDraw.Draw(image).ellipse((size * 0.38, size * 0.38, size * 0.62, size * 0.62), fill="#FFD700")
+    return image
+
+
+def _png(image) -> bytes:
+    from io import BytesIO
+
+    out = BytesIO()
+    image.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+def _write(path: str, data: bytes) -> None:
+    if os.path.exists(path):
+        return  # Имя - хэш содержимого: файл уже тот же
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class SkinAssets:
+    def __init__(self, source_dir: str = SKIN_SOURCE_DIR, asset_dir: str = SKIN_ASSET_DIR):
+        self.source_dir = source_dir
+        self.asset_dir = asset_dir
+        self.manifest: Dict[str, Any] = {"skins": {}, "sheets": []}
+        self._cells: Dict[int, Tuple[str, int, int]] = {}  # skin_id -> (лист, x, y)
+        self._mtime: Optional[float] = None
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.asset_dir, "manifest.json")
+
+    def refresh(self) -> bool:
+        """Перечитывает manifest, если его пересобрали; True - данные обновились."""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return False
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except ValueError:
+            return False  # Файл заменяется атомарно, так что это чужой или битый manifest
+        self._use(manifest)
+        self._mtime = mtime
+        return True
+
+    def _use(self, manifest: Dict[str, Any]) -> None:
+        if not isinstance(manifest.get("sheets"), list):
+            manifest["sheets"] = []  # Прежний формат - по листу на размер; пересоберутся страницами
+        self._cells = {int(skin_id): (sheet["file"], x, y)
+                       for sheet in manifest["sheets"] for skin_id, (x, y) in sheet["cells"].items()}
+        self.manifest = manifest
+
+    def image_url(self, skin_id: int, size: int = SPRITE_SIZE) -> Optional[str]:
+        entry = self.manifest["skins"].get(str(skin_id))
+        if entry is None:
+            return None
+        name = entry["variants"].get(str(size))
+        return URL_PREFIX + name if name else None
+
+    def sprite(self, skin_id: int) -> Optional[Dict[str, Any]]:
+        """Ячейка скина в спрайт-листе своей страницы: url листа, x, y, width, height."""
+        cell = self._cells.get(skin_id)
+        if cell is None:
+            return None
+        file, x, y = cell
+        return {"url": URL_PREFIX + file, "x": x, "y": y, "width": SPRITE_SIZE, "height": SPRITE_SIZE}
+
+    def build(self, skins: Iterable[Tuple[int, Optional[str]]], force: bool = False) -> List[int]:
+        """
+        Собирает варианты и листы для (id, цвет) скинов; возвращает id
+        перерисованных. Вызывается в отдельном потоке или до запуска сервера;
+        параллельная сборка другого процесса дожидается этой.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            # Windows: там запускается один процесс (python main.py), ждать некого
+            fcntl = None
+        os.makedirs(self.asset_dir, exist_ok=True)
+        with open(os.path.join(self.asset_dir, ".build.lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._build(skins, force)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _build(self, skins: Iterable[Tuple[int, Optional[str]]], force: bool) -> List[int]:
+        self.refresh()
+        old_skins = self.manifest["skins"]
+        old_sheets = self.manifest["sheets"]
+        skins_out: Dict[str, Any] = {}
+        changed: List[int] = []
+
+        for skin_id, color in sorted(skins):
+            source = find_source(skin_id, self.source_dir)
+            if source is not None:
+                with open(source, "rb") as f:
+                    data = f.read()
+            else:
+                data = f"color:{color or '#FFFFFF'}".encode()
+            key = _digest(f"{RENDER_VERSION}:{SIZES}:".encode() + data)
+            entry = old_skins.get(str(skin_id))
+            if (not force and entry is not None and entry["input"] == key
+                    and all(os.path.exists(os.path.join(self.asset_dir, name)) for name in entry["variants"].values())):
+                skins_out[str(skin_id)] = entry
+                continue
+            skins_out[str(skin_id)] = {"input": key, "variants": self._render_variants(skin_id, source, data)}
+            changed.append(skin_id)
+
+        # Страница пересобирается, только если изменился её набор вариантов
+        reusable = {sheet["input"]: sheet for sheet in old_sheets}
+        names = sorted((int(skin_id), entry["variants"][str(SPRITE_SIZE)]) for skin_id, entry in skins_out.items())
+        per_sheet = SHEET_COLUMNS * SHEET_ROWS
+        sheets_out: List[Dict[str, Any]] = []
+        for start in range(0, len(names), per_sheet):
+            page = names[start:start + per_sheet]
+            key = _digest(json.dumps([SPRITE_SIZE, SHEET_COLUMNS, page]).encode())
+            sheet = reusable.get(key)
+            if not force and sheet is not None and os.path.exists(os.path.join(self.asset_dir, sheet["file"])):
+                sheets_out.append(sheet)
+            else:
+                sheets_out.append(self._render_sheet(page, key))
+
+        manifest = {"skins": skins_out, "sheets": sheets_out}
+        if manifest != self.manifest or not os.path.exists(self.manifest_path):
+            tmp = f"{self.manifest_path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.manifest_path)
+        self._use(manifest)
+        self._mtime = os.stat(self.manifest_path).st_mtime
+        return changed
+
+    def _render_variants(self, skin_id: int, source: Optional[str], data: bytes) -> Dict[str, str]:
+        from PIL import Image, ImageOps
+
+        if source is not None:
+            with Image.open(source) as original:
+                image = ImageOps.fit(original.convert("RGBA"), (512, 512), Image.LANCZOS)
+        else:
+            image = _draw_daisy(data.decode().split(":", 1)[1])
+        variants = {}
+        for size in SIZES:
+            png = _png(image.resize((size, size), Image.LANCZOS))
+            name = f"skin-{skin_id}-{size}-{_digest(png)[:12]}.png"
+            _write(os.path.join(self.asset_dir, name), png)
+            variants[str(size)] = name
+        return variants
+
+    def _render_sheet(self, names: Sequence[Tuple[int, str]], key: str) -> Dict[str, Any]:
+        from PIL import Image
+
+        size = SPRITE_SIZE
+        columns = min(SHEET_COLUMNS, len(names))
+        rows = math.ceil(len(names) / columns)
+        sheet = Image.new("RGBA", (columns * size, rows * size))
+        cells = {}
+        for i, (skin_id, name) in enumerate(names):
+            x, y = (i % columns) * size, (i // columns) * size
+            with Image.open(os.path.join(self.asset_dir, name)) as variant:
+                sheet.paste(variant, (x, y))
+            cells[str(skin_id)] = [x, y]
+        png = _png(sheet)
+        file = f"sprite-{size}-{_digest(png)[:12]}.png"
+        _write(os.path.join(self.asset_dir, file), png)
+        return {"input": key, "file": file, "cells": cells}
+
+
+def sync_image_urls(db, assets: SkinAssets) -> int:
+    """Проставляет skins.image_url по manifest; возвращает число обновлённых строк."""
+    from sqlalchemy import select, update
+
+    from database import Skin
+
+    updated = 0
+    for skin_id, image_url in db.execute(select(Skin.id, Skin.image_url)).all():
+        url = assets.image_url(skin_id)
+        if url is not None and url != image_url:
+            db.execute(update(Skin).where(Skin.id == skin_id).values(image_url=url))
+            updated += 1
+    return updated
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Сборка картинок и спрайт-листов скинов")
+    parser.add_argument("--force", action="store_true", help="перерисовать все скины")
+    args = parser.parse_args(argv)
+
+    from sqlalchemy import select
+
+    from database import SessionLocal, Skin
+
+    assets = SkinAssets()
+    db = SessionLocal()
+    try:
+        changed = assets.build(db.execute(select(Skin.id, Skin.color)).all(), force=args.force)
+        updated = sync_image_urls(db, assets)
+        db.commit()
+    finally:
+        db.close()
+    print(f"{len(changed)} skins rendered, {updated} image urls updated, assets in {assets.asset_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Отчёт о холодном старте процесса.
+
+Импортируется первым в main.py. С этого момента:
+- время импорта каждого модуля (включая вложенные импорты) пишется
+  перехватчиком в sys.meta_path, пока не придёт первый ответ;
+- фазы старта (настройка мапперов, проверка схемы и т.п.) отмечаются
+  через with phase("name");
+- FirstResponseMiddleware фиксирует первый отданный ответ: его
+  длительность и время от начала импорта до него (time to first response).
+
+После первого ответа перехватчик снимается, отчёт пишется в лог и
+доступен на GET /api/debug/startup. Для подробного дерева импортов
+есть python -X importtime -c "import main".
+"""
+import importlib.abc
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+T0 = time.perf_counter()
+
+logger = logging.getLogger("startup")
+
+_phases: List[Tuple[str, float]] = []
+_imports: Dict[str, float] = {}
+_report: Dict[str, Any] = {}
+
+
+class _TimedLoader(importlib.abc.Loader):
+    def __init__(self, loader):
+        self.loader = loader
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        started = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            _imports[module.__name__] = time.perf_counter() - started
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    """Находит spec остальными finder'ами и оборачивает загрузчик замером exec_module."""
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader)
+                return spec
+        return None
+
+
+_timer = _ImportTimer()
+sys.meta_path.insert(0, _timer)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - started))
+
+
+def report() -> Dict[str, Any]:
+    return _report
+
+
+def _finish(first_request: float) -> None:
+    if _timer in sys.meta_path:
+        sys.meta_path.remove(_timer)
+    # Время верхнего уровня включает вложенные импорты, поэтому суммировать их нельзя
+    top = sorted(((name, t) for name, t in _imports.items() if "." not in name), key=lambda item: -item[1])
+    _report.update({
+        "time_to_first_response_ms": round((time.perf_counter() - T0) * 1000, 1),
+        "first_request_ms": round(first_request * 1000, 1),
+        "phases_ms": {name: round(t * 1000, 1) for name, t in _phases},
+        "slowest_imports_ms": {name: round(t * 1000, 1) for name, t in top[:15]},
+        "modules_imported": len(_imports),
+    })
+    logger.info("startup: %s", _report)
+
+
+class FirstResponseMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.done = False
+
+    async def __call__(self, scope, receive, send):
+        if self.done or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if not self.done:
+                self.done = True
+                _finish(time.perf_counter() - started)
@@ -0,0 +1,85 @@
+"""
+Наборы кастомных текстов, хранимые по содержимому.
+
+users.text_set_id ссылается на строку text_sets; одинаковые наборы
+хранятся один раз (уникальный digest). У большинства пользователей
+дефолтный набор - для него text_set_id = NULL и ни строки, ни запроса нет.
+
+TextSetCache держит LRU id -> уже разобранный кортеж строк, так что на
+чтение JSON не разбирается. Наборы неизменяемы (новый текст - новый
+набор), поэтому кэш не нужно инвалидировать, и он одинаково верен для
+всех воркеров.
+"""
+import json
+import threading
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+
+from sqlalchemy import bindparam, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import DEFAULT_TEXTS, TextSet, text_set_digest, text_set_json
+from metrics import cache_requests
+import query_audit
+
+Texts = Tuple[str, ...]
+
+_TEXTS_BY_ID = select(TextSet.texts).where(TextSet.id == bindparam("set_id"))
+_ID_BY_DIGEST = select(TextSet.id).where(TextSet.digest == bindparam("digest"))
+_INSERT = insert(TextSet).returning(TextSet.id)
+
+
+class TextSetCache:
+    def __init__(self, max_size: int = 10_000):
+        self.max_size = max_size
+        self._sets: "OrderedDict[int, Texts]" = OrderedDict()
+        # intern вызывается из потока-писателя, get - из event loop
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, set_id: Optional[int]) -> Texts:
+        """Тексты набора; при промахе - один SELECT по первичному ключу."""
+        if set_id is None:
+            return DEFAULT_TEXTS
+        with self._lock:
+            texts = self._sets.get(set_id)
+            if texts is not None:
+                self._sets.move_to_end(set_id)
+        if texts is not None:
+            cache_requests.inc("text_sets", "hit")
+            return texts
+        cache_requests.inc("text_sets", "miss")
+        # Промах - разовый на процесс и набор, в бюджет запросов маршрута не входит
+        with query_audit.unbudgeted():
+            raw = db.execute(_TEXTS_BY_ID, {"set_id": set_id}).scalar()
+        texts = tuple(json.loads(raw)) if raw is not None else DEFAULT_TEXTS
+        self._remember(set_id, texts)
+        return texts
+
+    def intern(self, wdb: Session, texts: Sequence[str]) -> Optional[int]:
+        """
+        id набора с такими текстами (создаётся при необходимости); None - дефолтный набор.
+        Вызывать до изменения объектов сессии: SAVEPOINT вставки сбрасывает их flush'ем.
+        """
+        texts = tuple(texts)
+        if texts == DEFAULT_TEXTS:
+            return None
+        digest = text_set_digest(texts)
+        set_id = wdb.execute(_ID_BY_DIGEST, {"digest": digest}).scalar()
+        if set_id is None:
+            try:
+                with wdb.begin_nested():
+                    set_id = wdb.execute(_INSERT, {"digest": digest, "texts": text_set_json(texts)}).scalar_one()
+            except IntegrityError:
+                # Тот же набор только что создал другой процесс
+                set_id = wdb.execute(_ID_BY_DIGEST, {"digest": digest}).scalar_one()
+        # В кэш не кладём: транзакция писателя ещё может откатиться, а id - достаться
+        # другому набору. Кэш заполнится при первом чтении
+        return set_id
+
+    def _remember(self, set_id: int, texts: Texts) -> None:
+        with self._lock:
+            self._sets[set_id] = texts
+            self._sets.move_to_end(set_id)
+            if len(self._sets) > self.max_size:
+                self._sets.popitem(last=False)
@@ -0,0 +1,235 @@
+"""
+Лёгкая трассировка запросов без внешнего коллектора.
+
+Каждый HTTP-запрос получает trace id (заголовок ответа X-Trace-Id). Доля
+TRACE_SAMPLE_RATE запросов записывается целиком: корневой спан запроса,
+спаны вокруг verify_init_data, каждого SQL-выражения (в том числе в
+потоке-писателе) и каждого вызова Bot API. Готовые трассы лежат в
+кольцевом буфере на TRACE_BUFFER штук (GET /api/debug/traces, нужен
+X-Admin-Token) и, если задан TRACE_FILE, пишутся строками JSON в
+ротируемый файл.
+
+Запрос с заголовками X-Trace: 1 и X-Admin-Token записывается вне
+зависимости от выборки.
+Для невыбранных запросов span() возвращает пустой контекст-менеджер.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from admin_auth import is_admin_token
+from metrics import route_of
+
+SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+BUFFER_SIZE = int(os.getenv("TRACE_BUFFER", "200"))
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "duration", "attrs", "_started")
+
+    def __init__(self, name: str, parent_id: Optional[str], attrs: Dict[str, Any]):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.attrs = attrs
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._started
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "attrs": self.attrs,
+        }
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+
+    def to_dict(self) -> Dict[str, Any]:
+        root = self.spans[0] if self.spans else None
+        return {
+            "trace_id": self.trace_id,
+            "name": root.name if root else None,
+            "start": root.start if root else None,
+            "duration_ms": root.to_dict()["duration_ms"] if root else None,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+
+# Трасса запроса (None - запрос не выбран) и текущий спан - родитель для новых
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+_buffer: "deque[Dict[str, Any]]" = deque(maxlen=BUFFER_SIZE)
+_buffer_lock = threading.Lock()
+
+_file_logger: Optional[logging.Logger] = None
+if TRACE_FILE:
+    _file_logger = logging.getLogger("tracing.file")
+    _file_logger.propagate = False
+    _file_logger.setLevel(logging.INFO)
+    _file_logger.addHandler(logging.handlers.RotatingFileHandler(
+        TRACE_FILE, maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"))
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _ActiveSpan:
+    __slots__ = ("trace", "span", "token")
+
+    def __init__(self, trace: Trace, name: str, attrs: Dict[str, Any]):
+        parent = current_span.get()
+        self.trace = trace
+        self.span = Span(name, parent.span_id if parent else None, attrs)
+
+    def __enter__(self) -> Span:
+        self.trace.spans.append(self.span)
+        self.token = current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.finish()
+        if exc_type is not None:
+            self.span.attrs["error"] = exc_type.__name__
+        current_span.reset(self.token)
+        return False
+
+
+def span(name: str, **attrs: Any):
+    """with span("telegram.sendInvoice"): ... - спан, если запрос трассируется."""
+    trace = current_trace.get()
+    if trace is None:
+        return _NOOP
+    return _ActiveSpan(trace, name, attrs)
+
+
+def recent(limit: int = 50) -> List[Dict[str, Any]]:
+    with _buffer_lock:
+        traces = list(_buffer)
+    return traces[-limit:][::-1]
+
+
+def get(trace_id: str) -> Optional[Dict[str, Any]]:
+    with _buffer_lock:
+        for trace in _buffer:
+            if trace["trace_id"] == trace_id:
+                return trace
+    return None
+
+
+def _store(trace: Trace) -> None:
+    data = trace.to_dict()
+    with _buffer_lock:
+        _buffer.append(data)
+    if _file_logger is not None:
+        _file_logger.info(json.dumps(data, ensure_ascii=False))
+
+
+def instrument_engine(engine) -> None:
+    """Спан на каждое SQL-выражение трассируемого запроса."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        trace = current_trace.get()
+        if trace is None:
+            return
+        parent = current_span.get()
+        sql_span = Span("sql", parent.span_id if parent else None,
+                        {"statement": " ".join(statement.split())[:500], "executemany": executemany})
+        trace.spans.append(sql_span)
+        conn.info["trace_span"] = sql_span
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        sql_span = conn.info.pop("trace_span", None)
+        if sql_span is not None:
+            sql_span.finish()
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        conn = exception_context.connection
+        sql_span = conn.info.pop("trace_span", None) if conn is not None else None
+        if sql_span is not None:
+            sql_span.finish()
+            sql_span.attrs["error"] = type(exception_context.original_exception).__name__
+
+
+class TracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace_id = uuid.uuid4().hex
+        headers = dict(scope["headers"])
+        # Принудительная трассировка - только с токеном администратора
+        forced = headers.get(b"x-trace") == b"1" and is_admin_token(headers.get(b"x-admin-token"))
+        if not forced and random.random() >= SAMPLE_RATE:
+            # Не выбран: только id для корреляции с логами клиента
+            async def send_with_id(message):
+                if message["type"] == "http.response.start":
+                    _add_trace_header(message, trace_id)
+                await send(message)
+
+            await self.app(scope, receive, send_with_id)
+            return
+
+        trace = Trace(trace_id)
+        trace_token = current_trace.set(trace)
+        root = _ActiveSpan(trace, scope["method"], {"path": scope["path"]})
+        root.__enter__()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                _add_trace_header(message, trace_id)
+                root.span.attrs["status"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as exc:
+            root.span.attrs["error"] = type(exc).__name__
+            raise
+        finally:
+            # Имя корневого спана - шаблон маршрута, он известен только после роутинга
+            root.span.name = f'{scope["method"]} {route_of(scope)}'
+            root.__exit__(None, None, None)
+            current_trace.reset(trace_token)
+            _store(trace)
+
+
+def _add_trace_header(message, trace_id: str) -> None:
+    message["headers"] = list(message.get("headers", [])) + [(b"x-trace-id", trace_id.encode())]
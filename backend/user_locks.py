@@ -0,0 +1,22 @@
+"""
+Таблица асинхронных блокировок с разбиением по user id (lock striping).
+
+Изменения одного пользователя выполняются по очереди внутри процесса,
+разные пользователи идут параллельно: им достаются разные полосы. Таблица
+фиксированного размера, поэтому память не растёт с числом пользователей;
+редкие совпадения полос у разных пользователей лишь ненадолго
+сериализуют их запросы.
+"""
+import asyncio
+from typing import List
+
+
+class StripedLocks:
+    def __init__(self, stripes: int = 1024):
+        self._locks: List[asyncio.Lock] = [asyncio.Lock() for _ in range(stripes)]
+
+    def for_key(self, key: int) -> asyncio.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    def locked_count(self) -> int:
+        return sum(1 for lock in self._locks if lock.locked())
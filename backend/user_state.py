@@ -0,0 +1,182 @@
+"""
+Авторитетный кэш горячих счётчиков пользователя с отложенной записью.
+
+GET/POST /api/daisies вызываются на каждом раунде игры. Значение
+daisies_left живёт в памяти процесса (шард по user id), а в таблицу users
+сбрасывается пачкой через WriteQueue: раз в flush_interval секунд, когда
+накопилось max_dirty изменённых пользователей, и при остановке.
+
+Гарантии при падении:
+- штатная остановка (shutdown) сбрасывает все изменения;
+- при аварийном завершении процесса теряются только изменения, сделанные
+  после последнего сброса: не старше flush_interval секунд и не больше
+  max_dirty пользователей. В БД остаётся последнее сброшенное значение,
+  частично записанной пачки не бывает - сброс идёт одной транзакцией;
+- ромашки, купленные за листики (buy_daisy), пишутся в БД сразу, в той же
+  транзакции, что и списание, поэтому оплаченная ромашка не теряется.
+
+Баланс здесь не кэшируется: он обязан меняться в одной транзакции с
+журналом проводок (см. ledger.py).
+
+Кэш рассчитан на один процесс. При нескольких воркерах отложенная запись
+выключается (DAISIES_WRITE_BEHIND=0): чтение идёт из БД, запись - сразу.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import bindparam
+from sqlalchemy.orm import Session
+
+from database import User
+from metrics import cache_requests
+from write_queue import WriteQueue
+
+logger = logging.getLogger("user_state")
+
+_users = User.__table__
+_UPDATE_DAISIES = (
+    _users.update()
+    .where(_users.c.id == bindparam("b_id"))
+    .values(daisies_left=bindparam("b_daisies_left"))
+)
+
+
+class _Shard:
+    __slots__ = ("values", "dirty")
+
+    def __init__(self):
+        self.values: "OrderedDict[int, int]" = OrderedDict()
+        self.dirty: Set[int] = set()
+
+
+class UserStateCache:
+    """
+    Все методы вызываются из потока event loop, поэтому шарды не требуют
+    блокировок: между чтением и записью значения нет await.
+    """
+
+    def __init__(self, writer: WriteQueue, write_behind: bool = True, shards: int = 64,
+                 flush_interval: float = 2.0, max_dirty: int = 512, max_entries: int = 100_000):
+        self.writer = writer
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+        self.max_entries_per_shard = max(1, max_entries // shards)
+        self._shards = [_Shard() for _ in range(shards)]
+        self._dirty_count = 0
+        self._task: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    def _shard(self, user_id: int) -> _Shard:
+        return self._shards[user_id % len(self._shards)]
+
+    def get_daisies(self, user: User) -> int:
+        """Текущее значение; при промахе берётся из уже загруженной строки users."""
+        if not self.write_behind:
+            return user.daisies_left
+        shard = self._shard(user.id)
+        value = shard.values.get(user.id)
+        if value is None:
+            cache_requests.inc("daisies", "miss")
+            value = user.daisies_left if user.daisies_left is not None else 2
+            self._remember(shard, user.id, value)
+        else:
+            cache_requests.inc("daisies", "hit")
+            shard.values.move_to_end(user.id)
+        return value
+
+    async def set_daisies(self, user_id: int, value: int) -> int:
+        if not self.write_behind:
+            def work(wdb: Session):
+                wdb.execute(_UPDATE_DAISIES, [{"b_id": user_id, "b_daisies_left": value}])
+
+            await self.writer.run(work)
+            return value
+        shard = self._shard(user_id)
+        self._remember(shard, user_id, value)
+        if user_id not in shard.dirty:
+            shard.dirty.add(user_id)
+            self._dirty_count += 1
+            if self._dirty_count >= self.max_dirty and self._flushing is None:
+                self._flushing = asyncio.ensure_future(self._flush_on_threshold())
+        return value
+
+    def dirty_count(self) -> int:
+        return self._dirty_count
+
+    def mark_written(self, user_id: int, value: int) -> None:
+        """Значение уже записано в БД вызывающим (например, при покупке ромашки)."""
+        if not self.write_behind:
+            return
+        shard = self._shard(user_id)
+        self._remember(shard, user_id, value)
+        if user_id in shard.dirty:
+            shard.dirty.discard(user_id)
+            self._dirty_count -= 1
+
+    def _remember(self, shard: _Shard, user_id: int, value: int) -> None:
+        shard.values[user_id] = value
+        shard.values.move_to_end(user_id)
+        # Вытесняем только чистые записи: грязные ещё не сброшены в БД
+        if len(shard.values) > self.max_entries_per_shard:
+            for candidate in list(shard.values)[:len(shard.values) - self.max_entries_per_shard]:
+                if candidate not in shard.dirty:
+                    del shard.values[candidate]
+
+    async def flush(self) -> int:
+        """Сбрасывает изменённые значения одной транзакцией. Возвращает их число."""
+        params: List[Dict[str, int]] = []
+        for shard in self._shards:
+            for user_id in shard.dirty:
+                params.append({"b_id": user_id, "b_daisies_left": shard.values[user_id]})
+            shard.dirty.clear()
+        self._dirty_count = 0
+        if not params:
+            return 0
+
+        def work(wdb: Session):
+            wdb.execute(_UPDATE_DAISIES, params)
+
+        try:
+            await self.writer.run(work)
+        except BaseException:
+            # Не удалось записать - значения снова грязные и уйдут со следующим сбросом
+            for item in params:
+                shard = self._shard(item["b_id"])
+                if item["b_id"] not in shard.dirty:
+                    shard.dirty.add(item["b_id"])
+                    self._dirty_count += 1
+            raise
+        return len(params)
+
+    async def _flush_on_threshold(self) -> None:
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Error flushing user state")
+        finally:
+            self._flushing = None
+
+    def start(self) -> None:
+        if self.write_behind and self._task is None:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error flushing user state")
@@ -0,0 +1,120 @@
+"""
+Единственный поток-писатель с групповым коммитом.
+
+SQLite допускает одного писателя: конкурирующие коммиты из обработчиков
+ждут блокировку, каждый платит за свой fsync и под нагрузкой падают с
+"database is locked". Вместо этого обработчики отправляют единицы работы
+(функции от Session) в очередь; поток-писатель забирает всё накопившееся,
+выполняет каждую единицу в своём SAVEPOINT и коммитит пачку одной
+транзакцией. Ошибка в единице откатывает только её SAVEPOINT и уходит в
+future этого вызывающего, остальные единицы пачки коммитятся.
+"""
+import asyncio
+import contextvars
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
+
+from sqlalchemy.orm import Session, sessionmaker
+
+from database import engine
+
+T = TypeVar("T")
+
+# BEGIN IMMEDIATE: блокировка на запись берётся в начале пачки, а не при первом INSERT
+WriterSession = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    bind=engine.execution_options(sqlite_begin="BEGIN IMMEDIATE"),
+)
+
+_STOP = object()
+
+
+class WriteQueue:
+    def __init__(self, session_factory: Callable[[], Session] = WriterSession, max_batch: int = 64):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Дописывает уже поставленную работу и останавливает поток."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, work: Callable[[Session], T]) -> "Future[T]":
+        """
+        Ставит единицу работы в очередь. Коммит делает писатель, не work.
+        work выполняется в копии контекста вызывающего: метрики и трассировка
+        запроса видят и его SQL в потоке-писателе.
+        """
+        self.start()
+        future: "Future[T]" = Future()
+        self._queue.put((work, future, contextvars.copy_context()))
+        return future
+
+    async def run(self, work: Callable[[Session], T]) -> T:
+        return await asyncio.wrap_future(self.submit(work))
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stop = False
+            # Всё, что накопилось, пока писатель был занят, уходит в ту же транзакцию
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+            if stop:
+                return
+
+    def _commit_batch(self, batch: List[Tuple[Callable[[Session], Any], Future, contextvars.Context]]) -> None:
+        done: List[Tuple[Future, Any]] = []
+        db = self.session_factory()
+        try:
+            for work, future, context in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                savepoint = db.begin_nested()
+                try:
+                    result = context.run(work, db)
+                    savepoint.commit()
+                except BaseException as exc:
+                    savepoint.rollback()
+                    future.set_exception(exc)
+                else:
+                    done.append((future, result))
+            db.commit()
+        except BaseException as exc:
+            db.rollback()
+            for future, _ in done:
+                future.set_exception(exc)
+        else:
+            for future, result in done:
+                future.set_result(result)
+        finally:
+            db.close()
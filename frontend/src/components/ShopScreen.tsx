@@ -119,18 +119,30 @@ const ShopScreen: React.FC<ShopScreenProps> = ({
               <div 
                 className="skin-preview"
                 style={{ 
-                  backgroundColor: getSkinColor(skin),
+                  backgroundColor: skin.sprite ? 'transparent' : getSkinColor(skin),
                   borderColor: selectedSkin === skin.id ? '#2196F3' : 'transparent'
                 }}
               >
-                <div className="skin-daisy">
-                  <div className="skin-center"></div>
-                  <div className="skin-petals">
-                    {[...Array(8)].map((_, i) => (
-                      <div key={i} className={`skin-petal skin-petal-${i + 1}`}></div>
-                    ))}
+                {skin.sprite ? (
+                  <div
+                    className="skin-sprite"
+                    style={{
+                      backgroundImage: `url(${skin.sprite.url})`,
+                      backgroundPosition: `-${skin.sprite.x}px -${skin.sprite.y}px`,
+                      width: skin.sprite.width,
+                      height: skin.sprite.height
+                    }}
+                  />
+                ) : (
+                  <div className="skin-daisy">
+                    <div className="skin-center"></div>
+                    <div className="skin-petals">
+                      {[...Array(8)].map((_, i) => (
+                        <div key={i} className={`skin-petal skin-petal-${i + 1}`}></div>
+                      ))}
+                    </div>
                   </div>
-                </div>
+                )}
               </div>
               
               <div className="skin-info">
@@ -17,6 +17,16 @@ export interface Skin {
   color: string
   is_default: boolean
   owned: boolean
+  image_url?: string | null
+  sprite?: SkinSprite | null
+}
+
+export interface SkinSprite {
+  url: string
+  x: number
+  y: number
+  width: number
+  height: number
 }
 
 export interface Referral {